@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+This module decides which commands are executed and which are dropped.
+
+Every command costs storage round trips and usually a Slack post, so a
+single user asking for the ``leaderboard`` in a loop slows the bot down
+for everyone. `AdmissionControl` runs before `handle_command` and keeps
+a token bucket per user and per channel:
+
+- a bucket holds up to ``burst`` tokens and refills at ``rate`` tokens
+  per second,
+- a command is admitted if both the user's and the channel's buckets
+  hold its cost, which is then taken from both,
+- commands have different costs: boards read every user's score, so
+  they cost more than a give,
+- boards take from a channel bucket of their own, so a channel flooded
+  with boards still admits gives.
+
+Buckets are kept in LRU order with at most ``max_buckets`` per kind, so
+memory stays bounded however many users and channels are seen. A bucket
+evicted for being idle would have refilled anyway.
+
+Checking a command is a few dictionary operations and never touches
+storage. A rejected user is told once, until a command of theirs is
+admitted again (see `AdmissionControl.should_notify`).
+"""
+import time
+from collections import OrderedDict
+
+from typing import Callable, Dict
+
+
+# Cost of each command, in tokens. Commands not listed cost `DEFAULT_COST`.
+DEFAULT_COSTS = {'give': 1, 'leaderboard': 5, 'fullboard': 10, 'stats': 10}
+DEFAULT_COST = 1
+
+
+class TokenBucket():
+    """Tokens of one user or channel.
+
+    The bucket is refilled lazily, from the time elapsed since it was
+    last updated, when a command is checked against it.
+    """
+
+    __slots__ = ('tokens', 'updated', 'notified')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        # Whether the owner was told that a command was rejected.
+        self.notified = False
+
+    def refill(self, now: float, rate: float, burst: float) -> float:
+        """Add the tokens earned since the last update and return the total."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+
+class AdmissionControl():
+    """Token buckets per user and per channel for one workspace.
+
+    Parameters
+    ----------
+    user_rate
+        Tokens per second earned by each user
+    user_burst
+        Maximum tokens held by each user
+    channel_rate
+        Tokens per second earned by each channel
+    channel_burst
+        Maximum tokens held by each channel
+    costs
+        Dictionary of command : cost, merged over `DEFAULT_COSTS`
+    max_buckets
+        Maximum number of user buckets, and of channel buckets of each
+        kind, kept
+    clock
+        Function returning the current time in seconds
+    """
+
+    def __init__(self, user_rate: float = 0.2, user_burst: float = 10,
+                 channel_rate: float = 1, channel_burst: float = 30,
+                 costs: Dict[str, float] = None, max_buckets: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.user_rate = float(user_rate)
+        self.user_burst = float(user_burst)
+        self.channel_rate = float(channel_rate)
+        self.channel_burst = float(channel_burst)
+        self.costs = dict(DEFAULT_COSTS)
+        self.costs.update(costs or {})
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.admitted = 0
+        self.rejected = 0
+        self._users = OrderedDict()  # user_id : TokenBucket
+        self._channels = OrderedDict()  # channel : TokenBucket
+        self._board_channels = OrderedDict()  # channel : TokenBucket of boards
+
+    def _bucket(self, buckets: OrderedDict, key: str, burst: float, now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(burst, now)
+            if len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def cost(self, command: str) -> float:
+        """Return the number of tokens taken by `command`."""
+        return self.costs.get(command, DEFAULT_COST)
+
+    def admit(self, user_id: str, channel: str, command: str, board: bool = False) -> bool:
+        """Return True and take the tokens if `user_id` may run `command` in `channel`.
+
+        A `board` command is charged to the channel's board bucket.
+        """
+        now = self.clock()
+        cost = self.cost(command)
+        user = self._bucket(self._users, user_id, self.user_burst, now)
+        channel = self._bucket(self._board_channels if board else self._channels,
+                               channel, self.channel_burst, now)
+        if (user.refill(now, self.user_rate, self.user_burst) < cost or
+                channel.refill(now, self.channel_rate, self.channel_burst) < cost):
+            self.rejected += 1
+            return False
+        user.tokens -= cost
+        channel.tokens -= cost
+        user.notified = False
+        self.admitted += 1
+        return True
+
+    def should_notify(self, user_id: str) -> bool:
+        """Return True the first time `user_id` is rejected since their last admitted command."""
+        bucket = self._users.get(user_id)
+        if bucket is None or bucket.notified:
+            return False
+        bucket.notified = True
+        return True
+
+    def __len__(self):
+        return len(self._users) + len(self._channels) + len(self._board_channels)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+This module computes the statistics shown by the ``stats`` command.
+
+The daily records returned by `Storage.get_daily_history` are loaded
+once into columnar NumPy arrays (`History`): points received and points
+given as ``users x days`` matrices, and the giver -> receiver pairs as
+parallel index arrays. Every statistic is then a vectorised operation
+over these arrays.
+
+The history only covers past days, so a loaded `History` stays valid
+until the day rolls over; `get_history` caches one per storage and
+reloads it on the first call of a new day.
+
+NumPy is required by this module only, so it is imported by
+`hey_fireball` when the ``stats`` command is used.
+"""
+import datetime
+import weakref
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class History():
+    """Daily history of a workspace as columnar arrays.
+
+    Attributes
+    ----------
+    users : list
+        User ids; row ``i`` of every matrix belongs to ``users[i]``
+    start : datetime.date
+        Date of column 0
+    received : numpy.ndarray
+        ``users x days`` points received per day
+    given : numpy.ndarray
+        ``users x days`` points given per day
+    pair_giver, pair_target, pair_day, pair_points : numpy.ndarray
+        One entry per (giver, target, day) with the points given
+    """
+
+    def __init__(self, records: List[Tuple[str, str, int, int, Dict[str, int]]],
+                 start: datetime.date, days: int):
+        self.start = start
+        users = {record[1] for record in records}
+        for record in records:
+            users.update(record[4])
+        self.users = sorted(users)
+        index = {user_id: i for i, user_id in enumerate(self.users)}
+        start_ordinal = start.toordinal()
+
+        # Single pass to build the columns, everything else is vectorised.
+        rows, cols, received, given = [], [], [], []
+        pair_giver, pair_target, pair_day, pair_points = [], [], [], []
+        for date, user_id, points_received, points_used, given_to in records:
+            day = datetime.date(int(date[:4]), int(date[5:7]), int(date[8:10])).toordinal() - start_ordinal
+            if not 0 <= day < days:
+                continue
+            rows.append(index[user_id])
+            cols.append(day)
+            received.append(points_received)
+            given.append(points_used)
+            for target_id, points in given_to.items():
+                pair_giver.append(index[user_id])
+                pair_target.append(index[target_id])
+                pair_day.append(day)
+                pair_points.append(points)
+
+        shape = (len(self.users), days)
+        self.received = np.zeros(shape, dtype=np.int64)
+        self.given = np.zeros(shape, dtype=np.int64)
+        np.add.at(self.received, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)),
+                  np.array(received, dtype=np.int64))
+        np.add.at(self.given, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)),
+                  np.array(given, dtype=np.int64))
+        self.pair_giver = np.array(pair_giver, dtype=np.int64)
+        self.pair_target = np.array(pair_target, dtype=np.int64)
+        self.pair_day = np.array(pair_day, dtype=np.int64)
+        self.pair_points = np.array(pair_points, dtype=np.int64)
+
+    @property
+    def days(self) -> int:
+        return self.received.shape[1]
+
+
+_histories = weakref.WeakKeyDictionary()  # storage : (today, History)
+
+
+def get_history(storage, days: int = 365, today: datetime.date = None) -> History:
+    """Return the last `days` days of history of `storage`, cached until rollover."""
+    today = today or datetime.date.today()
+    cached = _histories.get(storage)
+    if cached is not None and cached[0] == today and cached[1].days == days:
+        return cached[1]
+    start = today - datetime.timedelta(days=days)
+    history = History(storage.get_daily_history(start), start, days)
+    _histories[storage] = (today, history)
+    return history
+
+
+def _top(values: np.ndarray, k: int) -> np.ndarray:
+    """Return the indices of the `k` largest positive `values`, largest first."""
+    k = min(k, int(np.count_nonzero(values > 0)))
+    if k == 0:
+        return np.array([], dtype=np.intp)
+    idx = np.argpartition(-values, k - 1)[:k]
+    return idx[np.argsort(-values[idx], kind='stable')]
+
+
+def shares(history: History, days: int = 90, k: int = 5) -> List[Tuple[str, int, float]]:
+    """Return the top `k` (user_id, points received, share of all points) over `days`."""
+    received = history.received[:, -days:].sum(axis=1)
+    total = received.sum()
+    return [(history.users[i], int(received[i]), float(received[i] / total))
+            for i in _top(received, k)]
+
+
+def trends(history: History, days: int = 30, k: int = 5,
+           giving: bool = False) -> List[Tuple[str, int, int]]:
+    """Return the top `k` (user_id, last `days`, previous `days`) by increase.
+
+    Points received are compared unless `giving` is True.
+    """
+    counts = history.given if giving else history.received
+    recent = counts[:, -days:].sum(axis=1)
+    previous = counts[:, -2 * days:-days].sum(axis=1)
+    return [(history.users[i], int(recent[i]), int(previous[i]))
+            for i in _top(recent - previous, k)]
+
+
+def longest_streaks(history: History, k: int = 5) -> List[Tuple[str, int]]:
+    """Return the top `k` (user_id, longest run of consecutive days giving points)."""
+    active = history.given > 0
+    # Running count of active days, restarted after every inactive day.
+    count = np.cumsum(active, axis=1)
+    restart = np.maximum.accumulate(np.where(active, 0, count), axis=1)
+    streaks = (count - restart).max(axis=1, initial=0)
+    return [(history.users[i], int(streaks[i])) for i in _top(streaks, k)]
+
+
+def top_pairs(history: History, days: int = 90, k: int = 5) -> List[Tuple[str, str, int]]:
+    """Return the top `k` (giver_id, target_id, points) over the last `days`."""
+    recent = history.pair_day >= history.days - days
+    keys = history.pair_giver[recent] * len(history.users) + history.pair_target[recent]
+    pairs, inverse = np.unique(keys, return_inverse=True)
+    points = np.bincount(inverse, weights=history.pair_points[recent]).astype(np.int64)
+    return [(history.users[pairs[i] // len(history.users)],
+             history.users[pairs[i] % len(history.users)], int(points[i]))
+            for i in _top(points, k)]
+
+
+def generate_stats(tenant) -> List[Dict[str, str]]:
+    """Return the ``stats`` attachments for `tenant`."""
+    history = get_history(tenant.storage)
+
+    def name(user_id):
+        return tenant.user_name_lookup.get(user_id[2:-1], user_id)
+
+    points = tenant.points
+    sections = [
+        ('Share of points received (90 days)',
+         [f'{name(u)}: {n} {points} ({share:.0%})' for u, n, share in shares(history)]),
+        ('Trending receivers (last 30 days vs the 30 before)',
+         [f'{name(u)}: {recent} vs {previous}' for u, recent, previous in trends(history)]),
+        ('Trending givers (last 30 days vs the 30 before)',
+         [f'{name(u)}: {recent} vs {previous}' for u, recent, previous in trends(history, giving=True)]),
+        ('Longest giving streaks',
+         [f'{name(u)}: {n} days' for u, n in longest_streaks(history)]),
+        ('Top pairs (90 days)',
+         [f'{name(giver)} → {name(target)}: {n} {points}' for giver, target, n in top_pairs(history)]),
+    ]
+    return [{'title': title, 'text': '\n'.join(lines) or 'No data yet.', 'color': '#f4ac00'}
+            for title, lines in sections]
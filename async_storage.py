@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+This module holds the asynchronous counterpart of the `Storage` API.
+
+`AsyncStorage` has the methods of `storage.Storage` as coroutines, so
+that a caller can issue independent storage requests concurrently
+(``asyncio.gather``) instead of one after the other.
+
+Implementations:
+
+- `AsyncStorageAdapter` runs any `Storage` in a thread pool.
+- `AsyncAzureTableStorage` sends the requests of `AzureTableStorage`
+  from a pool of threads sharing one keep-alive connection pool, and
+  overlaps the requests that do not depend on each other: the channel
+  index updates of a give and the queries of the daily history. The
+  Azure SDK used here only has a blocking client, so concurrency comes
+  from the threads rather than from an async HTTP client.
+
+Boards are not sped up here: every board reads its scores with a single
+query (e.g. `Storage.get_users_and_scores_total`), so there are no
+per-user lookups to run in parallel, and no caller for a batch of them.
+
+`SyncStorage` goes the other way: it runs an `AsyncStorage` on a
+background event loop and exposes the blocking `Storage` API, so the
+rest of the bot keeps calling storage as before.
+"""
+import asyncio
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Callable, Dict, List, Tuple
+
+# Same package imports
+from storage import Storage, AzureTableStorage
+
+
+#####################
+# API
+#####################
+
+
+class AsyncStorage():
+    """Coroutine version of `storage.Storage`.
+
+    Every method has the arguments and result of the `Storage` method
+    with the same name.
+    """
+    ### Listeners
+    def add_listener(self, listener):
+        """Tell `listener` about every change of points, see `Storage.add_listener`."""
+        pass
+
+    ### Daily reset
+    def set_user_offsets(self, offsets: Dict[str, int]):
+        """Set the UTC offset of users, see `Storage.set_user_offsets`."""
+        pass
+
+    async def rollover(self, now: int = None) -> int:
+        pass
+
+    ### Currencies
+    def set_default_currency(self, name: str):
+        """Set the currency of points given without counts, see `Storage.set_default_currency`."""
+        pass
+
+    async def get_user_currencies_used(self, user_id: str) -> Dict[str, int]:
+        pass
+
+    async def get_currency_leaders(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        pass
+
+    ### Diagnostics
+    def sizes(self) -> Dict[str, int]:
+        """Return the sizes of the structures held in memory, see `Storage.sizes`."""
+        return dict()
+
+    ### Points used
+    async def get_user_points_used_total(self, user_id: str) -> int:
+        pass
+
+    async def get_user_points_used(self, user_id: str) -> int:
+        pass
+
+    async def add_user_points_used(self, user_id: str, num: int,
+                                   currencies: Dict[str, int] = None):
+        pass
+
+    ### Points received
+    async def get_user_points_received_total(self, user_id: str) -> int:
+        pass
+
+    async def get_user_points_received(self, user_id: str) -> int:
+        pass
+
+    async def add_user_points_received(self, user_id: str, num: int,
+                                       currencies: Dict[str, int] = None) -> int:
+        pass
+
+    async def get_users_and_scores_total(self) -> List[Tuple[str, int]]:
+        pass
+
+    ### Gives
+    async def give_points(self, requestor_id: str, targets: Dict[str, int],
+                          channel_id: str = None,
+                          currencies: Dict[str, int] = None) -> Dict[str, int]:
+        pass
+
+    ### Channels
+    async def add_channel_points_received(self, channel_id: str, user_id: str, num: int):
+        pass
+
+    async def get_channel_users_and_scores(self, channel_id: str,
+                                           this_month: bool = False) -> List[Tuple[str, int]]:
+        pass
+
+    ### Recent scores
+    async def get_recent_leaders(self, k: int) -> List[Tuple[str, float]]:
+        pass
+
+    ### Gives graph
+    async def add_given_to(self, requestor_id: str, targets: Dict[str, int]):
+        pass
+
+    async def get_fans(self, user_id: str, k: int, this_month: bool = False) -> List[Tuple[str, int]]:
+        pass
+
+    async def get_top_pairs(self, k: int, this_month: bool = False) -> List[Tuple[str, str, int]]:
+        pass
+
+    ### History
+    async def get_daily_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        pass
+
+    async def compact_history(self, before: datetime.date) -> int:
+        return 0
+
+    ### PM Preferences
+    async def get_pm_preference(self, user_id: str) -> int:
+        pass
+
+    async def set_pm_preference(self, user_id: str, pref: int):
+        pass
+
+
+#####################
+# Implementations
+#####################
+
+
+class AsyncStorageAdapter(AsyncStorage):
+    """`AsyncStorage` running the methods of a `Storage` in a thread pool.
+
+    The methods of `storage` run on several threads at once, so it must
+    be thread safe: `AzureTableStorage` guards its caches with a lock,
+    `InMemoryStorage` needs a `pool_size` of 1.
+
+    Parameters
+    ----------
+    storage
+        Blocking storage to run
+    pool_size
+        Maximum number of calls running at the same time
+    """
+
+    def __init__(self, storage: Storage, pool_size: int = 8):
+        self.storage = storage
+        self.pool_size = pool_size
+        self._executor = ThreadPoolExecutor(max_workers=pool_size,
+                                            thread_name_prefix='storage')
+
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def add_listener(self, listener):
+        self.storage.add_listener(listener)
+
+    def set_user_offsets(self, offsets: Dict[str, int]):
+        self.storage.set_user_offsets(offsets)
+
+    async def rollover(self, now: int = None) -> int:
+        if not self.storage.resets.is_due(now):
+            # Checked here so that the loop does not wait for a thread.
+            return 0
+        return await self._run(self.storage.rollover, now)
+
+    def set_default_currency(self, name: str):
+        self.storage.set_default_currency(name)
+
+    async def get_user_currencies_used(self, user_id: str) -> Dict[str, int]:
+        return await self._run(self.storage.get_user_currencies_used, user_id)
+
+    async def get_currency_leaders(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        return await self._run(self.storage.get_currency_leaders, currency, k)
+
+    def sizes(self) -> Dict[str, int]:
+        return self.storage.sizes()
+
+    async def get_user_points_used_total(self, user_id: str) -> int:
+        return await self._run(self.storage.get_user_points_used_total, user_id)
+
+    async def get_user_points_used(self, user_id: str) -> int:
+        return await self._run(self.storage.get_user_points_used, user_id)
+
+    async def add_user_points_used(self, user_id: str, num: int,
+                                   currencies: Dict[str, int] = None):
+        await self._run(self.storage.add_user_points_used, user_id, num, currencies)
+
+    async def get_user_points_received_total(self, user_id: str) -> int:
+        return await self._run(self.storage.get_user_points_received_total, user_id)
+
+    async def get_user_points_received(self, user_id: str) -> int:
+        return await self._run(self.storage.get_user_points_received, user_id)
+
+    async def add_user_points_received(self, user_id: str, num: int,
+                                       currencies: Dict[str, int] = None) -> int:
+        return await self._run(self.storage.add_user_points_received, user_id, num, currencies)
+
+    async def get_users_and_scores_total(self) -> List[Tuple[str, int]]:
+        return await self._run(self.storage.get_users_and_scores_total)
+
+    async def give_points(self, requestor_id: str, targets: Dict[str, int],
+                          channel_id: str = None,
+                          currencies: Dict[str, int] = None) -> Dict[str, int]:
+        return await self._run(self.storage.give_points, requestor_id, targets, channel_id,
+                               currencies)
+
+    async def add_channel_points_received(self, channel_id: str, user_id: str, num: int):
+        await self._run(self.storage.add_channel_points_received, channel_id, user_id, num)
+
+    async def get_channel_users_and_scores(self, channel_id: str,
+                                           this_month: bool = False) -> List[Tuple[str, int]]:
+        return await self._run(self.storage.get_channel_users_and_scores, channel_id, this_month)
+
+    async def get_recent_leaders(self, k: int) -> List[Tuple[str, float]]:
+        return await self._run(self.storage.get_recent_leaders, k)
+
+    async def add_given_to(self, requestor_id: str, targets: Dict[str, int]):
+        await self._run(self.storage.add_given_to, requestor_id, targets)
+
+    async def get_fans(self, user_id: str, k: int, this_month: bool = False) -> List[Tuple[str, int]]:
+        return await self._run(self.storage.get_fans, user_id, k, this_month)
+
+    async def get_top_pairs(self, k: int, this_month: bool = False) -> List[Tuple[str, str, int]]:
+        return await self._run(self.storage.get_top_pairs, k, this_month)
+
+    async def get_daily_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        return await self._run(self.storage.get_daily_history, start)
+
+    async def compact_history(self, before: datetime.date) -> int:
+        return await self._run(self.storage.compact_history, before)
+
+    async def get_pm_preference(self, user_id: str) -> int:
+        return await self._run(self.storage.get_pm_preference, user_id)
+
+    async def set_pm_preference(self, user_id: str, pref: int):
+        await self._run(self.storage.set_pm_preference, user_id, pref)
+
+
+class AsyncAzureTableStorage(AsyncStorageAdapter):
+    """`AsyncStorage` for Azure Table Service.
+
+    Requests are sent from `pool_size` threads sharing the keep-alive
+    connections of `request_session`, which should allow as many
+    connections per host (see `tenant.get_http_session`).
+
+    Parameters
+    ----------
+    table_name
+        Name of the table, defaults to the TABLE_NAME env var
+    request_session
+        ``requests.Session`` holding the connection pool
+    pool_size
+        Maximum number of requests in flight
+    recent_half_life
+        See `AzureTableStorage`
+    """
+
+    def __init__(self, table_name: str = None, request_session=None, pool_size: int = 8,
+                 **kwargs):
+        super().__init__(AzureTableStorage(table_name=table_name,
+                                           request_session=request_session, **kwargs),
+                         pool_size)
+
+    async def give_points(self, requestor_id: str, targets: Dict[str, int],
+                          channel_id: str = None,
+                          currencies: Dict[str, int] = None) -> Dict[str, int]:
+        """Apply the give in one transaction, then update the channel index concurrently.
+
+        The channel partitions are outside of the give's transaction, and
+        each (target, period) entity is read and written independently.
+        """
+        new_totals = await self._run(self.storage.give_points, requestor_id, targets, None,
+                                     currencies)
+        if channel_id is not None:
+            await asyncio.gather(*(self.add_channel_points_received(channel_id, target_id, num)
+                                   for target_id, num in targets.items()))
+        return new_totals
+
+    async def get_daily_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Run the queries of the rollups, date partitions and Total partition concurrently."""
+        rolled_up, archived, pending = await asyncio.gather(
+            self._run(self.storage._get_rolled_up_history, start),
+            self._run(self.storage._get_archived_history, start),
+            self._run(self.storage._get_pending_history, start))
+        return self.storage._merge_history(rolled_up, archived, pending)
+
+
+#####################
+# Sync adapter
+#####################
+
+
+class SyncStorage(Storage):
+    """Blocking `Storage` running an `AsyncStorage` on a background event loop.
+
+    Parameters
+    ----------
+    async_storage
+        Storage to run. Its concurrency is used within each call, e.g.
+        the channel updates of a give.
+    """
+
+    def __init__(self, async_storage: AsyncStorage):
+        super().__init__()
+        self.async_storage = async_storage
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _wait(self, coroutine):
+        """Run `coroutine` on the background loop and return its result."""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='storage-loop',
+                                     daemon=True).start()
+                    self._loop = loop
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def add_listener(self, listener):
+        self.async_storage.add_listener(listener)
+
+    def set_user_offsets(self, offsets: Dict[str, int]):
+        self.async_storage.set_user_offsets(offsets)
+
+    def rollover(self, now: int = None) -> int:
+        return self._wait(self.async_storage.rollover(now))
+
+    def set_default_currency(self, name: str):
+        self.async_storage.set_default_currency(name)
+
+    def get_user_currencies_used(self, user_id: str) -> Dict[str, int]:
+        return self._wait(self.async_storage.get_user_currencies_used(user_id))
+
+    def get_currency_leaders(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        return self._wait(self.async_storage.get_currency_leaders(currency, k))
+
+    def sizes(self) -> Dict[str, int]:
+        return self.async_storage.sizes()
+
+    def get_user_points_used_total(self, user_id: str) -> int:
+        return self._wait(self.async_storage.get_user_points_used_total(user_id))
+
+    def get_user_points_used(self, user_id: str) -> int:
+        return self._wait(self.async_storage.get_user_points_used(user_id))
+
+    def add_user_points_used(self, user_id: str, num: int, currencies: Dict[str, int] = None):
+        self._wait(self.async_storage.add_user_points_used(user_id, num, currencies))
+
+    def get_user_points_received_total(self, user_id: str) -> int:
+        return self._wait(self.async_storage.get_user_points_received_total(user_id))
+
+    def get_user_points_received(self, user_id: str) -> int:
+        return self._wait(self.async_storage.get_user_points_received(user_id))
+
+    def add_user_points_received(self, user_id: str, num: int,
+                                 currencies: Dict[str, int] = None) -> int:
+        return self._wait(self.async_storage.add_user_points_received(user_id, num, currencies))
+
+    def get_users_and_scores_total(self) -> List[Tuple[str, int]]:
+        return self._wait(self.async_storage.get_users_and_scores_total())
+
+    def give_points(self, requestor_id: str, targets: Dict[str, int],
+                    channel_id: str = None, currencies: Dict[str, int] = None) -> Dict[str, int]:
+        return self._wait(self.async_storage.give_points(requestor_id, targets, channel_id,
+                                                         currencies))
+
+    def add_channel_points_received(self, channel_id: str, user_id: str, num: int):
+        self._wait(self.async_storage.add_channel_points_received(channel_id, user_id, num))
+
+    def get_channel_users_and_scores(self, channel_id: str,
+                                     this_month: bool = False) -> List[Tuple[str, int]]:
+        return self._wait(self.async_storage.get_channel_users_and_scores(channel_id, this_month))
+
+    def get_recent_leaders(self, k: int) -> List[Tuple[str, float]]:
+        return self._wait(self.async_storage.get_recent_leaders(k))
+
+    def add_given_to(self, requestor_id: str, targets: Dict[str, int]):
+        self._wait(self.async_storage.add_given_to(requestor_id, targets))
+
+    def get_fans(self, user_id: str, k: int, this_month: bool = False) -> List[Tuple[str, int]]:
+        return self._wait(self.async_storage.get_fans(user_id, k, this_month))
+
+    def get_top_pairs(self, k: int, this_month: bool = False) -> List[Tuple[str, str, int]]:
+        return self._wait(self.async_storage.get_top_pairs(k, this_month))
+
+    def get_daily_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        return self._wait(self.async_storage.get_daily_history(start))
+
+    def compact_history(self, before: datetime.date) -> int:
+        return self._wait(self.async_storage.compact_history(before))
+
+    def get_pm_preference(self, user_id: str) -> int:
+        return self._wait(self.async_storage.get_pm_preference(user_id))
+
+    def set_pm_preference(self, user_id: str, pref: int):
+        self._wait(self.async_storage.set_pm_preference(user_id, pref))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Analytics benchmark.
+
+Builds a synthetic year of daily history for a few thousand users, loads
+it into an `analytics.History` once and times each statistic of the
+``stats`` command over it.
+
+Usage: python bench_analytics.py [users] [days]
+"""
+import datetime
+import random
+import sys
+import time
+
+import analytics
+
+
+def synthetic_history(users: int, days: int, today: datetime.date):
+    """Return daily records where about 1 user in 5 is active on a day."""
+    random.seed(0)
+    user_ids = [f'<@U{i:06d}>' for i in range(users)]
+    records = []
+    for n in range(1, days + 1):
+        date = (today - datetime.timedelta(days=n)).strftime('%Y-%m-%d')
+        received = dict()
+        for giver in random.sample(user_ids, users // 5):
+            given_to = {random.choice(user_ids): random.randint(1, 3) for _ in range(2)}
+            for target, points in given_to.items():
+                received[target] = received.get(target, 0) + points
+            records.append((date, giver, 0, sum(given_to.values()), given_to))
+        records.extend((date, target, points, 0, {}) for target, points in received.items())
+    return records
+
+
+def timed(label: str, fn, repeat: int = 20):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    print(f'{label:>16}: {(time.perf_counter() - start) / repeat * 1000:8.2f} ms')
+
+
+def main(users: int, days: int):
+    today = datetime.date.today()
+    records = synthetic_history(users, days, today)
+    print(f'{users} users x {days} days, {len(records)} daily records')
+    start = time.perf_counter()
+    history = analytics.History(records, today - datetime.timedelta(days=days), days)
+    print(f'{"load (once)":>16}: {(time.perf_counter() - start) * 1000:8.2f} ms')
+    timed('shares', lambda: analytics.shares(history))
+    timed('trends', lambda: analytics.trends(history))
+    timed('longest_streaks', lambda: analytics.longest_streaks(history))
+    timed('top_pairs', lambda: analytics.top_pairs(history))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 365)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Parse and dispatch benchmark.
+
+Measures, in nanoseconds per message:
+
+- parse: `hey_fireball.extract_fireball_info`, i.e. tokenizing the
+  message and recognising its targets, command and count (best of 5
+  rounds)
+- dispatch: `hey_fireball.handle_command` on the parsed messages,
+  including the in-memory storage and board cache
+
+Slack is replaced by a client that does nothing and admission control
+is opened wide, so the numbers measure the bot itself.
+
+Usage: python bench_dispatch.py [messages]
+"""
+import sys
+import time
+
+import hey_fireball
+
+
+class NullSlackClient():
+    """Slack client dropping every call."""
+
+    def api_call(self, method, **kwargs):
+        return {'ok': True}
+
+
+MESSAGES = ['<@UB> :fireball: :fireball:',
+            '<@UBOT> <@UB> <@UC> 1',
+            '<@UBOT> shotsleft',
+            '<@UBOT> shots',
+            '<@UBOT> <@UC> shots',
+            '<@UBOT> leaderboard',
+            '<@UBOT> leaderboard <#C2|eng> all',
+            '<@UBOT> fullboard',
+            'lunch anyone? :fireball:']
+
+
+def main(n: int):
+    app = hey_fireball.App([{'name': 'bench', 'slack_token': None, 'bot_id': 'UBOT',
+                             'emoji': ':fireball:', 'points': 'shots',
+                             'max_points_per_day': 10 ** 9, 'notification_window': 0,
+                             'admission': {'user_burst': 1e18, 'channel_burst': 1e18}}],
+                           num_shards=1)
+    tenant = app.tenants[0]
+    tenant.slack_client = NullSlackClient()
+    tenant.user_name_lookup = {'UA': 'kyle', 'UB': 'matt', 'UC': 'ann'}
+    msgs = [{'type': 'message', 'user': 'UA', 'channel': 'C1', 'ts': '1.0', 'text': text}
+            for text in MESSAGES]
+    msgs = (msgs * (n // len(msgs) + 1))[:n]
+
+    parse_ns = None
+    for _ in range(5):
+        start = time.perf_counter_ns()
+        for msg in msgs:
+            hey_fireball.extract_fireball_info(msg, tenant)
+        elapsed = (time.perf_counter_ns() - start) / n
+        parse_ns = elapsed if parse_ns is None else min(parse_ns, elapsed)
+
+    parsed = [hey_fireball.extract_fireball_info(msg, tenant) for msg in msgs]
+
+    valid = [fireball_message for fireball_message in parsed if fireball_message.valid]
+    start = time.perf_counter_ns()
+    for fireball_message in valid:
+        hey_fireball.handle_command(fireball_message)
+    dispatch_ns = (time.perf_counter_ns() - start) / len(valid)
+
+    print(f'{n} messages ({len(valid)} commands)')
+    print(f'{"parse":>9}: {parse_ns:9.0f} ns/message')
+    print(f'{"dispatch":>9}: {dispatch_ns:9.0f} ns/message')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Event router benchmark.
+
+Replays a synthetic RTM firehose, mostly reactions with other emoji,
+typing and presence events, with a few messages for the bot and
+reactions with the bot's emoji. Measures:
+
+- route: nanoseconds per event of `hey_fireball.bot_message`, which
+  drops irrelevant events on their type (best of 5 rounds)
+- step: events per minute handled by `App.step`, including executing
+  the gives and commands of the relevant events
+
+Slack is replaced by a client handing out the events and dropping every
+call, admission control is opened wide and storage is in memory.
+
+Usage: python bench_router.py [events]
+"""
+import random
+import sys
+import time
+
+import hey_fireball
+
+
+USERS = 200
+
+
+class FirehoseSlackClient():
+    """Slack client handing out queued events and dropping every call."""
+
+    def __init__(self, events, batch: int = 500):
+        self.events = events
+        self.batch = batch
+        self._next = 0
+
+    def rtm_read(self):
+        events = self.events[self._next:self._next + self.batch]
+        self._next += self.batch
+        return events
+
+    def api_call(self, method, **kwargs):
+        return {'ok': True}
+
+
+def firehose(rng: random.Random, n: int) -> list:
+    """Return `n` synthetic RTM events."""
+    events = []
+    for i in range(n):
+        user = f'U{rng.randrange(USERS)}'
+        author = f'U{rng.randrange(USERS)}'
+        item = {'type': 'message', 'channel': f'C{rng.randrange(20)}', 'ts': f'{i}.0'}
+        roll = rng.random()
+        if roll < 0.05:
+            events.append({'type': 'reaction_added', 'user': user, 'reaction': 'fireball',
+                           'item_user': author, 'item': item, 'event_ts': f'{i}.1'})
+        elif roll < 0.45:
+            events.append({'type': 'reaction_added', 'user': user,
+                           'reaction': rng.choice(['thumbsup', 'eyes', 'tada', 'joy']),
+                           'item_user': author, 'item': item, 'event_ts': f'{i}.1'})
+        elif roll < 0.65:
+            events.append({'type': 'user_typing', 'user': user, 'channel': item['channel']})
+        elif roll < 0.80:
+            events.append({'type': 'presence_change', 'user': user, 'presence': 'away'})
+        elif roll < 0.81:
+            events.append({'type': 'message', 'user': user, 'channel': item['channel'],
+                           'ts': f'{i}.0', 'text': f'<@{author}> :fireball:'})
+        elif roll < 0.95:
+            events.append({'type': 'message', 'user': user, 'channel': item['channel'],
+                           'ts': f'{i}.0', 'text': 'lunch anyone? the usual place at noon'})
+        else:
+            events.append({'type': 'reaction_removed', 'user': user, 'reaction': 'eyes',
+                           'item_user': author, 'item': item})
+    return events
+
+
+def main(n: int):
+    app = hey_fireball.App([{'name': 'bench', 'slack_token': None, 'bot_id': 'UBOT',
+                             'emoji': ':fireball:', 'points': 'shots',
+                             'max_points_per_day': 10 ** 9, 'notification_window': 0,
+                             'admission': {'user_burst': 1e18, 'channel_burst': 1e18}}],
+                           num_shards=1)
+    tenant = app.tenants[0]
+    tenant.user_name_lookup = {f'U{i}': f'user{i}' for i in range(USERS)}
+    events = firehose(random.Random(0), n)
+
+    route_ns = None
+    for _ in range(5):
+        start = time.perf_counter_ns()
+        for output in events:
+            hey_fireball.bot_message(tenant, output)
+        elapsed = (time.perf_counter_ns() - start) / n
+        route_ns = elapsed if route_ns is None else min(route_ns, elapsed)
+    relevant = sum(hey_fireball.bot_message(tenant, output) is not None for output in events)
+
+    tenant.slack_client = FirehoseSlackClient(events)
+    start = time.perf_counter()
+    while tenant.slack_client._next < n or app.scheduler:
+        app.step([tenant])
+    elapsed = time.perf_counter() - start
+
+    print(f'{n} events ({relevant} for the bot)')
+    print(f'{"route":>6}: {route_ns:9.0f} ns/event')
+    print(f'{"step":>6}: {n / elapsed * 60:9.0f} events/minute')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
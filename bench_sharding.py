@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Sharding throughput benchmark.
+
+Submits synthetic gives between a few hundred users to a
+`sharding.ShardRouter` and measures the gives per second fully handled
+(debited on the requestor's shard and credited on the target's) for 1,
+2, 4, ... shards. Gives cross shards as often as the user hash makes
+them, so with N shards most credits are forwarded between workers.
+
+The shards are worker processes, so the throughput grows with the
+number of shards only up to the number of cores; the number of cores is
+printed with the results.
+
+Slack is replaced by a client listing the users and dropping every
+call, admission control is opened wide, there is no daily limit and
+storage is in memory.
+
+Usage: python bench_sharding.py [gives] [max shards]
+"""
+import multiprocessing
+import random
+import sys
+import time
+
+import sharding
+from tenant import Tenant
+
+
+USERS = 500
+
+
+class DirectorySlackClient():
+    """Slack client listing `USERS` users and dropping every call."""
+
+    def api_call(self, method, **kwargs):
+        return {'ok': True, 'members': [{'id': f'U{i}', 'name': f'user{i}'}
+                                        for i in range(USERS)]}
+
+
+def make_tenants() -> list:
+    tenant = Tenant('bench', None, 'UBOT', ':fireball:', 'shots',
+                    max_points_per_day=10 ** 9, notification_window=0,
+                    admission={'user_burst': 1e18, 'channel_burst': 1e18})
+    tenant.slack_client = DirectorySlackClient()
+    return [tenant]
+
+
+def gives(rng: random.Random, n: int) -> list:
+    """Return `n` synthetic give messages."""
+    events = []
+    for i in range(n):
+        uid = rng.randrange(USERS)
+        target = (uid + rng.randrange(1, USERS)) % USERS
+        events.append({'type': 'message', 'user': f'U{uid}', 'channel': f'C{uid % 20}',
+                       'ts': f'{i}.0', 'text': f'<@U{target}> :fireball:'})
+    return events
+
+
+def run(num_shards: int, events: list) -> float:
+    """Return the gives per second handled by `num_shards` shards."""
+    router = sharding.ShardRouter(make_tenants(), num_shards, make_tenants)
+    router.start()
+    try:
+        # Warm up: every worker loads the user directory on its first message.
+        for shard in range(num_shards):
+            router.call(shard, ('call', 'bench', 'get_user_points_used', ('<@U0>',)))
+        start = time.perf_counter()
+        for event in events:
+            router.submit('bench', event)
+        # Every give ends with a notice of the credit from the target's shard.
+        credited = 0
+        while credited < len(events):
+            if router.results.get()[0] == 'given':
+                credited += 1
+        return len(events) / (time.perf_counter() - start)
+    finally:
+        router.stop()
+
+
+def main(n: int, max_shards: int):
+    events = gives(random.Random(0), n)
+    print(f'{n} gives, {USERS} users, {multiprocessing.cpu_count()} cores')
+    num_shards = 1
+    while num_shards <= max_shards:
+        print(f'{num_shards:3d} shards: {run(num_shards, events):9.0f} gives/s')
+        num_shards *= 2
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 4)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Soak benchmark.
+
+Replays over a year of synthetic traffic (gives, boards, scores and
+chatter from a few hundred users in a few dozen channels) through
+`App.step`, advancing the clock of the daily rollover and of the digests
+by a day between days, and asserts that memory stays flat once the
+bounded structures have filled up.
+
+The storage is the default in-memory one, whose history, and the gives
+graph with it, is kept for `history_days` days. The warm-up lasts that
+long plus `WARMUP_MARGIN` days, so every structure reaches its steady
+size within it. After the warm-up:
+
+- no size gauge (see `diagnostics`) may exceed its warm-up peak by more
+  than `TOLERANCE`; the gauges count entries, so this check does not
+  depend on the allocator,
+- RSS may grow by at most `TOLERANCE` (or 2 MB, whichever is larger).
+
+The gauges are printed at the end of the warm-up and of the run.
+
+Slack is replaced by a client that does nothing and admission control
+is opened wide, so every message reaches the bot.
+
+Usage: python bench_soak.py [days after the warm-up] [messages per day]
+"""
+import gc
+import random
+import sys
+
+import hey_fireball
+import reset
+from diagnostics import rss
+
+
+USERS = 500
+CHANNELS = 40
+HOME_CHANNELS = 3  # channels each user posts in
+TEAM = 50  # users each user gives to
+WARMUP_MARGIN = 31
+TOLERANCE = 0.05
+
+
+class SoakSlackClient():
+    """Slack client handing out queued events and dropping every call."""
+
+    def __init__(self):
+        self.events = []
+
+    def rtm_read(self):
+        events, self.events = self.events[:200], self.events[200:]
+        return events
+
+    def api_call(self, method, **kwargs):
+        return {'ok': True}
+
+
+def day_of_traffic(rng: random.Random, n: int, ts: int) -> list:
+    """Return `n` synthetic events sent to the bot."""
+    events = []
+    for i in range(n):
+        uid = rng.randrange(USERS)
+        user = f'U{uid}'
+        channel = f'C{(uid * CHANNELS // USERS + rng.randrange(HOME_CHANNELS)) % CHANNELS}'
+        target = f'U{(uid + rng.randrange(1, TEAM)) % USERS}'
+        roll = rng.random()
+        if roll < 0.6:
+            text = f'<@{target}> ' + ':fireball: ' * rng.randint(1, 3)
+        elif roll < 0.7:
+            text = f'<@UBOT> <@{target}> shots'
+        elif roll < 0.8:
+            text = '<@UBOT> shotsleft'
+        elif roll < 0.9:
+            text = f'<@UBOT> leaderboard <#C{rng.randrange(CHANNELS)}|chan>'
+        elif roll < 0.95:
+            text = rng.choice(['<@UBOT> leaderboard', '<@UBOT> leaderboard recent',
+                               '<@UBOT> fullboard'])
+        else:
+            text = 'lunch anyone? :fireball:'
+        events.append({'type': 'message', 'user': user, 'channel': channel,
+                       'ts': f'{ts + i}.0', 'text': text})
+    return events
+
+
+def main(days: int, per_day: int):
+    app = hey_fireball.App([{'name': 'soak', 'slack_token': None, 'bot_id': 'UBOT',
+                             'emoji': ':fireball:', 'points': 'shots',
+                             'notification_window': 0,
+                             'digest_channels': {'daily': ['C0'], 'weekly': ['C0']},
+                             'admission': {'user_burst': 1e18, 'channel_burst': 1e18}}],
+                           num_shards=1)
+    tenant = app.tenants[0]
+    tenant.slack_client = SoakSlackClient()
+    tenant.user_name_lookup = {f'U{i}': f'user{i}' for i in range(USERS)}
+    now = [reset.DAY * 20000]  # 2024-10-04, midnight UTC
+    tenant.storage.resets = reset.ResetSchedule(default_offset=0, clock=lambda: now[0])
+    tenant.storage.set_user_offsets({f'<@U{i}>': (i % 24 - 11) * 3600 for i in range(USERS)})
+    tenant.digests.today = lambda: tenant.storage.resets.today(now=now[0])
+    rng = random.Random(0)
+    warmup_days = tenant.storage.history_days + WARMUP_MARGIN
+
+    print(f'{warmup_days} + {days} days, {per_day} messages per day, '
+          f'{USERS} users, {CHANNELS} channels')
+    baseline = None
+    peaks = dict()  # gauge : highest value during the warm-up
+    for day in range(warmup_days + days):
+        tenant.slack_client.events = day_of_traffic(rng, per_day, now[0])
+        while tenant.slack_client.events or app.scheduler:
+            app.step([tenant])
+        now[0] += reset.DAY
+        # Rollover and digests.
+        app.step([tenant])
+        gc.collect()
+        size = rss()
+        gauges = app.diagnostics.sizes()
+        if day < warmup_days:
+            for name, value in gauges.items():
+                peaks[name] = max(peaks.get(name, 0), value)
+        else:
+            over = {name: value for name, value in gauges.items()
+                    if value > peaks.get(name, 0) * (1 + TOLERANCE)}
+            assert not over, f'day {day + 1}: gauges over their warm-up peak: {over}'
+        if (day + 1) % 10 == 0:
+            print(f'day {day + 1:3d}: RSS {size / 2 ** 20:7.1f} MB')
+        if day + 1 == warmup_days:
+            baseline = size
+            print(app.diagnostics.report(limit=0))
+    print(app.diagnostics.report(limit=0))
+    if baseline is not None and days:
+        growth = size - baseline
+        print(f'growth after warm-up: {growth / 2 ** 20:.1f} MB')
+        assert growth <= max(2 * 2 ** 20, TOLERANCE * baseline), 'RSS is not flat'
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 30,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark.
+
+Each run starts a fresh interpreter and measures:
+
+- import: time to ``import hey_fireball``
+- first message: time from the start of the process until the reply to
+  the first message is posted, including creating and connecting the
+  `App` and handling the message
+
+Slack is replaced by `LocalSlackClient`, which answers instantly, so the
+numbers measure the bot and not the network. Storage is in memory.
+
+Usage: python bench_startup.py [runs]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+class LocalSlackClient():
+    """Slack client answering from memory, with one message to read."""
+
+    def __init__(self, on_post):
+        self.on_post = on_post
+        self.events = [{'type': 'message', 'user': 'U2', 'channel': 'C1', 'ts': '1.0',
+                        'text': '<@UBOT> leaderboard'}]
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        events, self.events = self.events, []
+        return events
+
+    def api_call(self, method, **kwargs):
+        if method == 'users.list':
+            return {'ok': True, 'members': [{'id': 'U1', 'name': 'kyle'},
+                                            {'id': 'U2', 'name': 'matt'}]}
+        self.on_post()
+        return {'ok': True}
+
+
+def run_once() -> dict:
+    """Measure one cold start. Runs in the child interpreter."""
+    start = time.perf_counter()
+    import hey_fireball
+    imported = time.perf_counter()
+    posted = []
+    app = hey_fireball.App([{'name': 'bench', 'slack_token': None, 'bot_id': 'UBOT',
+                             'emoji': ':fireball:', 'points': 'shots'}], num_shards=1)
+    for tenant in app.tenants:
+        tenant.slack_client = LocalSlackClient(lambda: posted.append(time.perf_counter()))
+    connected = app.connect()
+    while not posted:
+        app.step(connected)
+    return {'import': imported - start, 'first_message': posted[0] - start}
+
+
+def main(runs: int):
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c',
+                              'import json, bench_startup; print(json.dumps(bench_startup.run_once()))'],
+                             cwd=here, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out))
+    for key in ('import', 'first_message'):
+        values = [r[key] * 1000 for r in results]
+        print(f'{key:>14}: median {statistics.median(values):7.2f} ms, '
+              f'min {min(values):7.2f} ms, max {max(values):7.2f} ms ({runs} runs)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
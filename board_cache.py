@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+This module caches the rendered leaderboards.
+
+Rendering a board reads every user's score from storage, sorts them and
+formats the attachments. When a thread starts, several people often
+ask for the same board within seconds, so `BoardCache` keeps the
+rendered attachments until a give changes what they show:
+
+- a ``leaderboard`` is dropped only when a give changes its top 10
+  (a listed user gains points or a new user can enter it),
+- a channel ``leaderboard`` is dropped by a give in that channel,
+- the ``fullboard`` lists everyone, the ``leaderboard recent`` ranks
+  decayed scores and a currency ``leaderboard`` ranks the emoji of one
+  currency: any give can change them, so any give drops them.
+
+Concurrent requests for a board that is not cached share a single
+computation (see `SingleFlight`).
+
+Boards of quiet channels and of past months are never dropped by a
+give, so at most ``max_boards`` boards are kept, least recently used
+first out.
+"""
+import threading
+from collections import OrderedDict
+
+from typing import Callable, Dict, Hashable, List, Tuple
+
+
+class SingleFlight():
+    """Run at most one computation per key at a time.
+
+    Callers asking for a key that is already being computed wait for
+    that computation and share its result instead of starting another.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()  # key : (Event, [result, exception])
+
+    def do(self, key: Hashable, fn: Callable):
+        """Return ``fn()``, sharing the call with concurrent callers of `key`."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = (threading.Event(), [None, None])
+        event, outcome = call
+        if leader:
+            try:
+                outcome[0] = fn()
+            except Exception as e:
+                outcome[1] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                event.set()
+        else:
+            event.wait()
+        if outcome[1] is not None:
+            raise outcome[1]
+        return outcome[0]
+
+
+class BoardCache():
+    """Cache of rendered leaderboards for one workspace.
+
+    Parameters
+    ----------
+    size
+        Number of users shown on the ``leaderboard``
+    max_boards
+        Maximum number of boards kept
+    """
+
+    LEADERBOARD = 'leaderboard'
+    FULLBOARD = 'fullboard'
+    RECENT = 'recent'
+    CURRENCY = 'currency'
+
+    def __init__(self, size: int = 10, max_boards: int = 256):
+        self.size = size
+        self.max_boards = max_boards
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._boards = OrderedDict()  # key : rendered attachments, in LRU order
+        # Incremented by every give so that a board rendered while a give
+        # was stored is not cached.
+        self._generation = 0
+        # Scores shown on the cached leaderboard, to decide if a give changes it.
+        self._top = None
+        self._flight = SingleFlight()
+
+    def get(self, key: Tuple, render: Callable[[], List[Dict[str, str]]]) -> List[Dict[str, str]]:
+        """Return the board cached under `key`, rendering it if needed.
+
+        Parameters
+        ----------
+        key
+            Tuple starting with ``LEADERBOARD``, ``FULLBOARD``, ``RECENT`` or ``CURRENCY``, followed
+            by the channel (or None) and anything else that changes the board
+        render
+            Function returning the board's attachments
+        """
+        with self._lock:
+            board = self._boards.get(key)
+            if board is not None:
+                self._boards.move_to_end(key)
+        if board is not None:
+            self.hits += 1
+            return board
+        self.misses += 1
+        return self._flight.do(key, lambda: self._render(key, render))
+
+    def _render(self, key: Tuple, render: Callable) -> List[Dict[str, str]]:
+        generation = self._generation
+        board = render()
+        with self._lock:
+            if generation == self._generation:
+                self._boards[key] = board
+                if len(self._boards) > self.max_boards:
+                    self._boards.popitem(last=False)
+        return board
+
+    def __len__(self):
+        return len(self._boards)
+
+    def set_top(self, users_and_scores: List[Tuple[str, int]]):
+        """Remember the scores shown on the workspace ``leaderboard``."""
+        with self._lock:
+            self._top = dict(users_and_scores)
+
+    def record_give(self, user_id: str, new_total: int, channel: str = None):
+        """Drop the boards changed by `user_id` reaching `new_total` points."""
+        with self._lock:
+            self._generation += 1
+            for key in list(self._boards):
+                kind, board_channel = key[0], key[1]
+                if kind in (self.FULLBOARD, self.RECENT, self.CURRENCY):
+                    del self._boards[key]
+                elif board_channel is not None:
+                    if board_channel == channel:
+                        del self._boards[key]
+                elif self._changes_top(user_id, new_total):
+                    del self._boards[key]
+                    self._top = None
+
+    def _changes_top(self, user_id: str, new_total: int) -> bool:
+        top = self._top
+        if top is None or user_id in top or len(top) < self.size:
+            return True
+        # Ties are kept: the sort order of equal scores is not guaranteed.
+        return new_total >= min(top.values())
+
+    def clear(self):
+        """Drop every cached board."""
+        with self._lock:
+            self._generation += 1
+            self._boards.clear()
+            self._top = None
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+This module compacts the daily history of the storages in the background.
+
+`storage.AzureTableStorage` archives one record per active user per day,
+so the table, and the partitions a history query reads, grow with every
+day the bot runs. `Compactor` calls `Storage.compact_history` from a
+background thread: the months older than a tenant's
+``compact_after_days`` are folded into one rollup per user and month,
+one month at a time.
+
+Compaction is resumable: a run interrupted (or failing) at any step is
+completed by the next one. Storages without a growing daily history
+have nothing to compact.
+"""
+import datetime
+import threading
+import time
+import traceback
+
+from typing import List
+
+
+def compaction_cutoff(today: datetime.date, age_days: int) -> datetime.date:
+    """Return the first day of the month `age_days` before `today`.
+
+    The months before the cutoff are whole and older than `age_days`.
+    """
+    return (today - datetime.timedelta(days=age_days)).replace(day=1)
+
+
+class Compactor():
+    """Fold the old daily history of tenants into monthly rollups.
+
+    Parameters
+    ----------
+    tenants
+        Tenants whose storage is compacted, those with a
+        ``compact_after_days`` of 0 are skipped
+    interval
+        Seconds between two runs of the background thread
+    """
+
+    def __init__(self, tenants: List, interval: float = 3600):
+        self.tenants = tenants
+        self.interval = interval
+
+    def run_once(self, today: datetime.date = None) -> int:
+        """Fold every month due of every tenant and return the number of daily records folded.
+
+        A tenant whose compaction fails is reported and retried at the
+        next run.
+        """
+        today = today or datetime.date.today()
+        folded = 0
+        for tenant in self.tenants:
+            if not tenant.compact_after_days:
+                continue
+            before = compaction_cutoff(today, tenant.compact_after_days)
+            try:
+                while True:
+                    count = tenant.storage.compact_history(before)
+                    if not count:
+                        break
+                    folded += count
+            except Exception:
+                print(f"Compaction failed for {tenant.name}, retrying in {self.interval:g}s:")
+                traceback.print_exc()
+        return folded
+
+    def start(self) -> threading.Thread:
+        """Run the compaction every `interval` seconds from a daemon thread."""
+        thread = threading.Thread(target=self._run, name='compaction', daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            self.run_once()
+            time.sleep(self.interval)
@@ -0,0 +1,173 @@
+import copy
+import datetime
+import itertools
+import json
+import re
+
+import pytest
+
+
+class FakeClock():
+    """Clock whose time is set by the test."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSlackClient():
+    """Slack client handing out `events`, listing `members` and recording the calls."""
+
+    def __init__(self, events=(), members=()):
+        self.events = list(events)
+        self.members = list(members)
+        self.calls = []
+
+    def rtm_read(self):
+        events, self.events = self.events, []
+        return events
+
+    def api_call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        return {'ok': True, 'members': [{'id': user_id, 'name': user_id.lower()}
+                                        for user_id in self.members]}
+
+
+class FakeTableService():
+    """Azure `TableService` keeping one table in memory and recording the calls.
+
+    Batches are the SDK's own `TableBatch`, so its checks (one partition,
+    at most 100 entities) apply. ``calls`` holds ('query', filter),
+    ('get', partition, row), ('merge', partition, row) and ('batch',
+    partition, [(method, row)], body bytes) tuples. ``hooks`` maps a
+    method name to a function called with its arguments first, which may
+    raise to simulate a failure.
+    """
+
+    def __init__(self):
+        self.entities = dict()  # (PartitionKey, RowKey) : entity
+        self.calls = []
+        self.hooks = dict()
+        self.now = datetime.datetime.now(datetime.timezone.utc)
+        self._etags = itertools.count(1)
+
+    def _hook(self, name, *args, **kwargs):
+        if name in self.hooks:
+            self.hooks[name](*args, **kwargs)
+
+    def _store(self, entity):
+        entity = {name: value for name, value in entity.items() if name not in ('etag', 'Timestamp')}
+        entity['etag'] = f'W/"{next(self._etags)}"'
+        entity['Timestamp'] = self.now
+        self.entities[(entity['PartitionKey'], entity['RowKey'])] = entity
+
+    def _existing(self, partition, row, if_match):
+        from azure.common import AzureHttpError
+        entity = self.entities.get((partition, row))
+        if entity is None:
+            raise AzureHttpError('The specified resource does not exist.', 404)
+        if if_match not in (None, '*') and if_match != entity['etag']:
+            raise AzureHttpError('The update condition specified in the request was not satisfied.', 412)
+        return entity
+
+    @staticmethod
+    def _matches(entity, filter):
+        # The filters used by storage: comparisons of the keys joined by and/or.
+        expr = re.sub(r' (eq|ne|ge|gt|le|lt) ',
+                      lambda m: {'eq': ' == ', 'ne': ' != ', 'ge': ' >= ', 'gt': ' > ',
+                                 'le': ' <= ', 'lt': ' < '}[m.group(1)], filter)
+        return eval(expr, {}, {'PartitionKey': entity['PartitionKey'], 'RowKey': entity['RowKey']})
+
+    def query_entities(self, table_name, filter=None, select=None, num_results=None, **kwargs):
+        self._hook('query_entities', table_name, filter=filter, select=select)
+        self.calls.append(('query', filter))
+        records = [copy.deepcopy(entity) for _, entity in sorted(self.entities.items())
+                   if filter is None or self._matches(entity, filter)]
+        return records[:num_results] if num_results else records
+
+    def get_entity(self, table_name, partition_key, row_key, select=None):
+        self._hook('get_entity', table_name, partition_key, row_key)
+        self.calls.append(('get', partition_key, row_key))
+        return copy.deepcopy(self._existing(partition_key, row_key, None))
+
+    def insert_entity(self, table_name, entity):
+        from azure.common import AzureHttpError
+        self._hook('insert_entity', table_name, entity)
+        if (entity['PartitionKey'], entity['RowKey']) in self.entities:
+            raise AzureHttpError('The specified entity already exists.', 409)
+        self._store(dict(entity))
+
+    def merge_entity(self, table_name, entity, if_match='*'):
+        self._hook('merge_entity', table_name, entity)
+        self.calls.append(('merge', entity['PartitionKey'], entity['RowKey']))
+        existing = self._existing(entity['PartitionKey'], entity['RowKey'], if_match)
+        self._store(dict(existing, **entity))
+
+    def insert_or_merge_entity(self, table_name, entity):
+        self._hook('insert_or_merge_entity', table_name, entity)
+        existing = self.entities.get((entity['PartitionKey'], entity['RowKey']), dict())
+        self._store(dict(existing, **entity))
+
+    def insert_or_replace_entity(self, table_name, entity):
+        self._hook('insert_or_replace_entity', table_name, entity)
+        self._store(dict(entity))
+
+    @staticmethod
+    def _decode(body):
+        entity = dict()
+        for name, value in json.loads(body).items():
+            if not name.endswith('@odata.type'):
+                entity[name] = value
+        for name, value in json.loads(body).items():
+            if name.endswith('@odata.type') and value == 'Edm.Int64':
+                entity[name[:-len('@odata.type')]] = int(entity[name[:-len('@odata.type')]])
+        return entity
+
+    def commit_batch(self, table_name, batch):
+        from azure.storage.table import AzureBatchOperationError
+        self._hook('commit_batch', table_name, batch)
+        ops = [(request.method, row, request) for row, request in batch._requests]
+        self.calls.append(('batch', batch._partition_key, [(method, row) for method, row, _ in ops],
+                           sum(len(request.body or b'') for _, _, request in ops)))
+        # All or nothing: check every operation first.
+        for idx, (method, row, request) in enumerate(ops):
+            if method in ('MERGE', 'DELETE') or request.headers.get('If-Match'):
+                try:
+                    self._existing(batch._partition_key, row, request.headers.get('If-Match'))
+                except Exception as error:
+                    raise AzureBatchOperationError(f'{idx}:{error}', error.status_code, 'Failed')
+        for method, row, request in ops:
+            key = (batch._partition_key, row)
+            if method == 'DELETE':
+                del self.entities[key]
+            elif method == 'MERGE':
+                self._store(dict(self.entities.get(key, dict()), **self._decode(request.body)))
+            else:
+                self._store(self._decode(request.body))
+
+    def batches(self, method=None):
+        """Return the batch calls, those holding a `method` operation only if given."""
+        return [call for call in self.calls if call[0] == 'batch' and
+                (method is None or any(op == method for op, _ in call[2]))]
+
+
+### Fixtures
+@pytest.fixture()
+def clock():
+    return FakeClock()
+
+@pytest.fixture()
+def table_service():
+    return FakeTableService()
+
+@pytest.fixture()
+def azure_storage(table_service, monkeypatch):
+    """`AzureTableStorage` on a `FakeTableService`."""
+    import storage
+    monkeypatch.setenv('ACCOUNT_NAME', 'test')
+    monkeypatch.setenv('ACCOUNT_KEY', 'dGVzdA==')
+    azure_storage = storage.AzureTableStorage(table_name='test')
+    azure_storage._table_service = table_service
+    return azure_storage
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+This module describes the currencies a workspace gives points in.
+
+A workspace has a main currency, its ``EMOJI``, and optionally more,
+e.g. ``:fireball:`` worth 1 point and ``:trophy:`` worth 5. Each
+currency has:
+
+- a weight: the points one emoji is worth. The scores (``leaderboard``,
+  ``fullboard``, ...) add up the points of every currency.
+- a daily budget: the number of emoji of that currency each user can
+  give per day, independent of the other currencies.
+- its own leaderboard, ranking the number of emoji received
+  (``leaderboard :trophy:``), answered from a `CurrencyIndex`.
+
+Storage keeps the counts of all of a user's currencies in one packed
+field of the user's record, so a give mixing several emoji is still a
+single read and a single write (see `storage.Storage.give_points`).
+"""
+import bisect
+
+from typing import Dict, List, Tuple
+
+
+class Currency():
+    """An emoji users give to each other.
+
+    Attributes
+    ----------
+    emoji : str
+        Emoji as written in messages, e.g. ``:trophy:``
+    name : str
+        Emoji without colons, e.g. ``trophy``. Used as the storage key
+        of the currency and matches the reaction name of the emoji.
+    weight : int
+        Points one emoji is worth
+    max_points_per_day : int
+        Number of emoji of this currency each user can give per day
+    """
+
+    __slots__ = ('emoji', 'name', 'weight', 'max_points_per_day')
+
+    def __init__(self, emoji: str, weight: int = 1, max_points_per_day: int = 5):
+        self.emoji = emoji
+        self.name = emoji.strip(':') if emoji else None
+        self.weight = int(weight)
+        self.max_points_per_day = int(max_points_per_day)
+
+    def __repr__(self):
+        return f'Currency({self.emoji!r}, {self.weight}, {self.max_points_per_day})'
+
+
+def parse_currencies(spec: str) -> List[Dict]:
+    """Return the currencies described by `spec`, as `Currency` arguments.
+
+    `spec` is a comma separated list of ``name:weight:max_points_per_day``,
+    e.g. ``trophy:5:1,star:2:3``.
+    """
+    currencies = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, weight, max_points_per_day = item.strip().strip(':').split(':')
+        currencies.append({'emoji': f':{name}:', 'weight': int(weight),
+                           'max_points_per_day': int(max_points_per_day)})
+    return currencies
+
+
+def within_budgets(currencies: List[Currency], used: Dict[str, int],
+                   spend: Dict[str, int]) -> bool:
+    """Return True if `spend` fits in the daily budget of every currency.
+
+    Parameters
+    ----------
+    currencies
+        Currencies of the workspace
+    used
+        Dictionary of currency name : emoji already used today
+    spend
+        Dictionary of currency name : emoji to give
+    """
+    for currency in currencies:
+        if used.get(currency.name, 0) + spend.get(currency.name, 0) > currency.max_points_per_day:
+            return False
+    return True
+
+
+class CurrencyIndex():
+    """Users ordered by the number of emoji received, per currency."""
+
+    def __init__(self):
+        self._scores = dict()  # currency : {user_id : received}
+        self._order = dict()  # currency : [(-received, user_id)], sorted
+
+    def __len__(self):
+        return sum(len(scores) for scores in self._scores.values())
+
+    def update(self, user_id: str, received: Dict[str, int]):
+        """Set the number of emoji received by `user_id`, a dict of currency : total."""
+        for currency, total in received.items():
+            scores = self._scores.setdefault(currency, dict())
+            order = self._order.setdefault(currency, [])
+            previous = scores.pop(user_id, None)
+            if previous is not None:
+                del order[bisect.bisect_left(order, (-previous, user_id))]
+            if total > 0:
+                scores[user_id] = total
+                bisect.insort(order, (-total, user_id))
+
+    def load(self, received: Dict[str, Dict[str, int]]):
+        """Replace the index with `received`, a dict of user_id : {currency : total}."""
+        self._scores = dict()
+        for user_id, totals in received.items():
+            for currency, total in totals.items():
+                if total > 0:
+                    self._scores.setdefault(currency, dict())[user_id] = total
+        self._order = {currency: sorted((-total, user_id) for user_id, total in scores.items())
+                       for currency, scores in self._scores.items()}
+
+    def top(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        """Return the `k` highest (user_id, received) in `currency`, highest first."""
+        return [(user_id, -total) for total, user_id in self._order.get(currency, [])[:k]]
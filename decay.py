@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+This module computes the "recent" scores shown by ``leaderboard recent``.
+
+The all time total only grows, so long-tenured users stay on top of the
+leaderboard forever. The recent score of a user instead decays
+exponentially: points received lose half of their weight every
+``half_life`` days.
+
+A recent score is stored as a pair ``(value, updated)``: its value at
+the time ``updated`` (seconds since the epoch) of the last change. The
+value at any later time ``t`` is ``value * exp(-rate * (t - updated))``,
+so nothing needs to be rewritten as time passes. The pair is brought up
+to date only when points are added (`add`) and the current value is
+computed when it is read (`decayed`).
+
+Every score decays at the same rate, so the order of the users never
+changes with time, only when points are added. `DecayedIndex` orders
+users by ``log(value) + rate * updated``, which does not depend on the
+time of the query, and answers top-k queries without recomputing
+anything.
+"""
+import bisect
+import math
+import time
+
+from typing import Dict, List, Tuple
+
+
+DEFAULT_HALF_LIFE = 30  # days
+
+
+def decay_rate(half_life: float) -> float:
+    """Return the decay rate, per second, for a half life in days."""
+    return math.log(2) / (half_life * 86400)
+
+
+def decayed(value: float, updated: float, now: float, rate: float) -> float:
+    """Return the value at `now` of a score worth `value` at `updated`."""
+    if not value:
+        return 0.0
+    return value * math.exp(-rate * max(0.0, now - updated))
+
+
+def add(value: float, updated: float, num: float, now: float,
+        rate: float) -> Tuple[float, float]:
+    """Return the pair ``(value, updated)`` after adding `num` at `now`."""
+    return decayed(value, updated, now, rate) + num, now
+
+
+def rank_key(value: float, updated: float, rate: float) -> float:
+    """Return the time independent sort key of a score."""
+    return math.log(value) + rate * updated
+
+
+class DecayedIndex():
+    """Users ordered by their decayed score.
+
+    Parameters
+    ----------
+    half_life
+        Half life of the scores in days
+    """
+
+    def __init__(self, half_life: float = DEFAULT_HALF_LIFE):
+        self.half_life = half_life
+        self.rate = decay_rate(half_life)
+        self._keys = dict()  # user_id : rank key
+        self._order = []  # (-rank key, user_id), sorted
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, user_id: str, value: float, updated: float):
+        """Set the score of `user_id` to the pair ``(value, updated)``."""
+        key = self._keys.pop(user_id, None)
+        if key is not None:
+            del self._order[bisect.bisect_left(self._order, (-key, user_id))]
+        if value > 0:
+            key = self._keys[user_id] = rank_key(value, updated, self.rate)
+            bisect.insort(self._order, (-key, user_id))
+
+    def load(self, scores: Dict[str, Tuple[float, float]]):
+        """Replace the index with `scores`, a dict of user_id : (value, updated)."""
+        self._keys = {user_id: rank_key(value, updated, self.rate)
+                      for user_id, (value, updated) in scores.items() if value > 0}
+        self._order = sorted((-key, user_id) for user_id, key in self._keys.items())
+
+    def top(self, k: int, now: float = None) -> List[Tuple[str, float]]:
+        """Return the `k` highest (user_id, score at `now`), highest first."""
+        now = time.time() if now is None else now
+        return [(user_id, math.exp(-key - self.rate * now))
+                for key, user_id in self._order[:k]]
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+This module reports on the memory used by the bot.
+
+The bot runs for weeks, so every structure growing with users, channels
+or messages must stay bounded. `MemoryDiagnostics` reports, on demand:
+
+- the resident set size (RSS) of the process,
+- size gauges: the number of entries of every such structure (users
+  cached, storage records, cached boards, token buckets, queued
+  commands, ...), see `Tenant.sizes` and `Storage.sizes`,
+- the allocation sites that grew the most since the previous report,
+  from `tracemalloc` snapshots,
+- the queue wait times of the commands, per priority class, when the
+  process schedules commands (see `scheduler.Scheduler.wait_stats`).
+
+Tracing allocations slows every allocation down, so `tracemalloc` is
+only started by the first report (or at startup with the
+``PYTHONTRACEMALLOC`` env var); the second report shows the growth
+between the two.
+
+A report is printed when the process receives ``SIGUSR1`` (see
+`MemoryDiagnostics.install_signal`), and sent to the admins of a
+workspace (`Tenant.admins`) who send ``memory`` to the bot. With shards,
+every worker process reports on the users it owns.
+"""
+import os
+import resource
+import signal
+import sys
+import tracemalloc
+
+from typing import Callable, Dict, List
+
+
+def rss() -> int:
+    """Return the resident set size of the process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current size, in KB on Linux and bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryDiagnostics():
+    """On demand memory report of one process.
+
+    Parameters
+    ----------
+    sizes
+        Function returning the size gauges, a dict of name : entries
+    frames
+        Number of frames kept per traced allocation
+    waits
+        Optional function returning the queue wait statistics, a dict of
+        priority class : {count, shed, mean, p95, max}, times in seconds
+    """
+
+    def __init__(self, sizes: Callable[[], Dict[str, int]], frames: int = 1,
+                 waits: Callable[[], Dict[str, Dict[str, float]]] = None):
+        self.sizes = sizes
+        self.frames = frames
+        self.waits = waits
+        self._snapshot = None
+
+    def growth(self, limit: int = 10) -> List[str]:
+        """Take a snapshot and return the `limit` sites that grew the most since the last one."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._snapshot = None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        previous, self._snapshot = self._snapshot, snapshot
+        if previous is None:
+            return ['Allocation tracing started, the next report shows the growth.']
+        stats = snapshot.compare_to(previous, 'lineno')
+        return [str(stat) for stat in stats[:limit] if stat.size_diff > 0]
+
+    def report(self, limit: int = 10) -> str:
+        """Return the RSS, size gauges, queue waits and allocation growth as text.
+
+        The `limit` sites that grew the most are listed, none if 0.
+        """
+        lines = [f'pid {os.getpid()}: RSS {rss() / 2 ** 20:.1f} MB']
+        lines.extend(f'{name}: {size}' for name, size in sorted(self.sizes().items()))
+        if self.waits is not None:
+            lines.append('Queue waits:')
+            lines.extend(f"{name}: {s['count']} run, {s['shed']} shed, mean {s['mean'] * 1000:.1f} ms, "
+                         f"p95 {s['p95'] * 1000:.1f} ms, max {s['max'] * 1000:.1f} ms"
+                         for name, s in self.waits().items())
+        if limit:
+            lines.append(f'Top {limit} allocation sites by growth:')
+            lines.extend(self.growth(limit))
+        return '\n'.join(lines)
+
+    def install_signal(self, signum: int = getattr(signal, 'SIGUSR1', None)):
+        """Print a report on stdout whenever the process receives `signum`.
+
+        Must be called from the main thread.
+        """
+        if signum is None:
+            # No SIGUSR1 on Windows.
+            return
+        signal.signal(signum, lambda *args: print(self.report(), flush=True))
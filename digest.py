@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps the running aggregates behind the daily and weekly
+digests.
+
+A digest recaps a finished day or week: top receivers, top givers,
+newcomers (users who received points for the first time) and biggest
+movers (largest increase in points received over the period before).
+Computing this from storage would read every user for every day of the
+period, so `DigestAggregator` listens to the storage instead (see
+`Storage.add_listener`) and updates the aggregates of the current day
+and week on every change.
+
+Within a period the counts only increase, and so does the increase
+over the previous period. `TopK` therefore keeps the exact top ``k``
+incrementally: a user can only enter it when their count grows, which
+is when it is checked. Producing a digest copies ``k`` entries.
+
+The aggregates are kept in memory, so a digest only covers the gives
+seen since the process started. With shards every worker aggregates the
+users it owns; users are partitioned between shards, so merging the top
+``k`` of every shard (`merge_summaries`) gives the exact top ``k``.
+"""
+import datetime
+
+from typing import Callable, Dict, List, Tuple
+
+
+DAILY = 'daily'
+WEEKLY = 'weekly'
+KINDS = (DAILY, WEEKLY)
+
+
+def period_start(kind: str, date: datetime.date) -> datetime.date:
+    """Return the first day of the `kind` period holding `date`."""
+    if kind == WEEKLY:
+        return date - datetime.timedelta(days=date.weekday())
+    return date
+
+
+def period_length(kind: str) -> datetime.timedelta:
+    return datetime.timedelta(days=7 if kind == WEEKLY else 1)
+
+
+class TopK():
+    """Exact top `k` of counters that only increase."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self._top = []  # [count, user_id], highest first
+        self._members = set()
+
+    def update(self, user_id: str, count: int):
+        """Record that the counter of `user_id` is now `count`."""
+        top = self._top
+        if user_id in self._members:
+            for entry in top:
+                if entry[1] == user_id:
+                    entry[0] = count
+                    break
+        elif len(top) < self.k:
+            top.append([count, user_id])
+            self._members.add(user_id)
+        elif count > top[-1][0]:
+            self._members.discard(top[-1][1])
+            top[-1] = [count, user_id]
+            self._members.add(user_id)
+        else:
+            return
+        # Stable, so earlier users stay ahead on ties.
+        top.sort(key=lambda entry: -entry[0])
+
+    def items(self) -> List[Tuple[str, int]]:
+        return [(user_id, count) for count, user_id in self._top]
+
+
+class PeriodStats():
+    """Aggregates of one day or week.
+
+    Parameters
+    ----------
+    start
+        First day of the period
+    k
+        Number of users kept in each ranking
+    baseline
+        Points received per user in the previous period, for the movers
+    """
+
+    def __init__(self, start: datetime.date, k: int, baseline: Dict[str, int] = None):
+        self.start = start
+        self.k = k
+        self.baseline = baseline or dict()
+        self.received = dict()  # user_id : points received
+        self.given = dict()  # user_id : points given
+        self.total = 0
+        self.top_received = TopK(k)
+        self.top_given = TopK(k)
+        self.movers = TopK(k)
+        self.newcomers = []  # first k newcomers
+        self.newcomer_count = 0
+
+    def add_received(self, user_id: str, num: int, newcomer: bool):
+        count = self.received[user_id] = self.received.get(user_id, 0) + num
+        self.total += num
+        self.top_received.update(user_id, count)
+        self.movers.update(user_id, count - self.baseline.get(user_id, 0))
+        if newcomer:
+            self.newcomer_count += 1
+            if len(self.newcomers) < self.k:
+                self.newcomers.append(user_id)
+
+    def add_given(self, user_id: str, num: int):
+        count = self.given[user_id] = self.given.get(user_id, 0) + num
+        self.top_given.update(user_id, count)
+
+    def summary(self, kind: str) -> Dict:
+        """Return the digest of the period, see `merge_summaries`."""
+        return {'kind': kind, 'start': self.start, 'total': self.total,
+                'received': self.top_received.items(),
+                'given': self.top_given.items(),
+                'movers': [(u, n) for u, n in self.movers.items() if n > 0],
+                'newcomers': list(self.newcomers),
+                'newcomer_count': self.newcomer_count}
+
+
+def empty_summary(kind: str, start: datetime.date) -> Dict:
+    return {'kind': kind, 'start': start, 'total': 0, 'received': [], 'given': [],
+            'movers': [], 'newcomers': [], 'newcomer_count': 0}
+
+
+def merge_summaries(summaries: List[Dict], k: int) -> Dict:
+    """Merge the summaries of disjoint sets of users, e.g. of every shard."""
+    merged = empty_summary(summaries[0]['kind'], summaries[0]['start'])
+    for summary in summaries:
+        merged['total'] += summary['total']
+        merged['newcomer_count'] += summary['newcomer_count']
+        for field in ('received', 'given', 'movers', 'newcomers'):
+            merged[field].extend(summary[field])
+    for field in ('received', 'given', 'movers'):
+        merged[field] = sorted(merged[field], key=lambda tup: tup[1], reverse=True)[:k]
+    merged['newcomers'] = merged['newcomers'][:k]
+    return merged
+
+
+class DigestAggregator():
+    """Running aggregates of the current and previous day and week.
+
+    Register it with `Storage.add_listener`.
+
+    Parameters
+    ----------
+    k
+        Number of users in each ranking of a digest
+    today
+        Function returning the current date
+    """
+
+    def __init__(self, k: int = 5, today: Callable[[], datetime.date] = datetime.date.today):
+        self.k = k
+        self.today = today
+        self._current = dict()  # kind : PeriodStats
+        self._previous = dict()  # kind : PeriodStats
+        self._posted = dict()  # kind : start of the last period posted
+
+    def _periods(self) -> List[PeriodStats]:
+        """Return the current stats of every kind, starting new periods as needed."""
+        today = self.today()
+        periods = []
+        for kind in KINDS:
+            start = period_start(kind, today)
+            current = self._current.get(kind)
+            if current is None or current.start != start:
+                if current is not None:
+                    self._previous[kind] = current
+                # Movers are compared with the period right before only.
+                baseline = None
+                if current is not None and current.start + period_length(kind) == start:
+                    baseline = current.received
+                current = self._current[kind] = PeriodStats(start, self.k, baseline)
+            periods.append(current)
+        return periods
+
+    ### Storage listener
+    def points_received(self, user_id: str, num: int, new_total: int):
+        for stats in self._periods():
+            stats.add_received(user_id, num, newcomer=new_total == num)
+
+    def points_used(self, user_id: str, num: int):
+        for stats in self._periods():
+            stats.add_given(user_id, num)
+
+    ### Digests
+    def last_period(self, kind: str) -> datetime.date:
+        """Return the first day of the last finished `kind` period."""
+        return period_start(kind, self.today()) - period_length(kind)
+
+    def due(self) -> List[str]:
+        """Return the kinds of digest whose last finished period was not posted."""
+        return [kind for kind in KINDS if self._posted.get(kind) != self.last_period(kind)]
+
+    def mark_posted(self, kind: str):
+        self._posted[kind] = self.last_period(kind)
+
+    def summary(self, kind: str) -> Dict:
+        """Return the digest of the last finished `kind` period, in O(k)."""
+        self._periods()
+        start = self.last_period(kind)
+        previous = self._previous.get(kind)
+        if previous is None or previous.start != start:
+            return empty_summary(kind, start)
+        return previous.summary(kind)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+This module exports the leaderboard to files for dashboards.
+
+Dashboards poll the leaderboard far more often than it changes. Instead
+of answering each poll from storage, `LeaderboardExporter` keeps the
+workspace ranking in memory and writes a snapshot of its top to disk
+when a give changes it:
+
+- ``leaderboard.json``: the snapshot as JSON,
+- ``leaderboard.bin``: the same snapshot packed with `struct`, see
+  `pack_snapshot` and `unpack_snapshot`.
+
+Every snapshot has a version, incremented by every write (and kept
+across restarts). Writes are debounced: the files are written ``delay``
+seconds after the first change, so a burst of gives produces a single
+write. Files are replaced atomically, readers never see half a file.
+
+The ranking is read from storage once (one ``get_users_and_scores_total``)
+and then kept up to date by the gives, see `Tenant.record_give`.
+
+`serve_snapshots` serves the export directory over HTTP, read-only,
+with ETags: a dashboard polling with ``If-None-Match`` gets a ``304 Not
+Modified`` until the next snapshot, and polls never reach the bot's
+storage.
+"""
+import hashlib
+import heapq
+import http.server
+import json
+import os
+import struct
+import threading
+import time
+
+from typing import Callable, Dict, List, Tuple
+
+
+JSON_FILE = 'leaderboard.json'
+BINARY_FILE = 'leaderboard.bin'
+
+# Binary snapshot: header, then one entry per leader.
+MAGIC = b'HFLB'
+FORMAT_VERSION = 1
+# magic, format version, snapshot version, generated (seconds since the epoch), leaders
+_HEADER = struct.Struct('<4sHIqH')
+# score, then the user id and name, each as length (1 byte) + UTF-8
+_ENTRY = struct.Struct('<q')
+
+
+#####################
+# Snapshots
+#####################
+
+
+def pack_snapshot(snapshot: Dict) -> bytes:
+    """Return the binary form of a snapshot, see `LeaderboardExporter.snapshot`."""
+    parts = [_HEADER.pack(MAGIC, FORMAT_VERSION, snapshot['version'], snapshot['generated'],
+                          len(snapshot['leaders']))]
+    for leader in snapshot['leaders']:
+        parts.append(_ENTRY.pack(leader['score']))
+        for text in (leader['user_id'], leader['name']):
+            data = text.encode('utf-8')[:255]
+            parts.append(bytes((len(data),)) + data)
+    return b''.join(parts)
+
+
+def unpack_snapshot(data: bytes) -> Dict:
+    """Return the snapshot packed in `data` by `pack_snapshot`.
+
+    The workspace and points name are not part of the binary form.
+    """
+    magic, format_version, version, generated, count = _HEADER.unpack_from(data)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError('Not a leaderboard snapshot.')
+    offset = _HEADER.size
+    leaders = []
+    for rank in range(1, count + 1):
+        score, = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        texts = []
+        for _ in range(2):
+            length = data[offset]
+            texts.append(data[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+        leaders.append({'rank': rank, 'user_id': texts[0], 'name': texts[1], 'score': score})
+    return {'version': version, 'generated': generated, 'leaders': leaders}
+
+
+def _write_atomic(path: str, data: bytes):
+    """Replace the file at `path` with `data` in one step."""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class LeaderboardExporter():
+    """Write the top of a workspace's ranking to disk when it changes.
+
+    Parameters
+    ----------
+    tenant
+        Workspace whose leaderboard is exported
+    directory
+        Directory the snapshots are written to, created if needed
+    delay
+        Seconds between the first change and the write of the snapshot
+    size
+        Number of users in the snapshot
+    clock
+        Function returning the current time in seconds
+    """
+
+    def __init__(self, tenant, directory: str, delay: float = 5, size: int = 10,
+                 clock: Callable[[], float] = time.monotonic):
+        self.tenant = tenant
+        self.directory = directory
+        self.delay = delay
+        self.size = size
+        self.clock = clock
+        self.version = self._read_version()
+        self._scores = None  # user_id : points received, loaded by the first `flush`
+        self._top = dict()  # scores of the last snapshot
+        self._changed_at = None  # time of the first change since the last snapshot
+
+    def __len__(self):
+        return len(self._scores or ())
+
+    def _read_version(self) -> int:
+        """Return the version of the snapshot on disk, 0 if none."""
+        try:
+            with open(os.path.join(self.directory, JSON_FILE)) as f:
+                return int(json.load(f)['version'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0
+
+    def record_give(self, user_id: str, new_total: int):
+        """Update the ranking with `user_id` reaching `new_total` points."""
+        if self._scores is None:
+            # Not loaded yet: the first `flush` reads the new total from storage.
+            return
+        self._scores[user_id] = new_total
+        if self._changed_at is None and self._changes_top(user_id, new_total):
+            self._changed_at = self.clock()
+
+    def _changes_top(self, user_id: str, new_total: int) -> bool:
+        top = self._top
+        if user_id in top or len(top) < self.size:
+            return True
+        return new_total >= min(top.values())
+
+    def flush(self, force: bool = False) -> bool:
+        """Write the snapshot if the top changed `delay` seconds ago.
+
+        The first call reads the ranking from storage and writes a
+        snapshot. Return True if a snapshot was written.
+        """
+        if self._scores is None:
+            self._scores = dict(self.tenant.storage.get_users_and_scores_total())
+            force = True
+        elif self._changed_at is None:
+            return False
+        if not force and self.clock() - self._changed_at < self.delay:
+            return False
+        self.write()
+        return True
+
+    def leaders(self) -> List[Tuple[str, int]]:
+        """Return the top (user_id, points received), highest first."""
+        return heapq.nsmallest(self.size, self._scores.items(), key=lambda tup: (-tup[1], tup[0]))
+
+    def snapshot(self, leaders: List[Tuple[str, int]]) -> Dict:
+        """Return the next snapshot of `leaders`, as written to ``leaderboard.json``."""
+        lookup = self.tenant.user_name_lookup
+        return {'version': self.version + 1,
+                'generated': int(time.time()),
+                'workspace': self.tenant.name,
+                'points': self.tenant.points,
+                'leaders': [{'rank': idx + 1, 'user_id': user_id[2:-1],
+                             'name': lookup.get(user_id[2:-1], user_id[2:-1]), 'score': score}
+                            for idx, (user_id, score) in enumerate(leaders)]}
+
+    def write(self):
+        """Write the current top to disk as the next version."""
+        leaders = self.leaders()
+        snapshot = self.snapshot(leaders)
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(os.path.join(self.directory, BINARY_FILE), pack_snapshot(snapshot))
+        _write_atomic(os.path.join(self.directory, JSON_FILE),
+                      json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+        self.version = snapshot['version']
+        self._top = dict(leaders)
+        self._changed_at = None
+
+
+#####################
+# HTTP server
+#####################
+
+
+class SnapshotHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the files of ``server.directory``, read-only, with ETags.
+
+    The content and ETag of a file are cached until its modification
+    time or size changes, so a poll costs a ``stat``.
+    """
+
+    CONTENT_TYPES = {'.json': 'application/json', '.bin': 'application/octet-stream'}
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def _serve(self, body: bool):
+        entry = self._load(self.path.split('?', 1)[0])
+        if entry is None:
+            self.send_error(404)
+            return
+        etag, data, content_type = entry
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        # Dashboards revalidate on every poll, which is a 304 until the next snapshot.
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def _load(self, url_path: str):
+        """Return (etag, content, content type) of the file at `url_path`, or None."""
+        root = os.path.realpath(self.server.directory)
+        path = os.path.realpath(os.path.join(root, url_path.lstrip('/')))
+        content_type = self.CONTENT_TYPES.get(os.path.splitext(path)[1])
+        if content_type is None or not path.startswith(root + os.sep):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.server.files.get(path)
+        if cached is None or cached[0] != key:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+            etag = '"{}"'.format(hashlib.sha1(data).hexdigest()[:16])
+            cached = self.server.files[path] = (key, (etag, data, content_type))
+        return cached[1]
+
+    def log_message(self, format, *args):
+        # Dashboards poll constantly, don't log every request.
+        pass
+
+
+def serve_snapshots(directory: str, port: int, host: str = '') -> http.server.ThreadingHTTPServer:
+    """Serve `directory` on `port` from a background thread and return the server.
+
+    Call ``shutdown()`` on the server to stop it.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), SnapshotHandler)
+    server.daemon_threads = True
+    server.directory = directory
+    server.files = dict()  # path : ((mtime, size), (etag, content, content type))
+    threading.Thread(target=server.serve_forever, name='snapshots', daemon=True).start()
+    return server
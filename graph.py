@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps who gave points to whom.
+
+The scores only say how many points a user gave and received, not to
+and from whom. `GiveGraph` is a weighted adjacency index of the gives,
+giver -> receiver -> points, answering:
+
+- ``fans @user``: the users who gave the most points to a user,
+- ``top pairs``: the giver -> receiver pairs with the most points,
+
+each for all time and this month, without reading the daily history.
+
+The graph is sparse: only pairs that exchanged points are stored. User
+ids are interned once to small integers and a pair is a single integer
+(``giver << 32 | receiver``), so an edge costs a dictionary entry and a
+tuple in the sorted order of its period, whatever the length of the ids.
+
+Every period ('ALL' and 'YYYY-MM') has its own bucket of edges. Storage
+drops the buckets of past months (see `GiveGraph.drop_periods`), only
+all time and this month are ever read. A storage keeping a limited
+history takes the gives of the days it forgets out of the graph too
+(see `GiveGraph.remove`), so the graph holds no more edges than pairs
+in that history.
+"""
+import bisect
+import heapq
+
+from typing import Dict, Iterable, List, Tuple
+
+
+ALL_TIME = 'ALL'
+# A pair is `giver << _SHIFT | receiver`.
+_SHIFT = 32
+_MASK = (1 << _SHIFT) - 1
+
+
+class _Bucket():
+    """Edges of one period."""
+
+    __slots__ = ('fans', 'order')
+
+    def __init__(self):
+        self.fans = dict()  # receiver : {giver : points}
+        self.order = []  # [(-points, pair)], sorted
+
+    def add(self, giver: int, receiver: int, num: int):
+        fans = self.fans.setdefault(receiver, dict())
+        previous = fans.get(giver, 0)
+        pair = giver << _SHIFT | receiver
+        if previous:
+            del self.order[bisect.bisect_left(self.order, (-previous, pair))]
+        total = previous + num
+        if total:
+            fans[giver] = total
+            bisect.insort(self.order, (-total, pair))
+        else:
+            del fans[giver]
+            if not fans:
+                del self.fans[receiver]
+
+
+class GiveGraph():
+    """Points given by each user to each other user, per period."""
+
+    def __init__(self):
+        self._ids = dict()  # user_id : index
+        self._users = []  # index : user_id
+        self._periods = dict()  # period : _Bucket
+
+    def __len__(self):
+        return sum(len(bucket.order) for bucket in self._periods.values())
+
+    def _intern(self, user_id: str) -> int:
+        index = self._ids.get(user_id)
+        if index is None:
+            index = self._ids[user_id] = len(self._users)
+            self._users.append(user_id)
+        return index
+
+    def add(self, giver_id: str, targets: Dict[str, int], month: str):
+        """Add a give of `targets` (target_id : points) by `giver_id` in `month` (YYYY-MM)."""
+        giver = self._intern(giver_id)
+        buckets = [self._periods.setdefault(period, _Bucket()) for period in (ALL_TIME, month)]
+        for target_id, num in targets.items():
+            receiver = self._intern(target_id)
+            for bucket in buckets:
+                bucket.add(giver, receiver, num)
+
+    def load(self, gives: Iterable[Tuple[str, str, Dict[str, int]]]):
+        """Replace the graph with `gives`, tuples (YYYY-MM-DD, giver_id, {target_id: points})."""
+        self._periods = dict()
+        edges = dict()  # period : {pair : points}
+        for day, giver_id, targets in gives:
+            giver = self._intern(giver_id)
+            for period in (ALL_TIME, day[:7]):
+                pairs = edges.setdefault(period, dict())
+                for target_id, num in targets.items():
+                    pair = giver << _SHIFT | self._intern(target_id)
+                    pairs[pair] = pairs.get(pair, 0) + num
+        for period, pairs in edges.items():
+            bucket = self._periods[period] = _Bucket()
+            for pair, num in pairs.items():
+                if num:
+                    bucket.fans.setdefault(pair & _MASK, dict())[pair >> _SHIFT] = num
+            bucket.order = sorted((-num, pair) for pair, num in pairs.items() if num)
+
+    def remove(self, giver_id: str, targets: Dict[str, int], month: str):
+        """Take a give added by `add` out of all time and of `month`, if still kept.
+
+        An edge never goes below zero, whatever was dropped before.
+        """
+        giver = self._ids.get(giver_id)
+        buckets = [self._periods[period] for period in (ALL_TIME, month) if period in self._periods]
+        for target_id, num in targets.items():
+            receiver = self._ids.get(target_id)
+            for bucket in buckets:
+                previous = bucket.fans.get(receiver, dict()).get(giver, 0)
+                if previous > 0 and num > 0:
+                    bucket.add(giver, receiver, -min(num, previous))
+
+    def drop_periods(self, keep: Iterable[str]):
+        """Drop the buckets of every period but all time and `keep`."""
+        keep = set(keep) | {ALL_TIME}
+        for period in [period for period in self._periods if period not in keep]:
+            del self._periods[period]
+
+    def fans(self, user_id: str, k: int, period: str = ALL_TIME) -> List[Tuple[str, int]]:
+        """Return the `k` users who gave `user_id` the most points, as (giver_id, points)."""
+        bucket = self._periods.get(period)
+        receiver = self._ids.get(user_id)
+        if bucket is None or receiver is None:
+            return []
+        fans = bucket.fans.get(receiver, dict())
+        top = heapq.nsmallest(k, fans.items(), key=lambda tup: (-tup[1], tup[0]))
+        return [(self._users[giver], num) for giver, num in top if num > 0]
+
+    def top_pairs(self, k: int, period: str = ALL_TIME) -> List[Tuple[str, str, int]]:
+        """Return the `k` pairs with the most points, as (giver_id, target_id, points)."""
+        bucket = self._periods.get(period)
+        if bucket is None:
+            return []
+        return [(self._users[pair >> _SHIFT], self._users[pair & _MASK], -num)
+                for num, pair in bucket.order[:k] if num < 0]
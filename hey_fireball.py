@@ -1,44 +1,24 @@
 # Standard imports
 import os
+import sys
 import time
+import datetime
 from collections import namedtuple
-import re 
 import json
 
-from typing import Dict, List
-
-# 3rd party imports
-from slackclient import SlackClient
+from typing import Callable, Dict, List, Tuple
 
 # Same package imports
-import storage
-
-# Storage info
-_storage = None
-STORAGE_TYPE = os.environ.get("STORAGE_TYPE", "inmemory")
-
-# starterbot's ID as an environment variable
-BOT_ID = os.environ.get("BOT_ID")
-EMOJI = os.environ.get('EMOJI')
-POINTS = os.environ.get('POINTS')
-SELF_POINTS = os.environ.get('SELF_POINTS', "DISALLOW")
-
-# constants
-AT_BOT = "<@" + BOT_ID + ">"
+from tenant import Tenant, load_tenant_configs, load_tenants
+from scheduler import Scheduler, INTERACTIVE, BOARD
+from diagnostics import MemoryDiagnostics
+from currency import within_budgets
+from compaction import Compactor
+from storage import MAX_TARGETS, ConflictError
 
-MAX_POINTS_PER_DAY = 5
 #EMOJI = ':fireball:'
 #POINTS = 'shots'
 
-# instantiate Slack & Twilio clients
-slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
-
-commands = ['leaderboard', 'fullboard', POINTS, '{}left'.format(POINTS), 'setpm']
-commands_with_target = [POINTS, 'all']
-
-user_list = slack_client.api_call("users.list")['members']
-user_name_lookup = {x['id'] : x['name'] for x in user_list}  # U1A1A1A1A : kyle.sykes
-
 def get_username(user_id: str, user_name_lookup: Dict[str, str]) -> str:
     """Get username from ``user_name_lookup`` dictionary
 
@@ -60,6 +40,58 @@ def get_username(user_id: str, user_name_lookup: Dict[str, str]) -> str:
     except KeyError:
         return user_id
 
+################
+# Tokenizer
+################
+
+# Kinds of tokens.
+MENTION = 'mention'  # value: the mention, e.g. ``<@U1A1A1A1A>``
+CHANNEL = 'channel'  # value: the channel Id
+EMOJI = 'emoji'      # value: the emoji of a currency
+INTEGER = 'integer'  # value: the int
+KEYWORD = 'keyword'  # value: the lowercased word
+
+
+def tokenize(parts: List[str], emojis) -> Tuple[List[Tuple[str, object]], Dict[str, int]]:
+    """Classify every part of a message in a single pass.
+
+    Parameters
+    ----------
+    parts
+        Message text split on spaces
+    emojis
+        Emojis counted as points, e.g. ``tenant.currency_by_emoji``
+
+    Returns
+    -------
+    tokens
+        List of (kind, value), one per part
+    emoji_counts
+        Dictionary of emoji : number of tokens, for the emojis found
+    """
+    tokens = []
+    append = tokens.append
+    emoji_counts = dict()
+    for part in parts:
+        if part in emojis:
+            append((EMOJI, part))
+            emoji_counts[part] = emoji_counts.get(part, 0) + 1
+        elif part[0] == '<' and part[-1] == '>':
+            if part[1] == '@':
+                # Mentions end up as storage keys: share one string per user.
+                append((MENTION, sys.intern(part)))
+            elif part[1] == '#':
+                # ``<#C1A1A1A1A|name>``
+                append((CHANNEL, part[2:-1].partition('|')[0]))
+            else:
+                append((KEYWORD, part.lower()))
+        elif part.isdecimal() or (part[0] == '-' and part[1:].isdecimal()):
+            append((INTEGER, int(part)))
+        else:
+            append((KEYWORD, part.lower()))
+    return tokens, emoji_counts
+
+
 ################
 # FireballMessage class
 ################
@@ -68,6 +100,8 @@ class FireballMessage():
 
     Attributes
     ----------
+    tenant : Tenant
+        Workspace the message was received from
     requestor_id_only : str
         User Id of person that sent the message
     requestor_id : str
@@ -80,6 +114,8 @@ class FireballMessage():
         Text of the message
     parts : list
         ``text`` split on spaces
+    tokens : list
+        ``(kind, value)`` of every part, see `tokenize`
     bot_is_first : bool
         Boolean flag determining whether the bot name was the first
         thing in the message or not
@@ -87,7 +123,11 @@ class FireballMessage():
         Boolean determining if message is a message intended for
         bot or not (default None)
     target_id : str
-        The intended target of points to be given
+        The intended target of points to be given (the first one if
+        several users were mentioned)
+    target_ids : list
+        Every user mentioned before the command or count, without
+        duplicates. Each of them receives ``count`` points.
     target_id_only : str
         User Id of the intended recipient of points
     target_name : str
@@ -95,174 +135,220 @@ class FireballMessage():
     command : str
         Command given or intepreted
     count : int
-        Count of number of points to be given
+        Count of number of points to be given (to each target)
+    counts : dict
+        Number of emoji of each currency, by name, every target receives.
+        ``count`` is their weighted sum, see `currency`.
+    setting_request : str
+        Argument of ``setpm``: ``on``, ``off``, ``toggle`` when there is
+        none, or None if it was invalid
     setting : int
-        Toggle for whether PMs should be sent to the user or not
+        Toggle for whether PMs should be sent to the user or not, set
+        from ``setting_request`` when ``setpm`` is executed (see
+        `resolve_setting`), None until then
+    give_all : bool
+        True for the ``all`` command: ``count`` is set from the points
+        remaining when the give is executed
     ts
         Storing thread_ts of message
+    board_channel : str
+        Channel Id given to the ``leaderboard`` command, if any
+    board_this_month : bool
+        True unless ``all`` follows the channel of a ``leaderboard``, the
+        user of ``fans`` or ``top pairs``
+    board_recent : bool
+        True for ``leaderboard recent``, ranking decayed scores
+    board_currency : str
+        Currency of ``leaderboard :emoji:``, ranking the emoji received
     """
 
-    _USER_ID_PATTERN = '^<@\w+>$'
-    _user_id_re = re.compile(_USER_ID_PATTERN)
-
-    def __init__(self, msg: Dict):
+    def __init__(self, msg: Dict, tenant: Tenant):
         """
         Parameters
         ----------
         msg
             Dictionary of the message from the Slack API
+        tenant
+            Workspace the message was received from
         """
+        self.tenant = tenant
         self.requestor_id_only = msg['user']
-        self.requestor_id = f'<@{self.requestor_id_only}>'
-        try:
-            self.requestor_name = user_name_lookup[self.requestor_id_only]
-        except KeyError:
-            self.requestor_name = self.requestor_id
+        self.requestor_id = sys.intern(f'<@{self.requestor_id_only}>')
+        user_name_lookup = tenant.user_name_lookup
+        self.requestor_name = user_name_lookup.get(self.requestor_id_only, self.requestor_id)
         self.channel = msg['channel']
         self.text = msg['text']
+        self.ts = msg.get('ts') # Store the thread_ts
         self.parts = self.text.split()
-        self.bot_is_first = self.parts[0] == AT_BOT
+        self.tokens, emoji_counts = tokenize(self.parts, tenant.currency_by_emoji)
+        self.bot_is_first = bool(self.parts) and self.parts[0] == tenant.at_bot
         self.valid = None
+        self.board_channel = None
+        self.board_this_month = True
+        self.board_recent = False
+        self.board_currency = None
+        self.give_all = False
+        self.target_ids = []
+        self.target_id = None
+        self.target_id_only = None
+        self.target_name = None
+        self.command = None
+        self.count = None
+        self.counts = dict()
+        self.setting_request = None
+        self.setting = None
         # Check if botname was the only token.
-        if len(self.parts) > 1:
-            # Extract target.
-            if self.bot_is_first: 
-                token = self.parts[1]
-            else:
-                token = self.parts[0] 
-            self.target_id = self._extract_valid_user(token)
-            if self.target_id is not None:
-                self.target_id_only = self.target_id[2:-1]
-                # Try to get target username.
-                try:
-                    self.target_name = user_name_lookup[self.target_id_only]
-                except KeyError:
-                    self.target_name = self.target_id
-            else:
-                self.target_id_only = None
-                self.target_name = self.target_id
-            self.command = self._extract_command()
-            self.count = self._extract_count()
-            self.setting = self._extract_setting() # Find on/off or assume toggle
-            self.ts = msg['ts'] # Store the thread_ts
+        if len(self.tokens) < 2:
+            return
+        tokens = self.tokens
+        # Targets: every known user mentioned before the command.
+        idx = int(self.bot_is_first)
+        while idx < len(tokens) and tokens[idx][0] == MENTION:
+            target_id = tokens[idx][1]
+            if target_id[2:-1] not in user_name_lookup:
+                break
+            if target_id not in self.target_ids:
+                self.target_ids.append(target_id)
+            idx += 1
+        if self.target_ids:
+            self.target_id = self.target_ids[0]
+            self.target_id_only = self.target_id[2:-1]
+            self.target_name = user_name_lookup.get(self.target_id_only, self.target_id)
+        if idx == len(tokens):
+            return
+        kind, value = tokens[idx]
+        if kind == KEYWORD:
+            table = command_table(tenant)
+            keywords = table.with_target if self.target_id else table.without_target
+            if value in keywords:
+                self.command = value
+        elif kind == EMOJI:
+            # Only mentions come before `idx`, so every emoji is counted.
+            self.count = 0
+            for emoji, n in emoji_counts.items():
+                currency = tenant.currency_by_emoji[emoji]
+                self.counts[currency.name] = n
+                self.count += currency.weight * n
+        elif kind == INTEGER:
+            # A number of points is a number of the main emoji.
+            main = tenant.currencies[0]
+            self.counts = {main.name: value}
+            self.count = value * main.weight
+        if self.command == 'leaderboard':
+            self._extract_board(idx + 1)
+        elif self.command == 'fans':
+            self._extract_fans(idx + 1)
+        elif self.command == 'top':
+            self._extract_pairs(idx + 1)
+        elif self.command == 'setpm':
+            self.setting_request = self._extract_setting(idx + 1)
 
     def __str__(self):
         return str(vars(self))
 
-    @staticmethod
-    def _extract_valid_user(user_str):
-        """Check if string is a valid user id.
-
-        Initially just checking for a valid pattern, but eventually need to check 
-        if ID is in Slack user list.
-        """
-        a = FireballMessage._user_id_re.findall(user_str)
-        if len(a) > 0:
-            if a[0][2:-1] in user_name_lookup.keys():
-                return a[0]
+    def _extract_board(self, idx: int):
+        """Find the channel (and period), currency or ``recent`` of a ``leaderboard``."""
+        if idx < len(self.tokens) and self.tokens[idx][0] == CHANNEL:
+            self.board_channel = self.tokens[idx][1]
+            self.board_this_month = self.tokens[idx + 1:idx + 2] != [(KEYWORD, 'all')]
+        elif idx < len(self.tokens) and self.tokens[idx] == (KEYWORD, 'recent'):
+            self.board_recent = True
+        elif idx < len(self.tokens) and self.tokens[idx][0] == EMOJI:
+            self.board_currency = self.tenant.currency_by_emoji[self.tokens[idx][1]].name
+
+    def _extract_fans(self, idx: int):
+        """Find the user (if not mentioned before) and period of ``fans``."""
+        if not self.target_id and idx < len(self.tokens) and self.tokens[idx][0] == MENTION:
+            self.target_id = self.tokens[idx][1]
+            self.target_id_only = self.target_id[2:-1]
+            self.target_name = self.tenant.user_name_lookup.get(self.target_id_only, self.target_id)
+            idx += 1
+        self.board_this_month = self.tokens[idx:idx + 1] != [(KEYWORD, 'all')]
+
+    def _extract_pairs(self, idx: int):
+        """Check that ``top`` is followed by ``pairs`` and find the period."""
+        if self.tokens[idx:idx + 1] != [(KEYWORD, 'pairs')]:
+            self.command = None
+            return
+        self.board_this_month = self.tokens[idx + 1:idx + 2] != [(KEYWORD, 'all')]
+
+    def _extract_setting(self, idx: int) -> str:
+        """Find the setting requested by ``setpm``, see `resolve_setting`."""
+        arguments = {value for kind, value in self.tokens[idx:] if kind == KEYWORD}
+        if 'on' in arguments:
+            return 'on'
+        elif 'off' in arguments:
+            return 'off'
+        elif idx == len(self.tokens):
+            # No Arguments, act as a toggle.
+            return 'toggle'
         return None
- 
-    def _extract_command(self):
-        """Find the command in the message."""
-        idx = sum([bool(self.bot_is_first), bool(self.target_id)])
-        if len(self.parts) > idx:
-            cmds = commands_with_target if self.target_id else commands
-            if self.parts[idx].lower() in cmds:
-                 return self.parts[idx].lower()
-
-    def _extract_count(self):
-        """Extract the count of EMOJI in the message."""
-        idx = sum([bool(self.bot_is_first), bool(self.target_id)])
-        if len(self.parts) > idx:
-            if self.parts[idx] == EMOJI:
-                return sum(part==EMOJI for part in self.parts[idx:])
-            else:
-                try:
-                    return int(self.parts[idx])
-                except ValueError:
-                    pass
-
-    def _extract_setting(self):
-        """Find the setting from self-targeting commands"""
-        idx = sum([bool(self.bot_is_first), bool(self.requestor_id)])
-        current_preference = get_pm_preference(self.requestor_id)
-        if 'on' in self.parts and not current_preference:
-            return 1
-        elif 'off' in self.parts and current_preference:
-            return 0
-        elif len(self.parts) == idx:
-            # No Arguments, act as a toggle:
-            if current_preference:
-                return 0
-            else:
-                return 1
-        else:
-            return 2
-
-    '''
-    # Use the following to catch and handle missing methods/properties as we want
-    def __getattr__(self, name):
-        def wrapper(*args, **kwargs):
-            print "{} is an invalid statement.".format(name)
-        return wrapper 
-    '''
-    
+
 
 #####################
 # Storing and retrieving data
 #####################
 
 
-def set_storage(storage_type: str):
-    """Set the storage mechanism.
-    
-    Must be set before calling storge functions.
-    """
-    global _storage
-    storage_type = storage_type.lower()
-    if storage_type == 'inmemory':
-        _storage = storage.InMemoryStorage()
-    elif storage_type == 'azuretable':
-        _storage = storage.AzureTableStorage()
-    else:
-        raise ValueError('Unknown storage type.')
-
+def get_user_points_remaining(tenant: Tenant, user_id: str) -> int:
+    """Return the number of points (main emoji) remaining for user today."""
+    return get_user_currencies_remaining(tenant, user_id)[tenant.currencies[0].name]
 
-def get_user_points_remaining(user_id: str) -> int:
-    """Return the number of points remaining for user today."""
-    used_pts = _storage.get_user_points_used(user_id)
-    return MAX_POINTS_PER_DAY - used_pts
+def get_user_currencies_remaining(tenant: Tenant, user_id: str) -> Dict[str, int]:
+    """Return dictionary of currency : number of emoji remaining for user today."""
+    used = tenant.storage.get_user_currencies_used(user_id)
+    return {c.name: c.max_points_per_day - used.get(c.name, 0) for c in tenant.currencies}
     
-def add_user_points_used(user_id: str, num: int):
+def add_user_points_used(tenant: Tenant, user_id: str, num: int):
     """Add `num` to user's total used points."""
-    _storage.add_user_points_used(user_id, num)
+    tenant.storage.add_user_points_used(user_id, num)
 
-def get_user_points_received_total(user_id: str) -> int:
+def get_user_points_received_total(tenant: Tenant, user_id: str) -> int:
     """Return the number of points received by this user total."""
-    return _storage.get_user_points_received_total(user_id)
+    return tenant.storage.get_user_points_received_total(user_id)
 
-def add_user_points_received(user_id: str, num: int):
-    """Add `num` to user's total and today's received points."""
-    _storage.add_user_points_received(user_id, num)
+def add_user_points_received(tenant: Tenant, user_id: str, num: int) -> int:
+    """Add `num` to user's total and today's received points.
+
+    Return the user's new total.
+    """
+    return tenant.storage.add_user_points_received(user_id, num)
 
-def get_users_and_scores() -> List:
+def get_users_and_scores(tenant: Tenant) -> List:
     """Return list of (user, total points received) tuples."""
-    return _storage.get_users_and_scores_total()
+    return tenant.storage.get_users_and_scores_total()
+
+def give_points(tenant: Tenant, requestor_id: str, targets: Dict[str, int],
+                channel_id: str, currencies: Dict[str, int] = None) -> Dict[str, int]:
+    """Credit every target and debit the requestor in one storage operation.
+
+    `currencies` is the number of emoji of each currency every target
+    receives. Return dictionary of target_id : new total of points received.
+    """
+    return tenant.storage.give_points(requestor_id, targets, channel_id, currencies)
 
-def get_pm_preference(user_id: str) -> int:
+def add_channel_points_received(tenant: Tenant, channel_id: str, user_id: str, num: int):
+    """Add `num` to user's points received in channel."""
+    tenant.storage.add_channel_points_received(channel_id, user_id, num)
+
+def get_channel_users_and_scores(tenant: Tenant, channel_id: str, this_month: bool) -> List:
+    """Return list of (user, points received in channel) tuples."""
+    return tenant.storage.get_channel_users_and_scores(channel_id, this_month)
+
+def get_pm_preference(tenant: Tenant, user_id: str) -> int:
     """Return user's PM Preference"""
-    return _storage.get_pm_preference(user_id)
+    return tenant.storage.get_pm_preference(user_id)
 
-def set_pm_preference(user_id: str, pref: int):
+def set_pm_preference(tenant: Tenant, user_id: str, pref: int):
     """Set user's PM Preference"""
-    _storage.set_pm_preference(user_id, pref)
+    tenant.storage.set_pm_preference(user_id, pref)
 
 
 #####################
 # Parsing Message
 #####################
 
-def parse_slack_output(slack_rtm_output):
+def parse_slack_output(tenant: Tenant, slack_rtm_output):
     """
         The Slack Real Time Messaging API is an events firehose.
         this parsing function returns None unless a message is
@@ -271,18 +357,89 @@ def parse_slack_output(slack_rtm_output):
     output_list = slack_rtm_output
     if output_list and len(output_list) > 0:
         for output in output_list:
-            if ((output and 'text' in output) and 
-                ((AT_BOT in output['text']) or
-                (EMOJI in output['text']))):
+            slack_msg = bot_message(tenant, output)
+            if slack_msg is not None:
                 # This returns after finding the first message containing
                 # the bot name. Other messages in this output list will
                 # be ignored. This is how the example was set up. My 
                 # guess is that this is prevent spamming the bot: this
                 # way the bot can be invoked only once per READ_WEBSOCKET_DELAY.
-                return extract_fireball_info(output)
+                # `App.step` handles every message.
+                return extract_fireball_info(slack_msg, tenant)
     return None
 
 
+def is_bot_event(tenant: Tenant, output: Dict) -> bool:
+    """Return True if the RTM event is a message for the bot."""
+    if not (output and 'text' in output):
+        return False
+    text = output['text']
+    if tenant.at_bot in text:
+        return True
+    for emoji in tenant.currency_by_emoji:
+        if emoji in text:
+            return True
+    return False
+
+
+#####################
+# Event routing
+#####################
+
+# RTM event type : function returning the message for the bot carried
+# by an event of that type, or None. See `bot_message`.
+_event_handlers = dict()
+
+
+def event(event_type: str):
+    """Register the decorated function for the RTM events of `event_type`."""
+    def register(handler):
+        _event_handlers[event_type] = handler
+        return handler
+    return register
+
+
+def bot_message(tenant: Tenant, output: Dict) -> Dict:
+    """Return the message for the bot carried by an RTM event, or None.
+
+    The firehose carries every event of the workspace: typing, presence,
+    reactions with any emoji, ... Events are routed on their ``type``
+    first, so most of them are dropped by a dictionary lookup, before
+    any text is looked at.
+    """
+    handler = _event_handlers.get(output.get('type'))
+    if handler is None:
+        return None
+    return handler(tenant, output)
+
+
+@event('message')
+def _message_event(tenant: Tenant, output: Dict) -> Dict:
+    # The bot's own replies can mention its emoji, e.g. ``Leaderboard for :trophy:``.
+    if output.get('user') == tenant.bot_id:
+        return None
+    return output if is_bot_event(tenant, output) else None
+
+
+@event('reaction_added')
+def _reaction_event(tenant: Tenant, output: Dict) -> Dict:
+    """Reacting with the emoji of a currency to a message gives one to its author.
+
+    The reaction is turned into the message ``<@author> :emoji:`` sent
+    by the user who reacted, so it is checked, admitted and routed like
+    any give.
+    """
+    currency = tenant.currency_by_name.get(output.get('reaction'))
+    if currency is None:
+        return None
+    item = output.get('item') or {}
+    author = output.get('item_user')
+    if item.get('type') != 'message' or not author:
+        return None
+    return {'type': 'message', 'user': output['user'], 'channel': item['channel'],
+            'text': f'<@{author}> {currency.emoji}', 'ts': item.get('ts')}
+
+
 def is_valid_message(fireball_message: FireballMessage) -> bool:
     """Determines if the message contained in the 
     FireballMessage instance is valid.
@@ -303,7 +460,7 @@ def is_valid_message(fireball_message: FireballMessage) -> bool:
     return False
 
 
-def extract_fireball_info(slack_msg: Dict) -> FireballMessage:
+def extract_fireball_info(slack_msg: Dict, tenant: Tenant) -> FireballMessage:
     """Extract relevant info from slack msg and return a FireballInfo instance.
 
     If required info is missing or the format is not recognized, set valid=False 
@@ -313,6 +470,8 @@ def extract_fireball_info(slack_msg: Dict) -> FireballMessage:
     ----------
     slack_msg
         Dictionary of the message from the Slack API
+    tenant
+        Workspace the message was received from
     
     Returns
     -------
@@ -321,12 +480,15 @@ def extract_fireball_info(slack_msg: Dict) -> FireballMessage:
         commands
 
     """
-    fireball = FireballMessage(slack_msg)
+    fireball = FireballMessage(slack_msg, tenant)
 
     # Handle `all` command.
     if fireball.command == 'all':
+        # The remaining points are split evenly between the targets when
+        # the give is executed (see `resolve_give_all`), so that parsing
+        # does not read storage.
         fireball.command = 'give'
-        fireball.count = get_user_points_remaining(fireball.requestor_id)
+        fireball.give_all = True
 
     # Determine if the `give` command was implied.
     if (fireball.command is None
@@ -338,6 +500,166 @@ def extract_fireball_info(slack_msg: Dict) -> FireballMessage:
     return fireball   
 
 
+def resolve_give_all(fireball_message: FireballMessage):
+    """Set the count of an ``all`` command from the requestor's points remaining.
+
+    The remaining points (main emoji) are split evenly between the targets.
+    """
+    if fireball_message.give_all:
+        main = fireball_message.tenant.currencies[0]
+        count = (get_user_points_remaining(fireball_message.tenant, fireball_message.requestor_id)
+                 // len(fireball_message.target_ids))
+        fireball_message.counts = {main.name: count}
+        fireball_message.count = count * main.weight
+
+
+def resolve_setting(fireball_message: FireballMessage):
+    """Set the setting of a ``setpm`` command from the requestor's current preference.
+
+    The setting is 2 if the preference is already as requested or the
+    argument was invalid. Done when the command is executed, so that
+    parsing (and rejected commands) do not read storage.
+    """
+    current_preference = get_pm_preference(fireball_message.tenant, fireball_message.requestor_id)
+    request = fireball_message.setting_request
+    if request == 'on' and not current_preference:
+        fireball_message.setting = 1
+    elif request == 'off' and current_preference:
+        fireball_message.setting = 0
+    elif request == 'toggle':
+        fireball_message.setting = 0 if current_preference else 1
+    else:
+        fireball_message.setting = 2
+
+
+#####################
+# Admission control
+#####################
+
+BUSY_NOTICE = "You're sending commands too quickly. Please wait a few seconds and try again."
+
+def admit_command(fireball_message: FireballMessage) -> bool:
+    """Return True if the command may run now, see `admission`.
+
+    A rejected requestor is sent one ephemeral notice until one of their
+    commands is admitted again. Neither the check nor the notice touch
+    storage.
+    """
+    tenant = fireball_message.tenant
+    board = command_table(tenant).commands[fireball_message.command].board
+    if tenant.admission.admit(fireball_message.requestor_id_only, fireball_message.channel,
+                              fireball_message.command, board):
+        return True
+    if tenant.admission.should_notify(fireball_message.requestor_id_only):
+        tenant.slack_client.api_call("chat.postEphemeral", channel=fireball_message.channel,
+                                     text=BUSY_NOTICE, user=fireball_message.requestor_id_only)
+    return False
+
+
+#####################
+# Command registry
+#####################
+
+class Command():
+    """A command of the bot, see `command`.
+
+    Attributes
+    ----------
+    name : str
+        Keyword of the command. ``{points}`` is replaced by the points
+        name of the tenant, e.g. ``{points}left`` becomes ``shotsleft``.
+    handler : callable
+        Function executing the command, see `command`
+    with_target : bool
+        True if the keyword is understood after mentioned users
+    without_target : bool
+        True if the keyword is understood without mentioned users
+    board : bool
+        True if the command reads every user's score. Its reply is
+        posted in the thread and, when sharded, it is executed by the
+        coordinator.
+    """
+
+    __slots__ = ('name', 'handler', 'with_target', 'without_target', 'board')
+
+    def __init__(self, name: str, handler: Callable, with_target: bool,
+                 without_target: bool, board: bool):
+        self.name = name
+        self.handler = handler
+        self.with_target = with_target
+        self.without_target = without_target
+        self.board = board
+
+
+class CommandTable():
+    """Commands of the tenants using `points`, keyed by their keyword.
+
+    Attributes
+    ----------
+    commands : dict
+        keyword : `Command`, used for dispatch
+    with_target : set
+        Keywords understood after mentioned users
+    without_target : set
+        Keywords understood without mentioned users
+    """
+
+    def __init__(self, points: str, registry: List[Command]):
+        self.commands = {c.name.format(points=points): c for c in registry}
+        self.with_target = {k for k, c in self.commands.items() if c.with_target}
+        self.without_target = {k for k, c in self.commands.items() if c.without_target}
+
+
+_registry = []  # Commands in order of registration
+# The keywords only depend on the points name, so tables are shared by
+# tenants with the same one.
+_command_tables = dict()  # points : CommandTable
+
+
+def command(name: str, with_target: bool = False, without_target: bool = True,
+            board: bool = False):
+    """Decorator registering a command handler.
+
+    The handler is called with the `FireballMessage` and returns None if
+    it replied itself, or a tuple ``(text, send_message_to, attachments)``
+    that `handle_command` posts. See `Command` for the arguments.
+    """
+    def register(handler):
+        _registry.append(Command(name, handler, with_target, without_target, board))
+        _command_tables.clear()
+        return handler
+    return register
+
+
+def command_table(tenant: Tenant) -> CommandTable:
+    """Return the commands understood in `tenant`."""
+    table = _command_tables.get(tenant.points)
+    if table is None:
+        table = _command_tables[tenant.points] = CommandTable(tenant.points, _registry)
+    return table
+
+
+#####################
+# Scheduling commands
+#####################
+
+def schedule_command(scheduler: Scheduler, fireball_message: FireballMessage) -> bool:
+    """Queue the command for `handle_command`, see `scheduler`.
+
+    Board commands go behind every other command and identical board
+    requests in a channel can be shed when the bot is overloaded.
+    Return False if the command was shed.
+    """
+    cmd = command_table(fireball_message.tenant).commands.get(fireball_message.command)
+    if cmd is None or not cmd.board:
+        return scheduler.submit(fireball_message, INTERACTIVE)
+    key = (fireball_message.tenant.name, fireball_message.channel, fireball_message.command,
+           fireball_message.board_channel, fireball_message.board_this_month,
+           fireball_message.board_recent, fireball_message.board_currency,
+           fireball_message.target_id)
+    return scheduler.submit(fireball_message, BOARD, key)
+
+
 #####################
 # Executing commands
 #####################
@@ -353,93 +675,195 @@ def handle_command(fireball_message: FireballMessage):
         Instance of ``FireballMessage`` class
 
     """
-    msg = ''
-    attach = None
-    if fireball_message.command == 'give':
-        # Check if self points are allowed.
-        if SELF_POINTS == 'DISALLOW' and (fireball_message.requestor_id == fireball_message.target_id):
-            msg = 'You cannot give points to yourself!'
-            send_message_to = fireball_message.requestor_id_only
-        # Determine if requestor has enough points to give.
-        elif check_points(fireball_message.requestor_id, fireball_message.count):
-            # Add points to target score.
-            add_user_points_received(fireball_message.target_id, fireball_message.count)
-            # Add points to requestor points used.
-            add_user_points_used(fireball_message.requestor_id, fireball_message.count)
-            msg = f'You received {fireball_message.count} {POINTS} from {fireball_message.requestor_name}'
-            send_message_to = fireball_message.target_id_only
-
-        else:
-            # Requestor lacks enough points to give.
-            msg = f'You do not have enough {POINTS}!'
-            send_message_to = fireball_message.requestor_id_only
-
-    elif fireball_message.command == POINTS:
-        if fireball_message.target_id:
-            # Return target's score.
-            score = get_user_points_received_total(fireball_message.target_id)
-            msg = f'{fireball_message.target_name} has received {score} {POINTS}'
-            send_message_to = fireball_message.channel
-        else:
-            # Return requestor's score.
-            score = get_user_points_received_total(fireball_message.requestor_id)
-            msg = f'{fireball_message.requestor_name} has received {score} {POINTS}'
-            send_message_to = fireball_message.channel
-
-    elif fireball_message.command == 'leaderboard':
-        # Post the leaderboard
-        msg = "Leaderboard"
-        attach = generate_leaderboard()
-        send_message_to = fireball_message.channel
-
-    elif fireball_message.command == 'fullboard':
-        # Post the leaderboard
-        msg = 'Leaderboard'
-        #attach = "Full HeyFireball Leaderboard\n" + generate_full_leaderboard()
-        attach = generate_full_leaderboard()
-        send_message_to = fireball_message.channel
-
-    elif fireball_message.command == f'{POINTS}left':
-        # Return requestor's points remaining.
-        points_rmn = get_user_points_remaining(fireball_message.requestor_id)
-        msg = f"You have {points_rmn} {POINTS} remaining"
-        send_message_to = fireball_message.requestor_id_only
-
-    elif fireball_message.command == 'setpm':
-        if fireball_message.setting <= 1:
-            set_pm_preference(fireball_message.requestor_id, fireball_message.setting)
-            if fireball_message.setting:
-                msg = "Receive PM's: On"
-            else:
-                msg = "Receive PM's: Off\n*Warning:* _Future messages that were sent only to you will look like this. This type of response does not typically persist between slack sessions._"
-        else:
-            msg = f"The option is already set as requested, or the argument was invalid.\nI accept: `{AT_BOT} setpm on`, `{AT_BOT} setpm off`, or `{AT_BOT} setpm` (to act as a toggle). "
-        send_message_to = fireball_message.requestor_id_only
-    else:
+    tenant = fireball_message.tenant
+    cmd = command_table(tenant).commands.get(fireball_message.command)
+    if cmd is None:
         # Message was not valid, so
-        msg = f'{fireball_message.requestor_id}: I do not understand your message. Try again!'
-        send_message_to = fireball_message.channel
+        reply = (f'{fireball_message.requestor_id}: I do not understand your message. Try again!',
+                 fireball_message.channel, None)
+    else:
+        reply = cmd.handler(fireball_message)
+        if reply is None:
+            return
+    msg, send_message_to, attach = reply
     ## Send message
-    if (fireball_message.command == 'fullboard' or
-            fireball_message.command == 'leaderboard'):
-        slack_client.api_call("chat.postMessage", channel=send_message_to,
-                              text=msg, as_user=True, attachments=attach,
-                              thread_ts=fireball_message.ts)
+    if cmd is not None and cmd.board:
+        tenant.slack_client.api_call("chat.postMessage", channel=send_message_to,
+                                     text=msg, as_user=True, attachments=attach,
+                                     thread_ts=fireball_message.ts)
     else:
         # Post message to Slack.
         if (send_message_to == fireball_message.requestor_id_only and
-                get_pm_preference(fireball_message.requestor_id) == 0):
-            slack_client.api_call("chat.postEphemeral", channel=fireball_message.channel,
-                                  text=msg, user=fireball_message.requestor_id_only,
-                                  attachments=attach)
+                get_pm_preference(tenant, fireball_message.requestor_id) == 0):
+            tenant.slack_client.api_call("chat.postEphemeral", channel=fireball_message.channel,
+                                         text=msg, user=fireball_message.requestor_id_only,
+                                         attachments=attach)
         elif (send_message_to == fireball_message.target_id_only and
-              get_pm_preference(fireball_message.target_id) == 0):
-            slack_client.api_call("chat.postEphemeral", channel=fireball_message.channel,
-                                  text=msg, user=fireball_message.target_id_only,
-                                  attachments=attach)
+              get_pm_preference(tenant, fireball_message.target_id) == 0):
+            tenant.slack_client.api_call("chat.postEphemeral", channel=fireball_message.channel,
+                                         text=msg, user=fireball_message.target_id_only,
+                                         attachments=attach)
+        else:
+            tenant.slack_client.api_call("chat.postMessage", channel=send_message_to,
+                                         text=msg, as_user=True, attachments=attach)
+
+
+# `all` is rewritten to `give` by `extract_fireball_info`.
+@command('all', with_target=True, without_target=False)
+@command('give', without_target=False)
+def _give(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    resolve_give_all(fireball_message)
+    # Every target receives `count` points.
+    targets = {target_id: fireball_message.count for target_id in fireball_message.target_ids}
+    # Check if self points are allowed.
+    if tenant.self_points == 'DISALLOW' and (fireball_message.requestor_id in targets):
+        return 'You cannot give points to yourself!', fireball_message.requestor_id_only, None
+    # Every target is written in the same transaction.
+    if len(targets) > MAX_TARGETS:
+        return (f'You can give to at most {MAX_TARGETS} users at once!',
+                fireball_message.requestor_id_only, None)
+    # A negative count would take points away from the targets.
+    if not fireball_message.give_all and (fireball_message.count or 0) <= 0:
+        return (f'You can only give a positive number of {tenant.points}!',
+                fireball_message.requestor_id_only, None)
+    # Determine if requestor has enough of every currency to give to all targets.
+    spend = {name: count * len(targets) for name, count in fireball_message.counts.items()}
+    if not check_points(tenant, fireball_message.requestor_id, spend):
+        # Requestor lacks enough points to give.
+        return f'You do not have enough {tenant.points}!', fireball_message.requestor_id_only, None
+    # Add points to targets' scores and to requestor points used.
+    try:
+        new_totals = give_points(tenant, fireball_message.requestor_id, targets,
+                                 fireball_message.channel, fireball_message.counts)
+    except ConflictError:
+        # The records kept changing under the give, none of it was saved.
+        return (f'Your {tenant.points} could not be given, please try again.',
+                fireball_message.requestor_id_only, None)
+    for target_id, new_total in new_totals.items():
+        tenant.record_give(target_id, new_total, fireball_message.channel)
+        # Notify the target once the burst of gives is over.
+        tenant.notifications.add(target_id, fireball_message.channel,
+                                 fireball_message.requestor_name, targets[target_id])
+
+
+@command('{points}', with_target=True)
+def _points(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    if fireball_message.target_id:
+        # Return target's score.
+        score = get_user_points_received_total(tenant, fireball_message.target_id)
+        msg = f'{fireball_message.target_name} has received {score} {tenant.points}'
+    else:
+        # Return requestor's score.
+        score = get_user_points_received_total(tenant, fireball_message.requestor_id)
+        msg = f'{fireball_message.requestor_name} has received {score} {tenant.points}'
+    return msg, fireball_message.channel, None
+
+
+@command('leaderboard', board=True)
+def _leaderboard(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    if fireball_message.board_recent:
+        # Scores decay every day, so the rendered board is kept for the day.
+        key = (tenant.board_cache.RECENT, None, datetime.date.today().strftime('%Y-%m-%d'))
+        attach = tenant.board_cache.get(key, lambda: generate_recent_leaderboard(tenant))
+        msg = f"Recent leaderboard (points count half after {tenant.recent_half_life:g} days)"
+        return msg, fireball_message.channel, attach
+    if fireball_message.board_currency:
+        currency = tenant.currency_by_name[fireball_message.board_currency]
+        key = (tenant.board_cache.CURRENCY, None, currency.name)
+        attach = tenant.board_cache.get(key, lambda: generate_currency_leaderboard(tenant, currency.name))
+        return f"Leaderboard for {currency.emoji}", fireball_message.channel, attach
+    # Post the leaderboard
+    if fireball_message.board_channel:
+        period = 'this month' if fireball_message.board_this_month else 'all time'
+        msg = f"Leaderboard for <#{fireball_message.board_channel}> ({period})"
+    else:
+        msg = "Leaderboard"
+    month = None
+    if fireball_message.board_channel and fireball_message.board_this_month:
+        month = datetime.date.today().strftime('%Y-%m')
+    key = (tenant.board_cache.LEADERBOARD, fireball_message.board_channel, month)
+    attach = tenant.board_cache.get(key, lambda: generate_leaderboard(
+        tenant, fireball_message.board_channel, fireball_message.board_this_month))
+    return msg, fireball_message.channel, attach
+
+
+@command('fans', with_target=True, board=True)
+def _fans(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    # Fans of the user mentioned, or of the requestor.
+    user_id = fireball_message.target_id or fireball_message.requestor_id
+    name = get_username(user_id[2:-1], tenant.user_name_lookup)
+    period = 'this month' if fireball_message.board_this_month else 'all time'
+    attach = generate_fans_board(tenant, user_id, fireball_message.board_this_month)
+    return f"Biggest fans of {name} ({period})", fireball_message.channel, attach
+
+
+@command('top', board=True)
+def _top_pairs(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    period = 'this month' if fireball_message.board_this_month else 'all time'
+    attach = generate_pairs_board(tenant, fireball_message.board_this_month)
+    return f"Top pairs ({period})", fireball_message.channel, attach
+
+
+@command('fullboard', board=True)
+def _fullboard(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    # Post the leaderboard
+    #attach = "Full HeyFireball Leaderboard\n" + generate_full_leaderboard()
+    attach = tenant.board_cache.get((tenant.board_cache.FULLBOARD, None),
+                                    lambda: generate_full_leaderboard(tenant))
+    return 'Leaderboard', fireball_message.channel, attach
+
+
+@command('{points}left')
+def _points_left(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    # Return requestor's points remaining.
+    remaining = get_user_currencies_remaining(tenant, fireball_message.requestor_id)
+    if len(tenant.currencies) == 1:
+        points_rmn = f'{remaining[tenant.currencies[0].name]} {tenant.points}'
+    else:
+        points_rmn = ', '.join(f'{remaining[c.name]} {c.emoji}' for c in tenant.currencies)
+    return (f"You have {points_rmn} remaining",
+            fireball_message.requestor_id_only, None)
+
+
+@command('setpm')
+def _setpm(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    resolve_setting(fireball_message)
+    if fireball_message.setting <= 1:
+        set_pm_preference(tenant, fireball_message.requestor_id, fireball_message.setting)
+        if fireball_message.setting:
+            msg = "Receive PM's: On"
         else:
-            slack_client.api_call("chat.postMessage", channel=send_message_to,
-                                  text=msg, as_user=True, attachments=attach)
+            msg = "Receive PM's: Off\n*Warning:* _Future messages that were sent only to you will look like this. This type of response does not typically persist between slack sessions._"
+    else:
+        msg = f"The option is already set as requested, or the argument was invalid.\nI accept: `{tenant.at_bot} setpm on`, `{tenant.at_bot} setpm off`, or `{tenant.at_bot} setpm` (to act as a toggle). "
+    return msg, fireball_message.requestor_id_only, None
+
+
+@command('memory')
+def _memory(fireball_message: FireballMessage):
+    tenant = fireball_message.tenant
+    # Only answered to admins, the report shows the internals of the bot.
+    if tenant.diagnostics is None or fireball_message.requestor_id_only not in tenant.admins:
+        return None
+    return f"```{tenant.diagnostics.report()}```", fireball_message.requestor_id_only, None
+
+
+@command('stats', board=True)
+def _stats(fireball_message: FireballMessage):
+    # Post the statistics over the daily history.
+    try:
+        import analytics
+    except ImportError:
+        return 'Stats are not available: numpy is not installed.', fireball_message.channel, None
+    return 'Stats', fireball_message.channel, analytics.generate_stats(fireball_message.tenant)
 
 
 # def give_fireball(user_id, number_of_points):
@@ -454,15 +878,21 @@ def handle_command(fireball_message: FireballMessage):
 #     pass 
 
 
-def check_points(user_id: str, number_of_points: int):
-    """Check to see if user_id has enough points remaining today.
+def check_points(tenant: Tenant, user_id: str, counts: Dict[str, int]):
+    """Check to see if user_id has enough of every currency remaining today.
 
+    tenant
+        Workspace the user belongs to
     user_id
         Slack User Id
-    number_of_points
-        Number of points to be given
+    counts
+        Dictionary of currency : number of emoji to be given
     """
-    return get_user_points_remaining(user_id) >= number_of_points
+    # Giving a negative number would take points away from the targets.
+    if not counts or min(counts.values()) <= 0:
+        return False
+    return within_budgets(tenant.currencies, tenant.storage.get_user_currencies_used(user_id),
+                          counts)
 
 '''
 fireball color palette
@@ -503,9 +933,20 @@ def leaderboard_item(user: str, score: int, idx: int, colors: List) -> Dict[str,
             "title":  "{}: {}".format(user, score)
         }
 
-def generate_leaderboard() -> List[Dict[str, str]]:
+def generate_leaderboard(tenant: Tenant, channel_id: str = None,
+                         this_month: bool = True) -> List[Dict[str, str]]:
     """Generate a formatted leaderboard
 
+    Parameters
+    ----------
+    tenant
+        Workspace to generate the leaderboard for
+    channel_id
+        If given, rank the points received in this channel only
+        (answered from the channel index)
+    this_month
+        Restrict the channel leaderboard to the current month
+
     Returns
     ----------
     board
@@ -513,26 +954,124 @@ def generate_leaderboard() -> List[Dict[str, str]]:
 
     """
     # Get sorted list of all users and their scores.
-    users_and_scores = get_users_and_scores()
+    if channel_id:
+        users_and_scores = get_channel_users_and_scores(tenant, channel_id, this_month)
+    else:
+        users_and_scores = get_users_and_scores(tenant)
     if users_and_scores is not None:
-        leaders = sorted(get_users_and_scores(), key=lambda tup: tup[1], reverse=True)
+        leaders = sorted(users_and_scores, key=lambda tup: tup[1], reverse=True)
+        if not channel_id:
+            # Used by the board cache to tell which gives change this board.
+            tenant.board_cache.set_top(leaders[:tenant.board_cache.size])
         # Create list of leaderboard items.
-        board = [leaderboard_item(get_username(tup[0][2:-1], user_name_lookup), tup[1], idx, colors) for idx, tup in enumerate(leaders[:10])]
+        board = [leaderboard_item(get_username(tup[0][2:-1], tenant.user_name_lookup), tup[1], idx, colors) for idx, tup in enumerate(leaders[:10])]
         if len(board) > 0:
             # Add test to the first element.
             #board[0]["pretext"] = "Leaderboard"
             pass
         else:
-            board = [{"text": f"No users yet. Start giving {POINTS}!!!"}]
+            board = [{"text": f"No users yet. Start giving {tenant.points}!!!"}]
         return board
     else:
         return
 
-def generate_full_leaderboard(full: bool = False) -> List[Dict[str, str]]:
+def generate_recent_leaderboard(tenant: Tenant) -> List[Dict[str, str]]:
+    """Generate a formatted leaderboard of the recent (decayed) scores
+
+    Parameters
+    ----------
+    tenant
+        Workspace to generate the leaderboard for
+
+    Returns
+    ----------
+    board
+        List of leaderboard items
+
+    """
+    leaders = tenant.storage.get_recent_leaders(10)
+    board = [leaderboard_item(get_username(tup[0][2:-1], tenant.user_name_lookup), f'{tup[1]:.1f}', idx, colors) for idx, tup in enumerate(leaders)]
+    if len(board) == 0:
+        board = [{"text": f"No users yet. Start giving {tenant.points}!!!"}]
+    return board
+
+def generate_currency_leaderboard(tenant: Tenant, currency: str) -> List[Dict[str, str]]:
+    """Generate a formatted leaderboard of the emoji of one currency received
+
+    Parameters
+    ----------
+    tenant
+        Workspace to generate the leaderboard for
+    currency
+        Name of the currency, see `currency`
+
+    Returns
+    ----------
+    board
+        List of leaderboard items
+
+    """
+    leaders = tenant.storage.get_currency_leaders(currency, 10)
+    board = [leaderboard_item(get_username(tup[0][2:-1], tenant.user_name_lookup), tup[1], idx, colors) for idx, tup in enumerate(leaders)]
+    if len(board) == 0:
+        board = [{"text": f"No users yet. Start giving {tenant.currency_by_name[currency].emoji}!!!"}]
+    return board
+
+def generate_fans_board(tenant: Tenant, user_id: str, this_month: bool = True) -> List[Dict[str, str]]:
+    """Generate a formatted board of the users who gave the most points to a user
+
+    Parameters
+    ----------
+    tenant
+        Workspace to generate the board for
+    user_id
+        User whose fans are ranked
+    this_month
+        Restrict the board to the points given this month
+
+    Returns
+    ----------
+    board
+        List of leaderboard items
+
+    """
+    fans = tenant.storage.get_fans(user_id, 10, this_month)
+    board = [leaderboard_item(get_username(tup[0][2:-1], tenant.user_name_lookup), tup[1], idx, colors) for idx, tup in enumerate(fans)]
+    if len(board) == 0:
+        board = [{"text": f"No {tenant.points} received yet."}]
+    return board
+
+def generate_pairs_board(tenant: Tenant, this_month: bool = True) -> List[Dict[str, str]]:
+    """Generate a formatted board of the giver → receiver pairs with the most points
+
+    Parameters
+    ----------
+    tenant
+        Workspace to generate the board for
+    this_month
+        Restrict the board to the points given this month
+
+    Returns
+    ----------
+    board
+        List of leaderboard items
+
+    """
+    pairs = tenant.storage.get_top_pairs(10, this_month)
+    lookup = tenant.user_name_lookup
+    board = [leaderboard_item(f'{get_username(giver[2:-1], lookup)} → {get_username(target[2:-1], lookup)}', points, idx, colors)
+             for idx, (giver, target, points) in enumerate(pairs)]
+    if len(board) == 0:
+        board = [{"text": f"No users yet. Start giving {tenant.points}!!!"}]
+    return board
+
+def generate_full_leaderboard(tenant: Tenant, full: bool = False) -> List[Dict[str, str]]:
     """Generate a formatted leaderboard
     
     Parameters
     ----------
+    tenant
+        Workspace to generate the leaderboard for
     full
         Flag for returning the full leadboard or a truncated version
         (to not overload a channel)
@@ -545,11 +1084,11 @@ def generate_full_leaderboard(full: bool = False) -> List[Dict[str, str]]:
 
     """
     # Get sorted list of all users and their scores.
-    leaders = sorted(get_users_and_scores(), key=lambda tup: tup[1], reverse=True)
+    leaders = sorted(get_users_and_scores(tenant), key=lambda tup: tup[1], reverse=True)
     # Create list of leaderboard items.
-    text = '\n'.join([f'{idx + 1}. {get_username(tup[0][2:-1], user_name_lookup)} has {tup[1]} {POINTS}' for idx, tup in enumerate(leaders)])
+    text = '\n'.join([f'{idx + 1}. {get_username(tup[0][2:-1], tenant.user_name_lookup)} has {tup[1]} {tenant.points}' for idx, tup in enumerate(leaders)])
     if len(text) == 0:
-        text = f"No users yet. Start giving {POINTS}!!!"
+        text = f"No users yet. Start giving {tenant.points}!!!"
     board = {'text':text, 'color':'#f05500'}
 
     #ee2400
@@ -557,20 +1096,212 @@ def generate_full_leaderboard(full: bool = False) -> List[Dict[str, str]]:
     #board[0]["pretext"] = "HeyFireball Leaderboard"
     return [board]
 
-if __name__ == "__main__":
+def generate_digest(tenant: Tenant, summary: Dict) -> List[Dict[str, str]]:
+    """Generate the attachments of a daily or weekly digest
+
+    Parameters
+    ----------
+    tenant
+        Workspace of the digest
+    summary
+        Digest returned by `digest.DigestAggregator.summary`
+
+    Returns
+    -------
+    list
+        One attachment per section of the digest
+
+    """
+    def name(user_id):
+        return get_username(user_id[2:-1], tenant.user_name_lookup)
+
+    points = tenant.points
+    newcomers = ', '.join(name(u) for u in summary['newcomers'])
+    if summary['newcomer_count'] > len(summary['newcomers']):
+        newcomers += f" and {summary['newcomer_count'] - len(summary['newcomers'])} more"
+    sections = [
+        ('Top receivers', [f'{name(u)}: {n} {points}' for u, n in summary['received']]),
+        ('Top givers', [f'{name(u)}: {n} {points}' for u, n in summary['given']]),
+        ('Biggest movers', [f'{name(u)}: +{n} {points}' for u, n in summary['movers']]),
+        ('Newcomers', [newcomers] if newcomers else []),
+    ]
+    return [{'title': title, 'text': '\n'.join(lines) or 'Nobody yet.', 'color': colors[idx]}
+            for idx, (title, lines) in enumerate(sections)]
+
+#####################
+# Application
+#####################
+
+class App():
+    """The bot, serving one or more workspaces.
+
+    Importing this module or creating an `App` does no network I/O:
+    tenants are created on first use and each tenant creates its Slack
+    client, storage backend and user directory lazily (see `Tenant`).
+    `connect` does the network initialisation, right before the loop.
+
+    Parameters
+    ----------
+    tenant_configs
+        List of `Tenant` arguments, defaults to `load_tenant_configs`
+    num_shards
+        Number of worker processes, defaults to the SHARDS env var.
+        See `sharding`.
+    shed_after
+        Queue wait in seconds above which duplicate board requests are
+        shed, defaults to the SHED_AFTER env var. See `scheduler`.
+    export_dir
+        Directory the leaderboards are exported to, one subdirectory per
+        workspace, defaults to the EXPORT_DIR env var. Nothing is
+        exported if None. See `exporter`.
+    export_port
+        Port serving ``export_dir`` over HTTP, defaults to the
+        EXPORT_PORT env var. Not served if None.
+    """
+
     READ_WEBSOCKET_DELAY = 1  # 1 second delay between reading from firehose
-    set_storage(STORAGE_TYPE)
-    if slack_client.rtm_connect():
-        print("HeyFireball connected and running!")
+    STEP_BUDGET = 0.5  # Seconds spent on queued commands before reading events again
+
+    def __init__(self, tenant_configs: List[Dict] = None, num_shards: int = None,
+                 shed_after: float = None, export_dir: str = None, export_port: int = None):
+        self._tenant_configs = tenant_configs
+        self._tenants = None
+        if num_shards is None:
+            num_shards = int(os.environ.get('SHARDS', 1))
+        self.num_shards = num_shards
+        if shed_after is None:
+            shed_after = float(os.environ.get('SHED_AFTER', 2))
+        # Commands of every workspace, most urgent first.
+        self.scheduler = Scheduler(handle_command, shed_after)
+        self.router = None
+        self.diagnostics = MemoryDiagnostics(self.sizes, waits=self.scheduler.wait_stats)
+        self.export_dir = export_dir or os.environ.get('EXPORT_DIR')
+        if export_port is None and os.environ.get('EXPORT_PORT'):
+            export_port = int(os.environ['EXPORT_PORT'])
+        self.export_port = export_port
+
+    @property
+    def tenants(self) -> List[Tenant]:
+        """One tenant per Slack workspace served by this process."""
+        if self._tenants is None:
+            configs = self._tenant_configs
+            if configs is None:
+                configs = load_tenant_configs()
+            self._tenants = [Tenant(**config) for config in configs]
+            for tenant in self._tenants:
+                tenant.diagnostics = self.diagnostics
+                if self.export_dir:
+                    # Imported here: the HTTP server is not needed to start.
+                    from exporter import LeaderboardExporter
+                    tenant.exporter = LeaderboardExporter(
+                        tenant, os.path.join(self.export_dir, tenant.name))
+        return self._tenants
+
+    def sizes(self) -> Dict[str, int]:
+        """Return the size gauges of the process, see `diagnostics`."""
+        sizes = self.scheduler.sizes()
+        if self.router is not None:
+            sizes.update(self.router.sizes())
+        for tenant in self._tenants or []:
+            sizes.update({f'{tenant.name} {name}': size for name, size in tenant.sizes().items()})
+        return sizes
+
+    def connect(self) -> List[Tenant]:
+        """Connect every tenant to Slack and return the connected ones."""
+        connected = []
+        for tenant in self.tenants:
+            if tenant.slack_client.rtm_connect():
+                # Load the user directory now rather than on the first message.
+                tenant.load_users()
+                connected.append(tenant)
+            else:
+                print(f"Connection failed for {tenant.name}. Invalid Slack token or bot ID?")
+        if connected and self.num_shards > 1:
+            # Users are split across worker processes, see `sharding`.
+            import sharding
+            self.router = sharding.ShardRouter(connected, self.num_shards, load_tenants)
+            # Boards handed back by the shards are queued like any other.
+            self.router.scheduler = self.scheduler
+            self.router.start()
+        return connected
+
+    def step(self, connected: List[Tenant]):
+        """Read and handle the pending events of every connected tenant once."""
+        # All workspaces are multiplexed over this single loop.
+        for tenant in connected:
+            for output in tenant.slack_client.rtm_read() or []:
+                slack_msg = bot_message(tenant, output)
+                if slack_msg is None:
+                    continue
+                if self.router is not None:
+                    self.router.submit(tenant.name, slack_msg)
+                else:
+                    # Every message for the bot is queued; admission control
+                    # keeps a single user from flooding the queue.
+                    fireball_message = extract_fireball_info(slack_msg, tenant)
+                    if fireball_message.valid and admit_command(fireball_message):
+                        schedule_command(self.scheduler, fireball_message)
+        if self.router is not None:
+            self.router.poll()
+        self.scheduler.run(self.STEP_BUDGET)
+        for tenant in connected:
+            self.post_digests(tenant)
+            # Archive the daily counts of the users whose midnight passed.
+            tenant.storage.rollover()
+        for tenant in connected:
+            tenant.notifications.flush()
+            if tenant.exporter is not None:
+                # Debounced, see `exporter`.
+                tenant.exporter.flush()
+
+    def post_digests(self, tenant: Tenant):
+        """Post the digests of the periods that ended since the last call.
+
+        Digests are read from the running aggregates, see `digest`.
+        Empty digests are not posted.
+        """
+        if not tenant.digest_channels:
+            return
+        for kind in tenant.digests.due():
+            if self.router is not None:
+                summary = self.router.digest(tenant.name, kind)
+            else:
+                summary = tenant.digests.summary(kind)
+            tenant.digests.mark_posted(kind)
+            if not summary['total']:
+                continue
+            if kind == 'weekly':
+                msg = f"Weekly digest for the week of {summary['start']:%Y-%m-%d}"
+            else:
+                msg = f"Daily digest for {summary['start']:%Y-%m-%d}"
+            attach = generate_digest(tenant, summary)
+            for channel in tenant.digest_channels.get(kind, []):
+                tenant.slack_client.api_call("chat.postMessage", channel=channel,
+                                             text=msg, as_user=True, attachments=attach)
+
+    def run(self):
+        """Connect and handle events until the process is stopped."""
+        connected = self.connect()
+        if not connected:
+            return
+        # `kill -USR1 <pid>` prints a memory report.
+        self.diagnostics.install_signal()
+        if self.export_dir and self.export_port is not None:
+            import exporter
+            exporter.serve_snapshots(self.export_dir, self.export_port)
+            print(f"Serving the leaderboards of {self.export_dir} on port {self.export_port}")
+        if self.router is not None:
+            print(f"HeyFireball connected and running on {self.num_shards} shards!")
+        else:
+            # Fold the old daily history into monthly rollups, see
+            # `compaction`. With shards, the first one does it.
+            Compactor(connected).start()
+            print(f"HeyFireball connected and running for {len(connected)} workspace(s)!")
         while True:
-            # Parse messages and look for EMOJI.
-            fireball_message = parse_slack_output(slack_client.rtm_read())
-            # Check if any messages were found containing EMOJI.
-            if fireball_message:
-                #print(fireball_message)
-                # Check if there was a valid message.
-                if fireball_message.valid:
-                    handle_command(fireball_message)
-            time.sleep(READ_WEBSOCKET_DELAY)
-    else:
-        print("Connection failed. Invalid Slack token or bot ID?")
+            self.step(connected)
+            if not self.scheduler:
+                time.sleep(self.READ_WEBSOCKET_DELAY)
+
+
+if __name__ == "__main__":
+    App().run()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+This module batches the "You received N points from X" notifications.
+
+When many people give points to the same person in a short time, each
+give used to post its own message. `NotificationAggregator` holds the
+notifications per target for a short window and then sends a single
+message naming every giver and the total, which saves Slack rate-limit
+budget and spares the recipient a flood of messages.
+
+Only notifications to the target of a give are delayed; replies to the
+requestor (errors, points left, ...) are still sent immediately.
+"""
+import time
+from collections import OrderedDict
+
+from typing import Callable
+
+
+def notify_user(tenant, user_id: str, channel: str, text: str):
+    """Send `text` to `user_id`, honouring their PM preference.
+
+    Parameters
+    ----------
+    tenant
+        Workspace of the user
+    user_id
+        Slack user Id, bare or formatted as ``<@U1A1A1A1A>``
+    channel
+        Channel for the ephemeral message when PMs are turned off
+    text
+        Text of the message
+    """
+    if user_id.startswith('<@'):
+        user_id_only = user_id[2:-1]
+    else:
+        user_id_only, user_id = user_id, f'<@{user_id}>'
+    if tenant.storage.get_pm_preference(user_id) == 0:
+        tenant.slack_client.api_call("chat.postEphemeral", channel=channel,
+                                     text=text, user=user_id_only)
+    else:
+        tenant.slack_client.api_call("chat.postMessage", channel=user_id_only,
+                                     text=text, as_user=True)
+
+
+class _PendingNotification():
+    """Notifications to one target waiting to be sent."""
+
+    __slots__ = ('first_seen', 'channel', 'givers', 'total')
+
+    def __init__(self, first_seen: float, channel: str):
+        self.first_seen = first_seen
+        self.channel = channel
+        # giver name : points, in order of first give
+        self.givers = OrderedDict()
+        self.total = 0
+
+
+class NotificationAggregator():
+    """Merge the notifications sent to the same target within `window` seconds.
+
+    Parameters
+    ----------
+    tenant
+        Workspace the notifications are sent to
+    window
+        Seconds to wait after the first give before notifying the target.
+        With 0, every notification is sent immediately.
+    clock
+        Function returning the current time in seconds
+    """
+
+    def __init__(self, tenant, window: float = 5, clock: Callable[[], float] = time.monotonic):
+        self.tenant = tenant
+        self.window = window
+        self.clock = clock
+        self._pending = dict()  # target_id : _PendingNotification
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, target_id: str, channel: str, giver_name: str, count: int):
+        """Queue a notification that `giver_name` gave `count` points to `target_id`."""
+        pending = self._pending.get(target_id)
+        if pending is None:
+            pending = self._pending[target_id] = _PendingNotification(self.clock(), channel)
+        # Ephemeral messages go to the channel of the latest give.
+        pending.channel = channel
+        pending.givers[giver_name] = pending.givers.get(giver_name, 0) + count
+        pending.total += count
+        if self.window <= 0:
+            self.flush(force=True)
+
+    def flush(self, force: bool = False) -> int:
+        """Send the notifications whose window has passed.
+
+        Parameters
+        ----------
+        force
+            Send every pending notification regardless of its window
+
+        Returns
+        -------
+        int
+            Number of messages sent
+        """
+        now = self.clock()
+        due = [target_id for target_id, pending in self._pending.items()
+               if force or now - pending.first_seen >= self.window]
+        for target_id in due:
+            pending = self._pending.pop(target_id)
+            notify_user(self.tenant, target_id, pending.channel, self.format(pending))
+        return len(due)
+
+    def format(self, pending: _PendingNotification) -> str:
+        """Return the merged message for `pending`."""
+        points = self.tenant.points
+        if len(pending.givers) == 1:
+            giver, = pending.givers
+            return f'You received {pending.total} {points} from {giver}'
+        givers = ', '.join(f'{giver} ({count})' for giver, count in pending.givers.items())
+        return f'You received {pending.total} {points} from {len(pending.givers)} people: {givers}'
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+This module decides when each user's daily allowance resets.
+
+``max_points_per_day`` resets at the user's local midnight, using the
+``tz_offset`` (seconds east of UTC) that Slack's ``users.list`` returns
+for every user. Users without a known offset use the server's.
+
+Users are grouped by offset. For each group `ResetSchedule` keeps the
+local day number and the instant (whole seconds since the epoch) of
+the next local midnight. Storage records the instant at which a user's
+daily counts expire (`ResetSchedule.next_reset`), so checking whether a
+record is current is a single comparison with the current time.
+
+Archiving the counts of the day that ended is done by
+`Storage.rollover`, called from the main loop, for the groups whose
+midnight has passed (`ResetSchedule.due`). A record read before the
+rollover of its group ran is still rolled over when it is read.
+"""
+import datetime
+import heapq
+import time
+
+from typing import Callable, Dict, List
+
+
+DAY = 86400  # seconds
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def local_offset() -> int:
+    """Return the UTC offset of the server, in seconds."""
+    return time.localtime().tm_gmtoff
+
+
+def day_number(now: int, offset: int) -> int:
+    """Return the number of the local day holding `now` (0 is 1970-01-01)."""
+    return (now + offset) // DAY
+
+
+class ResetSchedule():
+    """Local days and next midnights of users, grouped by UTC offset.
+
+    Parameters
+    ----------
+    default_offset
+        UTC offset in seconds of users without a known offset, defaults
+        to the server's
+    clock
+        Function returning the current time in seconds since the epoch
+    """
+
+    def __init__(self, default_offset: int = None, clock: Callable[[], float] = time.time):
+        self.default_offset = local_offset() if default_offset is None else int(default_offset)
+        self.clock = clock
+        self._offsets = dict()  # user_id : offset, when not the default
+        self._buckets = dict()  # offset : [next reset, day number]
+        self._queue = []  # heap of (next reset, offset), one entry per bucket
+        self._bucket(self.default_offset)
+
+    def now(self) -> int:
+        return int(self.clock())
+
+    def set_offsets(self, offsets: Dict[str, int]):
+        """Replace the UTC offsets of users with `offsets`, a dict of user_id : seconds."""
+        self._offsets = {user_id: int(offset) for user_id, offset in offsets.items()
+                         if offset is not None and int(offset) != self.default_offset}
+        for offset in set(self._offsets.values()):
+            self._bucket(offset)
+
+    def offset(self, user_id: str) -> int:
+        return self._offsets.get(user_id, self.default_offset)
+
+    def _bucket(self, offset: int, now: int = None) -> list:
+        """Return the current [next reset, day number] of `offset`."""
+        now = self.now() if now is None else now
+        bucket = self._buckets.get(offset)
+        if bucket is None:
+            bucket = self._buckets[offset] = [0, 0]
+            heapq.heappush(self._queue, (self._advance(bucket, offset, now), offset))
+        elif now >= bucket[0]:
+            # Midnight passed before `due` was called: the heap entry
+            # keeps the old instant, so `due` still reports the bucket.
+            self._advance(bucket, offset, now)
+        return bucket
+
+    @staticmethod
+    def _advance(bucket: list, offset: int, now: int) -> int:
+        day = day_number(now, offset)
+        bucket[0] = (day + 1) * DAY - offset
+        bucket[1] = day
+        return bucket[0]
+
+    def next_reset(self, user_id: str, now: int = None) -> int:
+        """Return when the daily counts of `user_id` written at `now` expire."""
+        return self._bucket(self.offset(user_id), now)[0]
+
+    def today(self, user_id: str = None, now: int = None) -> datetime.date:
+        """Return the local date of `user_id`, or of the server if None."""
+        offset = self.default_offset if user_id is None else self.offset(user_id)
+        return EPOCH + datetime.timedelta(days=self._bucket(offset, now)[1])
+
+    def is_due(self, now: int = None) -> bool:
+        """Return True if the midnight of a group passed since the last `due`."""
+        now = self.now() if now is None else now
+        return bool(self._queue) and self._queue[0][0] <= now
+
+    def due(self, now: int = None) -> List[int]:
+        """Return the offsets whose midnight passed since the last call.
+
+        Each offset is reported once per day, when its rollover is due.
+        """
+        now = self.now() if now is None else now
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            _, offset = heapq.heappop(self._queue)
+            bucket = self._buckets[offset]
+            if now >= bucket[0]:
+                self._advance(bucket, offset, now)
+            heapq.heappush(self._queue, (bucket[0], offset))
+            due.append(offset)
+        return due
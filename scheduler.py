@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+This module orders the execution of commands by priority.
+
+Commands do not have the same urgency: a give must never be dropped and
+should be answered right away, while a ``fullboard`` is expensive and
+can wait. `Scheduler` keeps one FIFO queue per priority class and always
+runs the oldest command of the most urgent non-empty class:
+
+- ``INTERACTIVE``: gives, points left, scores, settings
+- ``BOARD``: commands reading every user's score (leaderboards, stats)
+
+The loop runs the queue for a bounded time and then reads new events,
+so a give arriving behind a pile of boards waits at most for the board
+being executed.
+
+Board requests carry a key (workspace, channel and board). When the
+board queue is overloaded, i.e. its oldest request has waited more than
+``shed_after`` seconds, a request whose key is already queued is shed:
+the queued one posts the same board in the same channel. Interactive
+commands are never shed.
+
+The wait time of every executed command is recorded per class (see
+`WaitStats`) so that the latency of gives can be watched under load.
+"""
+import time
+import traceback
+from collections import deque
+
+from typing import Callable, Dict, Hashable
+
+
+# Priority classes, most urgent first.
+INTERACTIVE = 0
+BOARD = 1
+CLASS_NAMES = ['interactive', 'board']
+
+
+class WaitStats():
+    """Queue wait times of one priority class.
+
+    Percentiles are computed over the last `size` commands.
+    """
+
+    __slots__ = ('count', 'total', 'max', 'shed', '_recent')
+
+    def __init__(self, size: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.shed = 0
+        self._recent = deque(maxlen=size)
+
+    def add(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+        self._recent.append(wait)
+
+    def percentile(self, q: float) -> float:
+        """Return the `q` (0 to 100) percentile of the recent wait times."""
+        if not self._recent:
+            return 0.0
+        recent = sorted(self._recent)
+        return recent[min(len(recent) - 1, int(len(recent) * q / 100))]
+
+    def as_dict(self) -> Dict[str, float]:
+        return {'count': self.count, 'shed': self.shed,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p95': self.percentile(95), 'max': self.max}
+
+
+class Scheduler():
+    """Priority queue of work items, executed by `run`.
+
+    Parameters
+    ----------
+    execute
+        Function called with each item
+    shed_after
+        Wait in seconds of the oldest board request above which
+        duplicate board requests are shed
+    clock
+        Function returning the current time in seconds
+    """
+
+    def __init__(self, execute: Callable, shed_after: float = 2.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.execute = execute
+        self.shed_after = shed_after
+        self.clock = clock
+        self.stats = [WaitStats() for _ in CLASS_NAMES]
+        self._queues = [deque() for _ in CLASS_NAMES]  # (enqueued, key, item)
+        self._queued_keys = dict()  # key : number of queued items
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def latency(self, priority: int) -> float:
+        """Return how long the oldest queued item of `priority` has waited."""
+        queue = self._queues[priority]
+        return self.clock() - queue[0][0] if queue else 0.0
+
+    def submit(self, item, priority: int, key: Hashable = None) -> bool:
+        """Queue `item`, returning False if it was shed.
+
+        Only items with a `key` can be shed, when an item with the same
+        key is queued and the queue of `priority` is overloaded.
+        """
+        if (key is not None and key in self._queued_keys and
+                self.latency(priority) > self.shed_after):
+            self.stats[priority].shed += 1
+            return False
+        self._queues[priority].append((self.clock(), key, item))
+        if key is not None:
+            self._queued_keys[key] = self._queued_keys.get(key, 0) + 1
+        return True
+
+    def run(self, budget: float = None) -> int:
+        """Execute queued items, most urgent first.
+
+        Stop when the queue is empty or, if `budget` is given, once
+        `budget` seconds have been spent. An item raising an exception
+        is reported and counted as executed. Return the number of items
+        executed.
+        """
+        start = self.clock()
+        executed = 0
+        while True:
+            for priority, queue in enumerate(self._queues):
+                if queue:
+                    break
+            else:
+                return executed
+            enqueued, key, item = queue.popleft()
+            if key is not None:
+                if self._queued_keys[key] == 1:
+                    del self._queued_keys[key]
+                else:
+                    self._queued_keys[key] -= 1
+            now = self.clock()
+            self.stats[priority].add(now - enqueued)
+            try:
+                self.execute(item)
+            except Exception:
+                # A failed command must not stop the others, of any workspace.
+                print(f"Command failed: {item!r}")
+                traceback.print_exc()
+            executed += 1
+            if budget is not None and self.clock() - start >= budget:
+                return executed
+
+    def sizes(self) -> Dict[str, int]:
+        """Return the number of queued items of every priority class."""
+        return {'queued ' + name: len(queue) for name, queue in zip(CLASS_NAMES, self._queues)}
+
+    def wait_stats(self) -> Dict[str, Dict[str, float]]:
+        """Return the wait time statistics of every priority class."""
+        return {name: stats.as_dict() for name, stats in zip(CLASS_NAMES, self.stats)}
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+This module runs the bot with its users split across several worker
+processes (shards).
+
+Every user is owned by exactly one shard, chosen by a stable hash of
+the user id. A shard holds the storage for the users it owns, so all
+reads and writes of a user's record are serialised by that shard's
+process and need no locking.
+
+Incoming messages are routed to the shard owning the requestor. A give
+is a two-step transfer:
+
+1. The requestor's shard checks the daily limit and debits the points.
+   Because only this shard touches the requestor's record, the check
+   and the debit cannot race with another give by the same user, so
+   the daily budget of no currency is ever exceeded.
+2. The credit is forwarded to the target's shard, which adds the points
+   and notifies the target. Receiving points has no limit, so the
+   second step cannot be refused.
+
+Shards never wait on each other; only the coordinating process waits
+for replies. The coordinator sees the shards through `ShardedStorage`,
+a `Storage` that forwards each call to the owning shard and gathers
+``get_users_and_scores_total`` from all of them, which is what the
+leaderboards need. Each shard answers a gather for the users it owns
+only: with Azure tables every shard reads the same table, and a user
+must be counted once, not once per shard.
+"""
+import itertools
+import multiprocessing
+import queue
+import zlib
+from collections import deque
+
+from typing import Callable, Dict, List, Tuple
+
+# Same package imports
+from compaction import Compactor
+from currency import within_budgets
+from diagnostics import MemoryDiagnostics
+from notifications import notify_user
+from storage import Storage
+
+
+def shard_for(user_id: str, num_shards: int) -> int:
+    """Return the index of the shard owning `user_id`.
+
+    ``hash()`` is salted per process, so a CRC of the id is used to get
+    the same answer in every process.
+    """
+    if user_id.startswith('<@'):
+        user_id = user_id[2:-1]
+    return zlib.crc32(user_id.encode('utf-8')) % num_shards
+
+
+#####################
+# Worker
+#####################
+
+
+class ShardWorker(multiprocessing.Process):
+    """Process owning the users of one shard.
+
+    The worker reads operations from its inbox and posts replies (and
+    requests it cannot answer itself, such as leaderboards) on the
+    shared ``results`` queue read by the coordinator.
+
+    Operations
+    ----------
+    ('message', tenant_name, slack_msg[, admitted])
+        Parse and execute a message sent by a user of this shard.
+        ``admitted`` is True when the message was forwarded by the
+        requestor's shard, which already ran admission control.
+    ('credit', tenant_name, target_id, count, requestor_name, channel, counts)
+        Second step of a give: credit and notify the target. ``counts``
+        is the number of emoji of each currency, see `currency`.
+    ('transfer', tenant_name, requestor_id, target_id, count, key)
+        Check, debit and forward a give of the main currency, replying
+        with True/False.
+    ('call', tenant_name, method, args, key)
+        Call a `Storage` method and reply with its result.
+    ('gather', tenant_name, method, args, column, key)
+        Call a `Storage` method returning rows and reply with the rows
+        whose user id, at index ``column``, is owned by this shard.
+    ('digest', tenant_name, kind, key)
+        Reply with the digest of the users of this shard, see `digest`.
+    None
+        Stop the worker.
+    """
+
+    # Seconds between checks for notifications to send when idle.
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, index: int, inboxes: List, results,
+                 tenants_factory: Callable[[], List]):
+        super().__init__(daemon=True)
+        self.index = index
+        self.inboxes = inboxes
+        self.results = results
+        self.tenants_factory = tenants_factory
+        self.tenants = None
+
+    def run(self):
+        # Tenants are created in the child so that each shard gets a
+        # fresh storage instance.
+        self.tenants = {t.name: t for t in self.tenants_factory()}
+        # Memory reports of this worker, see `diagnostics`.
+        diagnostics = MemoryDiagnostics(lambda: {f'{name} {key}': size
+                                                 for name, tenant in self.tenants.items()
+                                                 for key, size in tenant.sizes().items()})
+        diagnostics.install_signal()
+        for tenant in self.tenants.values():
+            tenant.diagnostics = diagnostics
+        if self.index == 0:
+            # With Azure tables every shard reads and writes the same table,
+            # a single one folds its old history, see `compaction`.
+            Compactor(list(self.tenants.values())).start()
+        while True:
+            try:
+                op = self.inboxes[self.index].get(timeout=self.FLUSH_INTERVAL)
+            except queue.Empty:
+                op = ()
+            if op is None:
+                for tenant in self.tenants.values():
+                    tenant.notifications.flush(force=True)
+                break
+            if op:
+                getattr(self, '_op_' + op[0])(*op[1:])
+            for tenant in self.tenants.values():
+                tenant.storage.rollover()
+                tenant.notifications.flush()
+
+    def _owner(self, user_id: str) -> int:
+        return shard_for(user_id, len(self.inboxes))
+
+    def _op_call(self, tenant_name: str, method: str, args: Tuple, key: int):
+        storage = self.tenants[tenant_name].storage
+        self.results.put(('reply', key, getattr(storage, method)(*args)))
+
+    def _op_gather(self, tenant_name: str, method: str, args: Tuple, column: int, key: int):
+        rows = getattr(self.tenants[tenant_name].storage, method)(*args)
+        self.results.put(('reply', key, [row for row in rows
+                                         if self._owner(row[column]) == self.index]))
+
+    def _op_digest(self, tenant_name: str, kind: str, key: int):
+        self.results.put(('reply', key, self.tenants[tenant_name].digests.summary(kind)))
+
+    def _op_transfer(self, tenant_name: str, requestor_id: str, target_id: str,
+                     count: int, key: int):
+        accepted = self._transfer(self.tenants[tenant_name], requestor_id,
+                                  [target_id], count, None, None)
+        self.results.put(('reply', key, accepted))
+
+    def _op_credit(self, tenant_name: str, target_id: str, count: int,
+                   requestor_name: str, channel: str, counts: Dict[str, int] = None):
+        tenant = self.tenants[tenant_name]
+        new_total = tenant.storage.add_user_points_received(target_id, count, counts)
+        # Let the coordinator drop the cached boards this give changes.
+        self.results.put(('given', tenant_name, target_id, new_total, channel))
+        if channel is not None:
+            tenant.storage.add_channel_points_received(channel, target_id, count)
+            tenant.notifications.add(target_id, channel, requestor_name, count)
+
+    def _op_message(self, tenant_name: str, slack_msg: Dict, admitted: bool = False):
+        import hey_fireball
+        tenant = self.tenants[tenant_name]
+        fireball_message = hey_fireball.extract_fireball_info(slack_msg, tenant)
+        if not fireball_message.valid:
+            return
+        # Messages forwarded by another shard were admitted there.
+        if not (admitted or hey_fireball.admit_command(fireball_message)):
+            return
+        command = fireball_message.command
+        if hey_fireball.command_table(tenant).commands[command].board:
+            # Boards need every shard; the coordinator gathers them.
+            self.results.put(('message', tenant_name, slack_msg))
+        elif command == 'give':
+            hey_fireball.resolve_give_all(fireball_message)
+            if (tenant.self_points == 'DISALLOW' and
+                    fireball_message.requestor_id in fireball_message.target_ids):
+                notify_user(tenant, fireball_message.requestor_id, fireball_message.channel,
+                            'You cannot give points to yourself!')
+            elif len(set(fireball_message.target_ids)) > hey_fireball.MAX_TARGETS:
+                notify_user(tenant, fireball_message.requestor_id, fireball_message.channel,
+                            f'You can give to at most {hey_fireball.MAX_TARGETS} users at once!')
+            elif not self._transfer(tenant, fireball_message.requestor_id,
+                                    fireball_message.target_ids, fireball_message.count,
+                                    fireball_message.requestor_name, fireball_message.channel,
+                                    fireball_message.counts):
+                notify_user(tenant, fireball_message.requestor_id, fireball_message.channel,
+                            f'You do not have enough {tenant.points}!')
+        elif (command == tenant.points and fireball_message.target_id and
+                self._owner(fireball_message.target_id) != self.index):
+            # The score lives on the target's shard.
+            self.inboxes[self._owner(fireball_message.target_id)].put(
+                ('message', tenant_name, slack_msg, True))
+        else:
+            hey_fireball.handle_command(fireball_message)
+
+    def _transfer(self, tenant, requestor_id: str, target_ids: List[str], count: int,
+                  requestor_name: str, channel: str, counts: Dict[str, int] = None) -> bool:
+        """Debit the requestor and forward the credits to the targets' shards.
+
+        Every target receives `count` points, made of `counts` emoji of
+        each currency (`count` of the main one if None); the total is
+        checked against the daily budgets once and debited in a single
+        write.
+        """
+        if count is None or count <= 0:
+            return False
+        if counts is None:
+            counts = {tenant.currencies[0].name: count}
+        storage = tenant.storage
+        spend = {name: n * len(target_ids) for name, n in counts.items()}
+        if not within_budgets(tenant.currencies, storage.get_user_currencies_used(requestor_id),
+                              spend):
+            return False
+        storage.add_user_points_used(requestor_id, count * len(target_ids), spend)
+        storage.add_given_to(requestor_id, {target_id: count for target_id in target_ids})
+        for target_id in target_ids:
+            credit = ('credit', tenant.name, target_id, count, requestor_name, channel, counts)
+            owner = self._owner(target_id)
+            if owner == self.index:
+                self._op_credit(*credit[1:])
+            else:
+                self.inboxes[owner].put(credit)
+        return True
+
+
+#####################
+# Coordinator
+#####################
+
+
+class ShardRouter():
+    """Start the shard workers and route messages to them.
+
+    Parameters
+    ----------
+    tenants
+        Tenants of the coordinating process. Their storage is replaced
+        by a `ShardedStorage` routing to the workers.
+    num_shards
+        Number of worker processes
+    tenants_factory
+        Callable run in every worker to create its own tenants. It must
+        return tenants with the same names as ``tenants``.
+    """
+
+    def __init__(self, tenants: List, num_shards: int,
+                 tenants_factory: Callable[[], List]):
+        self.num_shards = num_shards
+        self.inboxes = [multiprocessing.Queue() for _ in range(num_shards)]
+        self.results = multiprocessing.Queue()
+        self.workers = [ShardWorker(i, self.inboxes, self.results, tenants_factory)
+                        for i in range(num_shards)]
+        self._keys = itertools.count()
+        self._replies = dict()
+        self._pending = deque()
+        self.tenants = {t.name: t for t in tenants}
+        for tenant in tenants:
+            tenant.storage = ShardedStorage(self, tenant.name)
+        # When set, the boards handed back by the shards are queued on
+        # this `scheduler.Scheduler` instead of being executed by `poll`.
+        self.scheduler = None
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def submit(self, tenant_name: str, slack_msg: Dict):
+        """Route a Slack message to the shard owning its sender."""
+        owner = shard_for(slack_msg['user'], self.num_shards)
+        self.inboxes[owner].put(('message', tenant_name, slack_msg))
+
+    def poll(self):
+        """Execute the requests the shards handed back to the coordinator.
+
+        These are board requests, and notices of gives so that the
+        coordinator's board cache stays current.
+        """
+        import hey_fireball
+        while True:
+            if self._pending:
+                item = self._pending.popleft()
+            elif not self.results.empty():
+                item = self.results.get()
+            else:
+                break
+            tenant = self.tenants[item[1]]
+            if item[0] == 'message':
+                fireball_message = hey_fireball.extract_fireball_info(item[2], tenant)
+                if self.scheduler is not None:
+                    hey_fireball.schedule_command(self.scheduler, fireball_message)
+                else:
+                    hey_fireball.handle_command(fireball_message)
+            elif item[0] == 'given':
+                tenant.record_give(*item[2:])
+
+    def call(self, shard: int, op: Tuple):
+        """Send `op` to `shard` and wait for its reply.
+
+        ``op`` must end with the reply key, which is appended here.
+        """
+        key = next(self._keys)
+        self.inboxes[shard].put(op + (key,))
+        return self._wait(key)
+
+    def _wait(self, key: int):
+        while key not in self._replies:
+            item = self.results.get()
+            if item[0] == 'reply':
+                self._replies[item[1]] = item[2]
+            else:
+                # Keep shard requests for the next `poll`.
+                self._pending.append(item)
+        return self._replies.pop(key)
+
+    def sizes(self) -> Dict[str, int]:
+        """Return the number of replies and shard requests not yet handled."""
+        return {'replies held': len(self._replies), 'shard requests held': len(self._pending)}
+
+    def digest(self, tenant_name: str, kind: str) -> Dict:
+        """Return the `kind` digest merged over every shard."""
+        import digest
+        summaries = [self.call(shard, ('digest', tenant_name, kind))
+                     for shard in range(self.num_shards)]
+        return digest.merge_summaries(summaries, self.tenants[tenant_name].digests.k)
+
+    def transfer(self, tenant_name: str, requestor_id: str, target_id: str,
+                 count: int) -> bool:
+        """Give `count` points from requestor to target without a message."""
+        return self.call(shard_for(requestor_id, self.num_shards),
+                         ('transfer', tenant_name, requestor_id, target_id, count))
+
+
+class ShardedStorage(Storage):
+    """`Storage` used by the coordinator to reach users on their shard.
+
+    Each call is forwarded to the shard owning the user and waits for
+    the reply. Totals are gathered from every shard, each returning the
+    users it owns.
+    """
+
+    def __init__(self, router: ShardRouter, tenant_name: str):
+        super().__init__()
+        self._router = router
+        self._tenant_name = tenant_name
+
+    def _call(self, user_id: str, method: str, *args):
+        shard = shard_for(user_id, self._router.num_shards)
+        return self._router.call(shard, ('call', self._tenant_name, method, (user_id,) + args))
+
+    def get_user_points_used_total(self, user_id: str) -> int:
+        return self._call(user_id, 'get_user_points_used_total')
+
+    def get_user_points_used(self, user_id: str) -> int:
+        return self._call(user_id, 'get_user_points_used')
+
+    def add_user_points_used(self, user_id: str, num: int, currencies: Dict[str, int] = None):
+        self._call(user_id, 'add_user_points_used', num, currencies)
+
+    def get_user_points_received_total(self, user_id: str) -> int:
+        return self._call(user_id, 'get_user_points_received_total')
+
+    def get_user_points_received(self, user_id: str) -> int:
+        return self._call(user_id, 'get_user_points_received')
+
+    def add_user_points_received(self, user_id: str, num: int,
+                                 currencies: Dict[str, int] = None) -> int:
+        return self._call(user_id, 'add_user_points_received', num, currencies)
+
+    def get_user_currencies_used(self, user_id: str) -> Dict[str, int]:
+        return self._call(user_id, 'get_user_currencies_used')
+
+    def get_users_and_scores_total(self) -> List[Tuple[str, int]]:
+        """Return list of tuples (user_id, points_received_total) from all shards.
+
+        Each user is counted once, by its owner, even when the shards
+        share one table.
+        """
+        return self._gather('get_users_and_scores_total')
+
+    def _gather(self, method: str, *args, column: int = 0) -> List[Tuple]:
+        """Call `method` on every shard and concatenate the rows each shard owns.
+
+        ``column`` is the index of the user id in the rows.
+        """
+        rows = []
+        for shard in range(self._router.num_shards):
+            rows.extend(self._router.call(shard, ('gather', self._tenant_name, method, args, column)))
+        return rows
+
+    def add_channel_points_received(self, channel_id: str, user_id: str, num: int):
+        shard = shard_for(user_id, self._router.num_shards)
+        self._router.call(shard, ('call', self._tenant_name, 'add_channel_points_received',
+                                  (channel_id, user_id, num)))
+
+    def get_channel_users_and_scores(self, channel_id: str,
+                                     this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return list of tuples (user_id, points_received) in channel from all shards."""
+        return self._gather('get_channel_users_and_scores', channel_id, this_month)
+
+    def get_recent_leaders(self, k: int) -> List[Tuple[str, float]]:
+        """Return the `k` highest (user_id, recent score) over the top `k` of every shard."""
+        leaders = self._gather('get_recent_leaders', k)
+        return sorted(leaders, key=lambda tup: tup[1], reverse=True)[:k]
+
+    def get_currency_leaders(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        """Return the `k` highest (user_id, emoji received) over the top `k` of every shard."""
+        leaders = self._gather('get_currency_leaders', currency, k)
+        return sorted(leaders, key=lambda tup: tup[1], reverse=True)[:k]
+
+    def add_given_to(self, requestor_id: str, targets: Dict[str, int]):
+        self._call(requestor_id, 'add_given_to', targets)
+
+    def get_fans(self, user_id: str, k: int, this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return the `k` biggest fans of user over the top `k` of every shard.
+
+        A give is recorded on the giver's shard, which returns the fans it owns.
+        """
+        fans = self._gather('get_fans', user_id, k, this_month)
+        return sorted(fans, key=lambda tup: tup[1], reverse=True)[:k]
+
+    def get_top_pairs(self, k: int, this_month: bool = False) -> List[Tuple[str, str, int]]:
+        """Return the `k` pairs with the most points over the top `k` of every shard."""
+        pairs = self._gather('get_top_pairs', k, this_month)
+        return sorted(pairs, key=lambda tup: tup[2], reverse=True)[:k]
+
+    def get_daily_history(self, start) -> List[Tuple]:
+        """Return the daily records of every shard, (day, user_id, ...)."""
+        return self._gather('get_daily_history', start, column=1)
+
+    def get_pm_preference(self, user_id: str) -> int:
+        return self._call(user_id, 'get_pm_preference')
+
+    def set_pm_preference(self, user_id: str, pref: int):
+        self._call(user_id, 'set_pm_preference', pref)
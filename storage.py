@@ -13,22 +13,129 @@ the use of any appropriate storage mechanism (database,
 flat-file, etc.)
 """
 import os
+import json
+import time
 import datetime
+import threading
 
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Tuple
+
+# Same package imports
+import currency
+import decay
+import graph
+import reset
 
 #####################
 # API
 #####################
 
 
+# Most targets of one give: Azure writes them and the requestor in one
+# transaction of at most 100 entities.
+MAX_TARGETS = 99
+
+
+class ConflictError(Exception):
+    """A write kept losing to concurrent updates of the same records."""
+
+
 class Storage():
     """Class that defines how module storage functions 
     interact with a storage provider.
 
     Class is responsible for ensuring users exists when
     querying/updating user data.
+
+    Subclasses call `_points_received` and `_points_used` after every
+    change, so that listeners (see `add_listener`) see every give.
+
+    Daily counts reset at each user's local midnight, see `resets` and
+    `rollover`.
+
+    Points can be given in several currencies (see `currency`). The
+    points fields hold the weighted sum of every currency, and the
+    number of emoji of each currency is kept alongside, in the same
+    record.
     """
+
+    def __init__(self):
+        self._listeners = []
+        self.resets = reset.ResetSchedule()
+        # Currency of the points given without per currency counts.
+        self.default_currency = None
+
+    ### Listeners
+    def add_listener(self, listener):
+        """Tell `listener` about every change of points.
+
+        `listener` must have the methods ``points_received(user_id, num,
+        new_total)`` and ``points_used(user_id, num)``, e.g.
+        `digest.DigestAggregator`.
+        """
+        self._listeners.append(listener)
+
+    def _points_received(self, user_id: str, num: int, new_total: int):
+        for listener in self._listeners:
+            listener.points_received(user_id, num, new_total)
+
+    def _points_used(self, user_id: str, num: int):
+        for listener in self._listeners:
+            listener.points_used(user_id, num)
+
+    ### Daily reset
+    def set_user_offsets(self, offsets: Dict[str, int]):
+        """Set the UTC offset in seconds of users, a dict of user_id : offset."""
+        self.resets.set_offsets(offsets)
+
+    def rollover(self, now: int = None) -> int:
+        """Roll over the daily counts of the users whose local midnight passed.
+
+        Called regularly by the main loop, so that the rollover is not
+        done while answering a command. Return the number of users
+        rolled over.
+        """
+        due = self.resets.due(now)
+        if not due:
+            return 0
+        return self._rollover(set(due), self.resets.now() if now is None else now)
+
+    def _rollover(self, offsets: set, now: int) -> int:
+        """Roll over the expired users whose UTC offset is in `offsets`."""
+        return 0
+
+    ### Currencies
+    def set_default_currency(self, name: str):
+        """Set the currency of points given without per currency counts.
+
+        That is the workspace's main currency: points given before
+        currencies were stored, or with ``currencies=None``, count as
+        emoji of this currency.
+        """
+        self.default_currency = name
+
+    def _currency_counts(self, num: int, currencies: Dict[str, int] = None) -> Dict[str, int]:
+        """Return `currencies`, or `num` emoji of the default currency if None."""
+        if currencies is not None:
+            return currencies
+        return {self.default_currency: num} if self.default_currency else dict()
+
+    def get_user_currencies_used(self, user_id: str) -> Dict[str, int]:
+        """Return dictionary of currency : number of emoji used today."""
+        pass
+
+    def get_currency_leaders(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        """Return the `k` highest (user_id, emoji of `currency` received), highest first."""
+        pass
+
+    ### Diagnostics
+    def sizes(self) -> Dict[str, int]:
+        """Return the number of entries of every structure held in memory.
+
+        See `diagnostics`.
+        """
+        return dict()
+
     ### Points used
     def get_user_points_used_total(self, user_id: str) -> int:
         """Return total number of points used or 0."""
@@ -38,8 +145,13 @@ class Storage():
         """Return number of points used today or 0."""
         pass
 
-    def add_user_points_used(self, user_id: str, num: int):
-        """Add `num` to user's total and today's used points.""" 
+    def add_user_points_used(self, user_id: str, num: int, currencies: Dict[str, int] = None):
+        """Add `num` to user's total and today's used points.
+
+        `currencies` is a dictionary of currency : number of emoji used,
+        whose weighted sum is `num`. Defaults to `num` emoji of the
+        default currency.
+        """
         pass
 
     ### Points received
@@ -51,14 +163,128 @@ class Storage():
         """Return number of points received today or 0."""
         pass
 
-    def add_user_points_received(self, user_id: str, num: int):
-        """Add `num` to user's total and today's received points."""
+    def add_user_points_received(self, user_id: str, num: int,
+                                 currencies: Dict[str, int] = None) -> int:
+        """Add `num` to user's total and today's received points.
+
+        `currencies` is a dictionary of currency : number of emoji
+        received, see `add_user_points_used`. Return the user's new
+        total of points received.
+        """
         pass
 
     def get_users_and_scores_total(self) -> List[Tuple[str, int]]:
         """Return list of tuples (user_id, points_received_total)."""
         pass
 
+    ### Gives
+    def give_points(self, requestor_id: str, targets: Dict[str, int],
+                    channel_id: str = None, currencies: Dict[str, int] = None) -> Dict[str, int]:
+        """Add points to every target and their sum to requestor's used points.
+
+        Subclasses should override this to apply the whole give, whatever
+        the mix of currencies, in a single write. The caller is
+        responsible for checking that the requestor has enough points.
+
+        Parameters
+        ----------
+        requestor_id
+            User giving the points
+        targets
+            Dictionary of target_id : points to add
+        channel_id
+            Channel the points were given in, if known
+        currencies
+            Dictionary of currency : number of emoji received by every
+            target, whose weighted sum is the points of each target.
+            Defaults to the points of `targets` in the default currency.
+
+        Returns
+        -------
+        dict
+            Dictionary of target_id : new total of points received
+        """
+        new_totals = dict()
+        for target_id, num in targets.items():
+            new_totals[target_id] = self.add_user_points_received(target_id, num, currencies)
+            if channel_id is not None:
+                self.add_channel_points_received(channel_id, target_id, num)
+        self.add_user_points_used(requestor_id, sum(targets.values()),
+                                  self._currencies_used(targets, currencies))
+        self.add_given_to(requestor_id, targets)
+        return new_totals
+
+    @staticmethod
+    def _currencies_used(targets: Dict[str, int], currencies: Dict[str, int] = None) -> Dict[str, int]:
+        """Return the emoji used by a give of `currencies` to every target, or None."""
+        if currencies is None:
+            return None
+        return {name: count * len(targets) for name, count in currencies.items()}
+
+    ### Channels
+    def add_channel_points_received(self, channel_id: str, user_id: str, num: int):
+        """Add `num` to user's all time and this month's points received in channel."""
+        pass
+
+    def get_channel_users_and_scores(self, channel_id: str,
+                                     this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return list of tuples (user_id, points_received) in channel.
+
+        Scores are all time unless `this_month` is True.
+        """
+        pass
+
+    ### Recent scores
+    def get_recent_leaders(self, k: int) -> List[Tuple[str, float]]:
+        """Return the `k` highest (user_id, recent score), highest first.
+
+        Recent scores decay exponentially, see `decay`. They are updated
+        with the totals by `add_user_points_received` and `give_points`.
+        """
+        pass
+
+    ### Gives graph
+    def add_given_to(self, requestor_id: str, targets: Dict[str, int]):
+        """Record that requestor gave `targets`, a dict of target_id : points.
+
+        Done by `give_points`, and by the shards after a transfer. Feeds
+        today's given to counts and the graph of gives (see `graph`).
+        """
+        pass
+
+    def get_fans(self, user_id: str, k: int, this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return the `k` users who gave the most points to user, as (giver_id, points).
+
+        Points are all time unless `this_month` is True.
+        """
+        pass
+
+    def get_top_pairs(self, k: int, this_month: bool = False) -> List[Tuple[str, str, int]]:
+        """Return the `k` pairs with the most points, as (giver_id, target_id, points).
+
+        Points are all time unless `this_month` is True.
+        """
+        pass
+
+    ### History
+    def get_daily_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Return the daily records from `start` until yesterday.
+
+        Each record is a tuple (YYYY-MM-DD, user_id, points_received,
+        points_used, {target_id: points given}). Days without activity
+        may be missing.
+        """
+        pass
+
+    def compact_history(self, before: datetime.date) -> int:
+        """Fold the daily records of the oldest month before `before` into monthly rollups.
+
+        Called from a background thread, see `compaction`. Return the
+        number of daily records folded, 0 once no month is left. Storages
+        whose history does not grow with every day have nothing to fold.
+        """
+        return 0
+
     ### PM Preferences
     def get_pm_preference(self, user_id: str) -> int:
         """Return user's PM Preference"""
@@ -88,17 +314,62 @@ class AzureTableStorage(Storage):
         received today: points received
         given today: points given
         negative today: negative points received
+        given to today: JSON object of target : points given today
+        currency received total: JSON object of currency : emoji received
+        currency used today: JSON object of currency : emoji given today
+        day: user's local date (YYYY-MM-DD) of the daily counts
+        reset at: time (seconds since the epoch) of the user's next local
+            midnight, when the daily counts expire
+        recent points: decayed points received, as of recent updated
+        recent updated: time (seconds since the epoch) of the last change
+            to recent points
         pm preference: preference for private messages
 
     The records in the TOTAL partition contain the total and the daily total
     for each user. When data is retrieved from the table, the user's record
-    from the TOTAL partition is grabbed. The built in TIMESTAMP field is compared 
-    to today's date: if it matches, that record is used; if the date it old,
+    from the TOTAL partition is grabbed. The reset at field is compared
+    to the current time: if it is later, that record is used; if not,
     a copy of the record is added to the table in the date partition and 
     the record in the Total partition is updated with zeros for today's 
     counts.
     This approach allows all of a user's info to be grabbed/updated in a 
     single call to the table, not separate calls for Total and Today.
+    The counts of every currency are packed in the same record, so a give
+    mixing currencies reads and writes each user's record once. Records
+    written before the currency fields existed count all their points as
+    the default currency.
+
+    __Channel index__
+    PartitionKey: CHANNEL-<channel id>-ALL, or CHANNEL-<channel id>-YYYY-MM
+    RowKey: username
+    Fields:
+        received: points received in the channel
+
+    The channel partitions are updated on every give, so a channel
+    leaderboard is a query of a single partition.
+
+    __Monthly rollups__
+    PartitionKey: ROLLUP-YYYY-MM
+    RowKey: username
+    Fields:
+        days: JSON object of date : [received, used, {target : points given}]
+        points received: points received in the month
+        points used: points given in the month
+
+    A date partition holds one record per active user, so the table grows
+    with every day. `compact_history` folds the date partitions of old
+    months into one rollup per user and month, which keeps the daily
+    counts: the history read by `get_daily_history` is the same, from a
+    partition per month instead of one per day.
+
+    __Recent scores__
+    The recent points of every user are read once into a
+    `decay.DecayedIndex`, which is then kept up to date by this
+    instance's gives. Gives made by other processes sharing the table
+    appear after a restart. The per currency leaderboards are answered
+    the same way, from a `currency.CurrencyIndex`, and ``fans`` and
+    ``top pairs`` from a `graph.GiveGraph` read from the given to counts
+    of every day.
     """
 
     # Define field names
@@ -111,22 +382,68 @@ class AzureTableStorage(Storage):
     USERS_LIST = 'USERS_LIST'
     TOTAL_PARTITION = 'TOTAL'
     PM_PREFERENCE = 'PM_PREFERENCE'
+    GIVEN_TO_TODAY = 'GIVEN_TO_TODAY'
+    CURRENCY_RECEIVED_TOTAL = 'CURRENCY_RECEIVED_TOTAL'
+    CURRENCY_USED_TODAY = 'CURRENCY_USED_TODAY'
+    DAY = 'DAY'
+    RESET_AT = 'RESET_AT'
+    RECENT_POINTS = 'RECENT_POINTS'
+    RECENT_UPDATED = 'RECENT_UPDATED'
+    CHANNEL_PARTITION = 'CHANNEL-{channel}-{period}'
+    ALL_TIME = 'ALL'
+    CHANNEL_POINTS_RECEIVED = 'POINTS_RECEIVED'
+    ROLLUP_PARTITION = 'ROLLUP-{month}'
+    ROLLUP_DAYS = 'DAYS'
+    ROLLUP_POINTS_RECEIVED = 'POINTS_RECEIVED'
+    ROLLUP_POINTS_USED = 'POINTS_USED'
+    # Entities and payload bytes per entity group transaction. A
+    # transaction is capped at 4 MB, the rest is left for the framing
+    # of each operation (`BATCH_ENTITY_BYTES`).
+    BATCH_SIZE = 100
+    BATCH_BYTES = 3 * 2 ** 20
+    BATCH_ENTITY_BYTES = 1024
+    # Transactions tried per give before giving up on concurrent updates.
+    GIVE_ATTEMPTS = 3
 
-    def __init__(self):
+    def __init__(self, table_name: str = None, request_session=None,
+                 recent_half_life: float = decay.DEFAULT_HALF_LIFE):
+        """
+        Parameters
+        ----------
+        table_name
+            Name of the table, defaults to the TABLE_NAME env var.
+            Each workspace served by the bot uses its own table.
+        request_session
+            Optional ``requests.Session`` so that several instances
+            share one connection pool
+        recent_half_life
+            Days after which received points count half in the recent
+            scores
+        """
         super().__init__()
         # Check if azure library is installed.
         try:
             import azure.storage.table
         except ImportError:
             raise Exception('azure table storage package not installed!')
+        # The methods run on several threads (see `async_storage` and
+        # `compaction`): the lock guards the caches below.
+        self._lock = threading.RLock()
         self._users = None
+        self._recent = decay.DecayedIndex(recent_half_life)
+        self._recent_loaded = False
+        self._currencies = currency.CurrencyIndex()
+        self._currencies_loaded = False
+        self._graph = graph.GiveGraph()
+        self._graph_loaded = False
         self._account_name = os.environ.get("ACCOUNT_NAME")
         self._account_key = os.environ.get("ACCOUNT_KEY")
         self._account_sas = os.environ.get("ACCOUNT_SAS")
-        self._table_name = os.environ.get("TABLE_NAME")
+        self._table_name = table_name or os.environ.get("TABLE_NAME")
         self._table_service = azure.storage.table.TableService(account_name=self._account_name,
                                                                 account_key=self._account_key,
-                                                                sas_token=self._account_sas)
+                                                                sas_token=self._account_sas,
+                                                                request_session=request_session)
 
     ### Users
     def _create_user_entry(self, user_id: str):
@@ -140,6 +457,13 @@ class AzureTableStorage(Storage):
                                             self.POINTS_RECEIVED_TODAY: 0,
                                             self.POINTS_USED_TODAY: 0,
                                             self.NEGATIVE_POINTS_USED_TODAY: 0,
+                                            self.GIVEN_TO_TODAY: '{}',
+                                            self.CURRENCY_RECEIVED_TOTAL: '{}',
+                                            self.CURRENCY_USED_TODAY: '{}',
+                                            self.RECENT_POINTS: 0.0,
+                                            self.RECENT_UPDATED: 0.0,
+                                            self.DAY: self.resets.today(user_id).strftime('%Y-%m-%d'),
+                                            self.RESET_AT: self.resets.next_reset(user_id),
                                             self.PM_PREFERENCE: 1})
         self._users.add(user_id)
 
@@ -155,8 +479,9 @@ class AzureTableStorage(Storage):
 
     def _check_user(self, user_id: str):
         """Check if user exists in storage and create a new entry if not."""
-        if not self._user_exists(user_id):
-            self._create_user_entry(user_id)
+        with self._lock:
+            if not self._user_exists(user_id):
+                self._create_user_entry(user_id)
 
     ### Total/current record
     def _move_user_to_new_day(self, user_id: str):
@@ -182,10 +507,108 @@ class AzureTableStorage(Storage):
                     'RowKey': total_record['RowKey'],
                     self.POINTS_RECEIVED_TODAY: 0,
                     self.POINTS_USED_TODAY: 0,
-                    self.NEGATIVE_POINTS_USED_TODAY: 0}
+                    self.NEGATIVE_POINTS_USED_TODAY: 0,
+                    self.GIVEN_TO_TODAY: '{}',
+                    self.CURRENCY_USED_TODAY: '{}'}
+        record.update(self._day_fields(total_record['RowKey']))
         # Merge with existing Total partition record. 
         self._table_service.merge_entity(self._table_name, record)
 
+    def _day_fields(self, user_id: str) -> dict:
+        """Return the day and reset at fields of a record starting the user's day now."""
+        return {self.DAY: self.resets.today(user_id).strftime('%Y-%m-%d'),
+                self.RESET_AT: self.resets.next_reset(user_id)}
+
+    def _is_current(self, record: dict) -> bool:
+        """Return True if the daily counts of a Total `record` are from the user's current day."""
+        reset_at = record.get(self.RESET_AT)
+        if reset_at is None:
+            # Written before reset times were stored: compare the time of
+            # the last change with the user's last midnight.
+            last_reset = self.resets.next_reset(record['RowKey']) - reset.DAY
+            return record['Timestamp'].timestamp() >= last_reset
+        return self.resets.now() < reset_at
+
+    def _rollover(self, offsets: set, now: int) -> int:
+        """Move the expired users whose UTC offset is in `offsets` to a new day.
+
+        Users without daily counts are left alone, they are moved when
+        they are next read.
+        """
+        filter_query = "PartitionKey eq '{}'".format(self.TOTAL_PARTITION)
+        select_query = "RowKey,{},{},{}".format(self.POINTS_RECEIVED_TODAY,
+                                                self.POINTS_USED_TODAY,
+                                                self.RESET_AT)
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter=filter_query,
+                                                     select=select_query)
+        expired = [r['RowKey'] for r in records
+                   if (r.get(self.POINTS_RECEIVED_TODAY) or r.get(self.POINTS_USED_TODAY)) and
+                   (r.get(self.RESET_AT) or 0) <= now and
+                   self.resets.offset(r['RowKey']) in offsets]
+        for user_id in expired:
+            self._move_user_to_new_day(user_id)
+        # Only this month's gives graph is ever read.
+        with self._lock:
+            self._graph.drop_periods([self._get_today().strftime('%Y-%m')])
+        return len(expired)
+
+    ### Currencies
+    def _get_currencies(self, record: dict, field: str, legacy_field: str) -> Dict[str, int]:
+        """Return the per currency counts packed in `field` of a Total `record`.
+
+        Records written before the currency fields existed count the
+        points of `legacy_field` as the default currency.
+        """
+        packed = record.get(field)
+        if packed is not None:
+            return json.loads(packed)
+        return self._currency_counts(record.get(legacy_field) or 0)
+
+    def _add_currencies(self, record: dict, field: str, legacy_field: str,
+                        counts: Dict[str, int]) -> Dict[str, int]:
+        """Add `counts` to `field` of a Total `record` being written and return the new counts.
+
+        Must be called before `legacy_field` is updated.
+        """
+        packed = self._get_currencies(record, field, legacy_field)
+        for name, count in counts.items():
+            packed[name] = packed.get(name, 0) + count
+        record[field] = json.dumps(packed)
+        return packed
+
+    def get_user_currencies_used(self, user_id: str) -> Dict[str, int]:
+        """Return dictionary of currency : number of emoji used today."""
+        self._check_user(user_id)
+        select_query = "PartitionKey,RowKey,Timestamp,{},{},{}".format(self.POINTS_USED_TODAY,
+                                                self.CURRENCY_USED_TODAY,
+                                                self.RESET_AT)
+        record = self._table_service.get_entity(self._table_name,
+                                                partition_key=self.TOTAL_PARTITION,
+                                                row_key=user_id,
+                                                select=select_query)
+        if not self._is_current(record):
+            # This record is from a previous day, so need to update table.
+            self._move_user_to_new_day(user_id)
+            return dict()
+        return self._get_currencies(record, self.CURRENCY_USED_TODAY, self.POINTS_USED_TODAY)
+
+    def get_currency_leaders(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        """Return the `k` highest (user_id, emoji of `currency` received), highest first."""
+        with self._lock:
+            if not self._currencies_loaded:
+                filter_query = "PartitionKey eq '{}'".format(self.TOTAL_PARTITION)
+                select_query = "RowKey,{},{}".format(self.CURRENCY_RECEIVED_TOTAL,
+                                                     self.POINTS_RECEIVED_TOTAL)
+                records = self._table_service.query_entities(self._table_name,
+                                                             filter=filter_query,
+                                                             select=select_query)
+                self._currencies.load({r['RowKey']: self._get_currencies(r, self.CURRENCY_RECEIVED_TOTAL,
+                                                                         self.POINTS_RECEIVED_TOTAL)
+                                       for r in records})
+                self._currencies_loaded = True
+            return self._currencies.top(currency, k)
+
     ### POINTS Used
     def get_user_points_used_total(self, user_id: str) -> int:
         """Return total number of points used or 0.
@@ -203,12 +626,13 @@ class AzureTableStorage(Storage):
     def get_user_points_used(self, user_id: str) -> int:
         """Return number of points used today or 0."""
         self._check_user(user_id)
-        select_query = "PartitionKey,RowKey,Timestamp,{}".format(self.POINTS_USED_TODAY)
+        select_query = "PartitionKey,RowKey,Timestamp,{},{}".format(self.POINTS_USED_TODAY,
+                                                self.RESET_AT)
         record = self._table_service.get_entity(self._table_name,
                                                 partition_key=self.TOTAL_PARTITION,
                                                 row_key=user_id,
                                                 select=select_query)
-        if not self._check_date(record['Timestamp']):
+        if not self._is_current(record):
             # This record is from a previous day, so need to update table.
             self._move_user_to_new_day(user_id)
             # Since the Total partition was old, the are no points for today.
@@ -217,23 +641,29 @@ class AzureTableStorage(Storage):
             # The record is current, so return value.
             return record[self.POINTS_USED_TODAY]
 
-    def add_user_points_used(self, user_id: str, num: int):
+    def add_user_points_used(self, user_id: str, num: int, currencies: Dict[str, int] = None):
         """Add `num` to user's total and daily used points."""
         self._check_user(user_id)
-        select_query = "PartitionKey,RowKey,Timestamp,{},{}".format(self.POINTS_USED_TODAY,
-                                                self.POINTS_USED_TOTAL)
+        counts = self._currency_counts(num, currencies)
+        select_query = "PartitionKey,RowKey,Timestamp,{},{},{},{}".format(self.POINTS_USED_TODAY,
+                                                self.POINTS_USED_TOTAL,
+                                                self.CURRENCY_USED_TODAY,
+                                                self.RESET_AT)
         record = self._table_service.get_entity(self._table_name,
                                                 partition_key=self.TOTAL_PARTITION,
                                                 row_key=user_id,
                                                 select=select_query)
         del record['etag']
-        if not self._check_date(record['Timestamp']):
+        if not self._is_current(record):
             # This record is from a previous day, so need to update table.
             self._move_user_to_new_day(user_id)
+            record.update(self._day_fields(user_id))
             # Since the record was old, there are 0 Daily points.
-            record[self.POINTS_USED_TOTAL] = num    
+            record[self.POINTS_USED_TODAY] = num
+            record[self.CURRENCY_USED_TODAY] = json.dumps(counts)
         else:
             # The record is current, so update Daily count.
+            self._add_currencies(record, self.CURRENCY_USED_TODAY, self.POINTS_USED_TODAY, counts)
             record[self.POINTS_USED_TODAY] += num
         # Add num to Total count.
         record[self.POINTS_USED_TOTAL] += num
@@ -242,6 +672,7 @@ class AzureTableStorage(Storage):
         # # Add RowKey
         # record['RowKey'] = user_id
         self._table_service.merge_entity(self._table_name, record)
+        self._points_used(user_id, num)
 
     def get_user_points_received_total(self, user_id: str) -> int:
         """Return total number of points received or 0."""
@@ -256,12 +687,13 @@ class AzureTableStorage(Storage):
     def get_user_points_received(self, user_id: str) -> int:
         """Return number of points received or 0."""
         self._check_user(user_id)
-        select_query = "PartitionKey,RowKey,Timestamp,{}".format(self.POINTS_RECEIVED_TODAY)
+        select_query = "PartitionKey,RowKey,Timestamp,{},{}".format(self.POINTS_RECEIVED_TODAY,
+                                                self.RESET_AT)
         record = self._table_service.get_entity(self._table_name,
                                                 partition_key=self.TOTAL_PARTITION,
                                                 row_key=user_id,
                                                 select=select_query)
-        if not self._check_date(record['Timestamp']):
+        if not self._is_current(record):
             # This record is from a previous day, so need to update table.
             self._move_user_to_new_day(user_id)
             # Since the Total partition was old, the are no points for today.
@@ -270,19 +702,27 @@ class AzureTableStorage(Storage):
             # The record is current, so return value.
             return record[self.POINTS_RECEIVED_TODAY]
 
-    def add_user_points_received(self, user_id: str, num: int):
-        """Add `num` to user's total received points."""
+    def add_user_points_received(self, user_id: str, num: int,
+                                 currencies: Dict[str, int] = None) -> int:
+        """Add `num` to user's total received points and return the new total."""
         self._check_user(user_id)
-        select_query = "PartitionKey,RowKey,Timestamp,{},{}".format(self.POINTS_RECEIVED_TODAY,
-                                                self.POINTS_RECEIVED_TOTAL)
+        select_query = "PartitionKey,RowKey,Timestamp,{},{},{},{},{},{}".format(self.POINTS_RECEIVED_TODAY,
+                                                self.POINTS_RECEIVED_TOTAL,
+                                                self.CURRENCY_RECEIVED_TOTAL,
+                                                self.RECENT_POINTS,
+                                                self.RECENT_UPDATED,
+                                                self.RESET_AT)
         record = self._table_service.get_entity(self._table_name,
                                                 partition_key=self.TOTAL_PARTITION,
                                                 row_key=user_id,
                                                 select=select_query)
         del record['etag']
-        if not self._check_date(record['Timestamp']):
+        self._add_recent_points(record, num)
+        self._add_received_currencies(record, num, currencies)
+        if not self._is_current(record):
             # This record is from a previous day, so need to update table.
             self._move_user_to_new_day(user_id)
+            record.update(self._day_fields(user_id))
             # Since the record was old, there are 0 Daily points.
             record[self.POINTS_RECEIVED_TODAY] = num
         else:
@@ -291,6 +731,8 @@ class AzureTableStorage(Storage):
         # Add num to Total count.
         record[self.POINTS_RECEIVED_TOTAL] += num
         self._table_service.merge_entity(self._table_name, record)
+        self._points_received(user_id, num, record[self.POINTS_RECEIVED_TOTAL])
+        return record[self.POINTS_RECEIVED_TOTAL]
 
     def get_users_and_scores_total(self) -> List[Tuple[str, int]]:
         """Return list of tuples (user_id, points_received_total)."""
@@ -301,6 +743,433 @@ class AzureTableStorage(Storage):
                                                      select=select_query)
         return [(r['RowKey'], r[self.POINTS_RECEIVED_TOTAL]) for r in records]
 
+    ### Gives
+    def _get_total_records(self, user_ids: List[str]) -> Dict[str, dict]:
+        """Return the Total records of `user_ids` using a single query."""
+        rows = ' or '.join("RowKey eq '{}'".format(u.replace("'", "''")) for u in user_ids)
+        filter_query = "PartitionKey eq '{}' and ({})".format(self.TOTAL_PARTITION, rows)
+        select_query = "PartitionKey,RowKey,Timestamp,{},{},{},{},{},{},{},{},{},{}".format(self.POINTS_USED_TODAY,
+                                                self.POINTS_USED_TOTAL,
+                                                self.POINTS_RECEIVED_TODAY,
+                                                self.POINTS_RECEIVED_TOTAL,
+                                                self.GIVEN_TO_TODAY,
+                                                self.CURRENCY_RECEIVED_TOTAL,
+                                                self.CURRENCY_USED_TODAY,
+                                                self.RECENT_POINTS,
+                                                self.RECENT_UPDATED,
+                                                self.RESET_AT)
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter=filter_query,
+                                                     select=select_query)
+        return {r['RowKey']: r for r in records}
+
+    def give_points(self, requestor_id: str, targets: Dict[str, int],
+                    channel_id: str = None, currencies: Dict[str, int] = None) -> Dict[str, int]:
+        """Add points to every target and their sum to requestor's used points.
+
+        The records of the requestor and every target, holding the counts
+        of every currency, are read with one query and written back in one
+        entity group transaction on the Total partition. Each entity is merged only if its etag is
+        unchanged, so a concurrent update makes the transaction fail
+        instead of losing points; the give is then read and written again,
+        up to `GIVE_ATTEMPTS` times before raising `ConflictError`. A
+        transaction holds at most `BATCH_SIZE` entities, which caps the
+        number of targets at `MAX_TARGETS`; more raise ValueError.
+        """
+        user_ids = set(targets) | {requestor_id}
+        if len(user_ids) > self.BATCH_SIZE:
+            raise ValueError(f'A give has at most {MAX_TARGETS} targets.')
+        for user_id in user_ids:
+            self._check_user(user_id)
+        for _ in range(self.GIVE_ATTEMPTS):
+            new_totals = self._try_give_points(requestor_id, targets, currencies)
+            if new_totals is not None:
+                break
+        else:
+            raise ConflictError(f'Give by {requestor_id} conflicted {self.GIVE_ATTEMPTS} times.')
+        with self._lock:
+            if self._graph_loaded:
+                self._graph.add(requestor_id, targets, self._get_today().strftime('%Y-%m'))
+        for target_id, num in targets.items():
+            self._points_received(target_id, num, new_totals[target_id])
+        self._points_used(requestor_id, sum(targets.values()))
+        if channel_id is not None:
+            # Channel partitions can't join the Total partition's transaction.
+            for target_id, num in targets.items():
+                self.add_channel_points_received(channel_id, target_id, num)
+        return new_totals
+
+    def _try_give_points(self, requestor_id: str, targets: Dict[str, int],
+                         currencies: Dict[str, int] = None) -> Dict[str, int]:
+        """Apply a give in one transaction, return None if a record changed since read."""
+        from azure.common import AzureHttpError
+        from azure.storage.table import TableBatch
+        user_ids = set(targets) | {requestor_id}
+        records = self._get_total_records(user_ids)
+        stale = [user_id for user_id, record in records.items()
+                 if not self._is_current(record)]
+        if stale:
+            # Rare: archive yesterday's counts first, then re-read.
+            for user_id in stale:
+                self._move_user_to_new_day(user_id)
+            records.update(self._get_total_records(stale))
+        new_totals = dict()
+        batch = TableBatch()
+        for user_id, record in records.items():
+            etag = record.pop('etag')
+            del record['Timestamp']
+            if user_id == requestor_id:
+                used = sum(targets.values())
+                self._add_currencies(record, self.CURRENCY_USED_TODAY, self.POINTS_USED_TODAY,
+                                     self._currency_counts(used, self._currencies_used(targets, currencies)))
+                record[self.POINTS_USED_TODAY] += used
+                record[self.POINTS_USED_TOTAL] += used
+                given_to = json.loads(record.get(self.GIVEN_TO_TODAY) or '{}')
+                for target_id, num in targets.items():
+                    given_to[target_id] = given_to.get(target_id, 0) + num
+                record[self.GIVEN_TO_TODAY] = json.dumps(given_to)
+            if user_id in targets:
+                self._add_received_currencies(record, targets[user_id], currencies)
+                record[self.POINTS_RECEIVED_TODAY] += targets[user_id]
+                record[self.POINTS_RECEIVED_TOTAL] += targets[user_id]
+                self._add_recent_points(record, targets[user_id])
+                new_totals[user_id] = record[self.POINTS_RECEIVED_TOTAL]
+            batch.merge_entity(record, if_match=etag)
+        try:
+            self._table_service.commit_batch(self._table_name, batch)
+        except AzureHttpError as e:
+            if e.status_code == 412:
+                return None
+            raise
+        return new_totals
+
+    ### Recent scores
+    def _add_recent_points(self, record: dict, num: int):
+        """Add `num` to the recent points of a Total `record` being written."""
+        value, updated = decay.add(record.get(self.RECENT_POINTS) or 0.0,
+                                   record.get(self.RECENT_UPDATED) or 0.0,
+                                   num, time.time(), self._recent.rate)
+        record[self.RECENT_POINTS] = value
+        record[self.RECENT_UPDATED] = updated
+        with self._lock:
+            if self._recent_loaded:
+                self._recent.update(record['RowKey'], value, updated)
+
+    def _add_received_currencies(self, record: dict, num: int, currencies: Dict[str, int] = None):
+        """Add the emoji received to a Total `record` being written, before its points."""
+        counts = self._currency_counts(num, currencies)
+        received = self._add_currencies(record, self.CURRENCY_RECEIVED_TOTAL,
+                                        self.POINTS_RECEIVED_TOTAL, counts)
+        with self._lock:
+            if self._currencies_loaded:
+                self._currencies.update(record['RowKey'], {name: received[name] for name in counts})
+
+    def get_recent_leaders(self, k: int) -> List[Tuple[str, float]]:
+        """Return the `k` highest (user_id, recent score), highest first."""
+        with self._lock:
+            if not self._recent_loaded:
+                filter_query = "PartitionKey eq '{}'".format(self.TOTAL_PARTITION)
+                select_query = "RowKey,{},{}".format(self.RECENT_POINTS, self.RECENT_UPDATED)
+                records = self._table_service.query_entities(self._table_name,
+                                                             filter=filter_query,
+                                                             select=select_query)
+                self._recent.load({r['RowKey']: (r.get(self.RECENT_POINTS) or 0.0,
+                                                 r.get(self.RECENT_UPDATED) or 0.0)
+                                   for r in records})
+                self._recent_loaded = True
+            return self._recent.top(k)
+
+    def sizes(self) -> Dict[str, int]:
+        with self._lock:
+            return {'users cached': len(self._users or ()), 'recent index': len(self._recent),
+                    'currency index': len(self._currencies), 'graph edges': len(self._graph)}
+
+    ### Gives graph
+    def add_given_to(self, requestor_id: str, targets: Dict[str, int]):
+        """Record that requestor gave `targets`, a dict of target_id : points.
+
+        `give_points` writes the given to counts in its own transaction,
+        this is for points debited on their own (see `sharding`).
+        """
+        self._check_user(requestor_id)
+        select_query = "PartitionKey,RowKey,Timestamp,{},{}".format(self.GIVEN_TO_TODAY,
+                                                                    self.RESET_AT)
+        record = self._table_service.get_entity(self._table_name,
+                                                partition_key=self.TOTAL_PARTITION,
+                                                row_key=requestor_id,
+                                                select=select_query)
+        del record['etag']
+        if not self._is_current(record):
+            # This record is from a previous day, so need to update table.
+            self._move_user_to_new_day(requestor_id)
+            record.update(self._day_fields(requestor_id))
+            given_to = dict()
+        else:
+            given_to = json.loads(record.get(self.GIVEN_TO_TODAY) or '{}')
+        for target_id, num in targets.items():
+            given_to[target_id] = given_to.get(target_id, 0) + num
+        record[self.GIVEN_TO_TODAY] = json.dumps(given_to)
+        self._table_service.merge_entity(self._table_name, record)
+        with self._lock:
+            if self._graph_loaded:
+                self._graph.add(requestor_id, targets, self._get_today().strftime('%Y-%m'))
+
+    def _load_graph(self):
+        """Read the graph of gives from the given to counts of every day, once.
+
+        Called with the lock held.
+        """
+        if self._graph_loaded:
+            return
+        select_query = "PartitionKey,RowKey,Timestamp,{},{}".format(self.GIVEN_TO_TODAY, self.DAY)
+        # Every date partition: the names of the other partitions start with a letter.
+        filter_query = "PartitionKey ge '0' and PartitionKey lt 'A'"
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter=filter_query,
+                                                     select=select_query)
+        archived = {(r['PartitionKey'], r['RowKey']): json.loads(r.get(self.GIVEN_TO_TODAY) or '{}')
+                    for r in records}
+        # Older months are folded into rollups, see `compact_history`.
+        rolled_up = {(r[0], r[1]): r[4] for r in self._get_rolled_up_history(datetime.date(1970, 1, 1))}
+        rolled_up.update(archived)
+        gives = [(day, user_id, given_to) for (day, user_id), given_to in rolled_up.items()]
+        # The Total partition holds the days not archived yet, today included.
+        filter_query = "PartitionKey eq '{}'".format(self.TOTAL_PARTITION)
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter=filter_query,
+                                                     select=select_query)
+        gives.extend((self._get_record_date(r), r['RowKey'],
+                      json.loads(r.get(self.GIVEN_TO_TODAY) or '{}'))
+                     for r in records)
+        self._graph.load(gives)
+        self._graph.drop_periods([self._get_today().strftime('%Y-%m')])
+        self._graph_loaded = True
+
+    def get_fans(self, user_id: str, k: int, this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return the `k` users who gave the most points to user, as (giver_id, points).
+
+        The graph is read from the table once and then kept up to date by
+        this instance's gives, like the recent scores.
+        """
+        period = self._get_today().strftime('%Y-%m') if this_month else self.ALL_TIME
+        with self._lock:
+            self._load_graph()
+            return self._graph.fans(user_id, k, period)
+
+    def get_top_pairs(self, k: int, this_month: bool = False) -> List[Tuple[str, str, int]]:
+        """Return the `k` pairs with the most points, as (giver_id, target_id, points)."""
+        period = self._get_today().strftime('%Y-%m') if this_month else self.ALL_TIME
+        with self._lock:
+            self._load_graph()
+            return self._graph.top_pairs(k, period)
+
+    ### Channels
+    def add_channel_points_received(self, channel_id: str, user_id: str, num: int):
+        """Add `num` to user's all time and this month's points received in channel."""
+        from azure.common import AzureMissingResourceHttpError
+        for period in (self.ALL_TIME, self._get_today().strftime('%Y-%m')):
+            partition = self.CHANNEL_PARTITION.format(channel=channel_id, period=period)
+            try:
+                record = self._table_service.get_entity(self._table_name,
+                                                        partition_key=partition,
+                                                        row_key=user_id,
+                                                        select=self.CHANNEL_POINTS_RECEIVED)
+                score = record[self.CHANNEL_POINTS_RECEIVED]
+            except AzureMissingResourceHttpError:
+                score = 0
+            self._table_service.insert_or_merge_entity(self._table_name,
+                                                       {'PartitionKey': partition,
+                                                        'RowKey': user_id,
+                                                        self.CHANNEL_POINTS_RECEIVED: score + num})
+
+    def get_channel_users_and_scores(self, channel_id: str,
+                                     this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return list of tuples (user_id, points_received) in channel."""
+        period = self._get_today().strftime('%Y-%m') if this_month else self.ALL_TIME
+        partition = self.CHANNEL_PARTITION.format(channel=channel_id, period=period)
+        filter_query = "PartitionKey eq '{}'".format(partition)
+        select_query = "RowKey,{}".format(self.CHANNEL_POINTS_RECEIVED)
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter=filter_query,
+                                                     select=select_query)
+        return [(r['RowKey'], r[self.CHANNEL_POINTS_RECEIVED]) for r in records]
+
+    ### History
+    _HISTORY_FIELDS = "PartitionKey,RowKey,Timestamp,{},{},{},{},{}".format(POINTS_RECEIVED_TODAY,
+                                                                           POINTS_USED_TODAY,
+                                                                           GIVEN_TO_TODAY,
+                                                                           DAY,
+                                                                           RESET_AT)
+
+    def get_daily_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Return the daily records from `start` until yesterday.
+
+        The date partitions and the monthly rollups in the range are read
+        with one query each. Total records that have not been moved to
+        their date partition yet (users inactive since) are included too.
+        """
+        return self._merge_history(self._get_rolled_up_history(start),
+                                   self._get_archived_history(start),
+                                   self._get_pending_history(start))
+
+    @staticmethod
+    def _merge_history(rolled_up: List[Tuple], archived: List[Tuple],
+                       pending: List[Tuple]) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Return the history of the three sources, each day of a user once.
+
+        While a month is compacted, its days can be both in a rollup and
+        in their date partition.
+        """
+        history = {(r[0], r[1]): r for r in rolled_up}
+        history.update(((r[0], r[1]), r) for r in archived)
+        return list(history.values()) + pending
+
+    def _get_archived_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Return the records of the date partitions from `start` until yesterday."""
+        filter_query = "PartitionKey ge '{}' and PartitionKey lt '{}'".format(
+            start.strftime('%Y-%m-%d'), self._get_today_str())
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter=filter_query,
+                                                     select=self._HISTORY_FIELDS)
+        return [self._history_record(r) for r in records]
+
+    def _get_pending_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Return the stale daily counts of the Total partition since `start`."""
+        filter_query = "PartitionKey eq '{}'".format(self.TOTAL_PARTITION)
+        records = []
+        for record in self._table_service.query_entities(self._table_name,
+                                                         filter=filter_query,
+                                                         select=self._HISTORY_FIELDS):
+            if (not self._is_current(record) and
+                    self._get_record_date(record) >= start.strftime('%Y-%m-%d')):
+                record['PartitionKey'] = self._get_record_date(record)
+                records.append(self._history_record(record))
+        return records
+
+    def _get_rolled_up_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Return the records of the monthly rollups from `start` until yesterday."""
+        filter_query = "PartitionKey ge '{}' and PartitionKey lt '{}'".format(
+            self.ROLLUP_PARTITION.format(month=start.strftime('%Y-%m')),
+            self.ROLLUP_PARTITION.format(month='9'))
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter=filter_query,
+                                                     select='PartitionKey,RowKey,' + self.ROLLUP_DAYS)
+        start, today = start.strftime('%Y-%m-%d'), self._get_today_str()
+        return [(day, r['RowKey'], received, used, given_to)
+                for r in records
+                for day, (received, used, given_to) in json.loads(r[self.ROLLUP_DAYS]).items()
+                if start <= day < today]
+
+    def _history_record(self, r: dict) -> Tuple[str, str, int, int, Dict[str, int]]:
+        return (r['PartitionKey'], r['RowKey'], r[self.POINTS_RECEIVED_TODAY],
+                r[self.POINTS_USED_TODAY], json.loads(r.get(self.GIVEN_TO_TODAY) or '{}'))
+
+    ### Compaction
+    def compact_history(self, before: datetime.date) -> int:
+        """Fold the date partitions of the oldest month before `before` into monthly rollups.
+
+        `before` should be the first day of a month, so that only whole
+        months are folded. The steps are:
+
+        1. read the month's date partitions, and its rollups if any,
+        2. write one rollup per user, in batches of at most
+           `BATCH_SIZE` entities and `BATCH_BYTES` bytes,
+        3. read the rollups back and check that they hold every daily
+           record and that their totals match,
+        4. delete the daily records, in batches per date partition.
+
+        A day is set in a rollup, never added, so a run interrupted at
+        any step is completed by the next one without counting a day
+        twice; records archived late into a folded month are folded by
+        the next run too. If the check fails nothing is deleted and a
+        RuntimeError is raised.
+        """
+        from azure.storage.table import TableBatch
+        # The oldest date partition tells the month to fold.
+        filter_query = "PartitionKey ge '0' and PartitionKey lt '{}'".format(before.strftime('%Y-%m-%d'))
+        oldest = list(self._table_service.query_entities(self._table_name,
+                                                         filter=filter_query,
+                                                         select='PartitionKey',
+                                                         num_results=1))
+        if not oldest:
+            return 0
+        month = oldest[0]['PartitionKey'][:7]
+        filter_query = "PartitionKey ge '{0}-01' and PartitionKey le '{0}-31'".format(month)
+        daily = list(self._table_service.query_entities(self._table_name,
+                                                        filter=filter_query,
+                                                        select=self._HISTORY_FIELDS))
+        partition = self.ROLLUP_PARTITION.format(month=month)
+        rollups = self._get_rollups(partition)
+        for r in daily:
+            _, user_id, received, used, given_to = self._history_record(r)
+            rollups.setdefault(user_id, dict())[r['PartitionKey']] = [received, used, given_to]
+        entities = []
+        for user_id in sorted({r['RowKey'] for r in daily}):
+            days = rollups[user_id]
+            entities.append({'PartitionKey': partition,
+                             'RowKey': user_id,
+                             self.ROLLUP_DAYS: json.dumps(days, separators=(',', ':')),
+                             self.ROLLUP_POINTS_RECEIVED: sum(day[0] for day in days.values()),
+                             self.ROLLUP_POINTS_USED: sum(day[1] for day in days.values())})
+        for entities in self._batches(entities):
+            batch = TableBatch()
+            for entity in entities:
+                batch.insert_or_replace_entity(entity)
+            self._table_service.commit_batch(self._table_name, batch)
+        # Check what was written before deleting the source records.
+        written = self._get_rollups(partition, totals=True)
+        for r in daily:
+            days, received, used = written.get(r['RowKey'], (dict(), None, None))
+            if (days.get(r['PartitionKey']) != list(self._history_record(r)[2:]) or
+                    received != sum(day[0] for day in days.values()) or
+                    used != sum(day[1] for day in days.values())):
+                raise RuntimeError(f'Rollup of {r["RowKey"]} for {month} does not match '
+                                   f'{r["PartitionKey"]}, daily records kept.')
+        by_day = dict()
+        for r in daily:
+            by_day.setdefault(r['PartitionKey'], []).append(r)
+        for day, records in by_day.items():
+            for records in self._batches(records):
+                batch = TableBatch()
+                for r in records:
+                    batch.delete_entity(day, r['RowKey'], if_match=r['etag'])
+                self._table_service.commit_batch(self._table_name, batch)
+        return len(daily)
+
+    def _batches(self, entities: List[dict]) -> Iterator[List[dict]]:
+        """Split `entities` of one partition into entity group transactions.
+
+        Each batch holds at most `BATCH_SIZE` entities and `BATCH_BYTES`
+        bytes of their JSON, with `BATCH_ENTITY_BYTES` added per entity.
+        A single entity is written on its own whatever its size.
+        """
+        batch, size = [], 0
+        for entity in entities:
+            entity_size = len(json.dumps(entity, default=str)) + self.BATCH_ENTITY_BYTES
+            if batch and (len(batch) == self.BATCH_SIZE or size + entity_size > self.BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(entity)
+            size += entity_size
+        if batch:
+            yield batch
+
+    def _get_rollups(self, partition: str, totals: bool = False) -> Dict[str, object]:
+        """Return the rollups of a month, user_id : days.
+
+        With `totals`, user_id : (days, points received, points used).
+        """
+        select_query = "RowKey,{},{},{}".format(self.ROLLUP_DAYS, self.ROLLUP_POINTS_RECEIVED,
+                                                self.ROLLUP_POINTS_USED)
+        records = self._table_service.query_entities(self._table_name,
+                                                     filter="PartitionKey eq '{}'".format(partition),
+                                                     select=select_query)
+        if totals:
+            return {r['RowKey']: (json.loads(r[self.ROLLUP_DAYS]), r[self.ROLLUP_POINTS_RECEIVED],
+                                  r[self.ROLLUP_POINTS_USED])
+                    for r in records}
+        return {r['RowKey']: json.loads(r[self.ROLLUP_DAYS]) for r in records}
+
     def set_pm_preference(self, user_id: str, pref: int):
         """Set the user's PM Preference"""
         self._check_user(user_id)
@@ -326,32 +1195,40 @@ class AzureTableStorage(Storage):
                                                 select=select_query)
         return record[self.PM_PREFERENCE]
 
-    @staticmethod
-    def _get_today() -> datetime.date:
-        """Return today's date as a string YYYY-MM-DD."""
-        return datetime.datetime.today() + datetime.timedelta(hours=6)
+    def _get_today(self) -> datetime.date:
+        """Return the server's date, see `reset.ResetSchedule.today`."""
+        return self.resets.today()
 
-    @staticmethod
-    def _get_today_str() -> str:
+    def _get_today_str(self) -> str:
         """Return today's date as a string YYYY-MM-DD."""
-        return AzureTableStorage._get_today().strftime('%Y-%m-%d')
+        return self._get_today().strftime('%Y-%m-%d')
 
     @staticmethod
-    def _get_record_date(record: dict) -> datetime.date:
-        """Retrieves the TZ aware date from Azure Table entity in UTC."""
-        return record['Timestamp'].date().strftime('%Y-%m-%d')
+    def _get_record_date(record: dict) -> str:
+        """Return the user's local date (YYYY-MM-DD) of the daily counts of a record.
 
-    @staticmethod
-    def _check_date(ts: datetime.datetime) -> bool:
-        """Return True if date is today.
-        
-        # TODO: Currently working in UTC and not accunting for TZ.
+        Records written before the day field was stored use the UTC date
+        of their last change.
         """
-        return ts.date() == AzureTableStorage._get_today().date()
+        return record.get(AzureTableStorage.DAY) or record['Timestamp'].date().strftime('%Y-%m-%d')
 
 
 class InMemoryStorage(Storage):
     """Implementation of `Storage` that uses a dict in memory.
+
+    Parameters
+    ----------
+    recent_half_life
+        Days after which received points count half in the recent scores
+    history_days
+        Days of daily records kept for `get_daily_history`, older ones
+        are dropped at rollover
+
+    The channel scores and gives graph of past months are dropped at
+    rollover too, and the gives of the days dropped from the history are
+    taken out of the graph, so memory stays bounded however long the bot
+    runs. All time in `get_fans` and `get_top_pairs` is therefore the
+    last `history_days` days.
     """
 
     POINTS_USED_TOTAL = 'POINTS_USED_TOTAL'
@@ -362,19 +1239,36 @@ class InMemoryStorage(Storage):
     NEGATIVE_POINTS_USED_TODAY = 'NEGATIVE_POINTS_USED_TODAY'
     PM_PREFERENCE = 'PM_PREFERENCE'
     LAST_MODIFIED = 'LAST_MODIFIED'
+    RESET_AT = 'RESET_AT'
+    GIVEN_TO_TODAY = 'GIVEN_TO_TODAY'
+    CURRENCY_RECEIVED_TOTAL = 'CURRENCY_RECEIVED_TOTAL'
+    CURRENCY_USED_TODAY = 'CURRENCY_USED_TODAY'
+    RECENT_POINTS = 'RECENT_POINTS'
+    RECENT_UPDATED = 'RECENT_UPDATED'
+    ALL_TIME = 'ALL'
 
-    def __init__(self):
+    def __init__(self, recent_half_life: float = decay.DEFAULT_HALF_LIFE,
+                 history_days: int = 366):
         super().__init__()
+        self.history_days = history_days
         self._data = dict()
+        # Users ordered by recent score, see `get_recent_leaders`.
+        self._recent = decay.DecayedIndex(recent_half_life)
+        # Users ordered by emoji received, per currency.
+        self._currencies = currency.CurrencyIndex()
+        # Points given by each user to each other user, per period.
+        self._graph = graph.GiveGraph()
+        # (channel_id, 'ALL' or 'YYYY-MM') -> {user_id: points received}
+        self._channels = dict()
+        # Archived daily records, see `get_daily_history`.
+        self._history = []
 
-    def _check_date(self, date: datetime.date) -> bool:
-        """Compare date to current date and return True is match."""
-        # This is based on server date, not user date.
-        return date == self._get_today()
+    def _is_current(self, record: dict) -> bool:
+        """Return True if the daily counts of `record` are from the user's current day."""
+        return self.resets.now() < record[self.RESET_AT]
 
-    @staticmethod
-    def _get_today() -> datetime.date:
-        return datetime.datetime.today().date()
+    def _get_today(self) -> datetime.date:
+        return self.resets.today()
 
     ### Users
     def _check_user(self, user_id: str):
@@ -392,7 +1286,13 @@ class InMemoryStorage(Storage):
             self.NEGATIVE_POINTS_USED_TOTAL : 0,
             self.NEGATIVE_POINTS_USED_TODAY : 0,
             self.PM_PREFERENCE: 1,
-            self.LAST_MODIFIED: self._get_today()
+            self.GIVEN_TO_TODAY: dict(),
+            self.CURRENCY_RECEIVED_TOTAL: dict(),
+            self.CURRENCY_USED_TODAY: dict(),
+            self.RECENT_POINTS: 0.0,
+            self.RECENT_UPDATED: 0.0,
+            self.LAST_MODIFIED: self.resets.today(user_id),
+            self.RESET_AT: self.resets.next_reset(user_id)
         }
 
     def _user_exists(self, user_id: str) -> bool:
@@ -404,30 +1304,63 @@ class InMemoryStorage(Storage):
         return list(self._data.keys())
 
     # Manipulate storage data structure
+    def _daily_record(self, user_id: str) -> Tuple[str, str, int, int, Dict[str, int]]:
+        """Return the user's daily counts as a history record."""
+        record = self._data[user_id]
+        return (record[self.LAST_MODIFIED].strftime('%Y-%m-%d'), user_id,
+                record[self.POINTS_RECEIVED_TODAY], record[self.POINTS_USED_TODAY],
+                dict(record[self.GIVEN_TO_TODAY]))
+
     def _reset_user_counts(self, user_id: str):
-        """Reset daily counts for user."""
+        """Archive and reset daily counts for user."""
+        record = self._data[user_id]
+        if record[self.POINTS_RECEIVED_TODAY] or record[self.POINTS_USED_TODAY]:
+            self._history.append(self._daily_record(user_id))
+        self._data[user_id][self.GIVEN_TO_TODAY] = dict()
+        self._data[user_id][self.CURRENCY_USED_TODAY] = dict()
         self._data[user_id][self.POINTS_RECEIVED_TODAY] = 0      
         self._data[user_id][self.POINTS_USED_TODAY] = 0
         self._data[user_id][self.NEGATIVE_POINTS_USED_TODAY] = 0
-        self._data[user_id][self.LAST_MODIFIED] = self._get_today()
-    
+        self._data[user_id][self.LAST_MODIFIED] = self.resets.today(user_id)
+        self._data[user_id][self.RESET_AT] = self.resets.next_reset(user_id)
+
+    def _rollover(self, offsets: set, now: int) -> int:
+        """Reset the expired users whose UTC offset is in `offsets`."""
+        expired = [user_id for user_id, record in self._data.items()
+                   if record[self.RESET_AT] <= now and self.resets.offset(user_id) in offsets]
+        for user_id in expired:
+            self._reset_user_counts(user_id)
+        # Trim the history once a day rather than on every append.
+        today = self.resets.today(now=now)
+        oldest = (today - datetime.timedelta(days=self.history_days)).strftime('%Y-%m-%d')
+        for day, user_id, _, _, given_to in self._history:
+            if day < oldest and given_to:
+                self._graph.remove(user_id, given_to, day[:7])
+        self._history = [record for record in self._history if record[0] >= oldest]
+        # Only this month's channel scores are ever read.
+        month = today.strftime('%Y-%m')
+        for key in [key for key in self._channels if key[1] not in (self.ALL_TIME, month)]:
+            del self._channels[key]
+        self._graph.drop_periods([month])
+        return len(expired)
+
     def _get_user_field(self, user_id: str, field: str) -> int:
         """Return value of `field` for `user_id`."""
-        if not self._check_date(self._data[user_id][self.LAST_MODIFIED]):
+        if not self._is_current(self._data[user_id]):
             # This record is stale.
             self._reset_user_counts(user_id)
         return self._data[user_id][field]
 
     def _set_user_field(self, user_id: str, field: str, value: int):
         """Set `field` to `value` for `user_id`."""
-        if not self._check_date(self._data[user_id][self.LAST_MODIFIED]):
+        if not self._is_current(self._data[user_id]):
             # This record is stale.
             self._reset_user_counts(user_id)
         self._data[user_id][field] = value
 
     def _add_to_user_field(self, user_id: str, field: str, value: int):
         """Add `value` to `field` for `user_id`."""
-        if not self._check_date(self._data[user_id][self.LAST_MODIFIED]):
+        if not self._is_current(self._data[user_id]):
             # This record is stale.
             self._reset_user_counts(user_id)
         self._data[user_id][field] += value
@@ -443,11 +1376,15 @@ class InMemoryStorage(Storage):
         self._check_user(user_id=user_id)
         return self._get_user_field(user_id, self.POINTS_USED_TODAY)
 
-    def add_user_points_used(self, user_id: str, num: int):
+    def add_user_points_used(self, user_id: str, num: int, currencies: Dict[str, int] = None):
         """Add `num` to user's total and daily used points."""
         self._check_user(user_id=user_id)
         self._add_to_user_field(user_id, self.POINTS_USED_TOTAL, num)
         self._add_to_user_field(user_id, self.POINTS_USED_TODAY, num)
+        used = self._data[user_id][self.CURRENCY_USED_TODAY]
+        for name, count in self._currency_counts(num, currencies).items():
+            used[name] = used.get(name, 0) + count
+        self._points_used(user_id, num)
 
     ### Points received
     def get_user_points_received_total(self, user_id: str) -> int:
@@ -460,17 +1397,101 @@ class InMemoryStorage(Storage):
         self._check_user(user_id=user_id)
         return self._get_user_field(user_id, self.POINTS_RECEIVED_TODAY)
 
-    def add_user_points_received(self, user_id: str, num: int):
-        """Add `num` to user's total received points."""
+    def add_user_points_received(self, user_id: str, num: int,
+                                 currencies: Dict[str, int] = None) -> int:
+        """Add `num` to user's total received points and return the new total."""
         self._check_user(user_id=user_id)
         self._add_to_user_field(user_id, self.POINTS_RECEIVED_TOTAL, num)
         self._add_to_user_field(user_id, self.POINTS_RECEIVED_TODAY, num)
+        record = self._data[user_id]
+        received = record[self.CURRENCY_RECEIVED_TOTAL]
+        counts = self._currency_counts(num, currencies)
+        for name, count in counts.items():
+            received[name] = received.get(name, 0) + count
+        self._currencies.update(user_id, {name: received[name] for name in counts})
+        value, updated = decay.add(record[self.RECENT_POINTS], record[self.RECENT_UPDATED],
+                                   num, time.time(), self._recent.rate)
+        record[self.RECENT_POINTS] = value
+        record[self.RECENT_UPDATED] = updated
+        self._recent.update(user_id, value, updated)
+        self._points_received(user_id, num, record[self.POINTS_RECEIVED_TOTAL])
+        return record[self.POINTS_RECEIVED_TOTAL]
 
     def get_users_and_scores_total(self) -> List[Tuple[str, int]]:
         """Return list of tuples (user_id, points_received)."""
         return [(user, self._get_user_field(user, self.POINTS_RECEIVED_TOTAL)) 
                 for user in self.get_users()]
 
+    ### Gives graph
+    def add_given_to(self, requestor_id: str, targets: Dict[str, int]):
+        """Record that requestor gave `targets`, a dict of target_id : points."""
+        self._check_user(user_id=requestor_id)
+        given_to = self._get_user_field(requestor_id, self.GIVEN_TO_TODAY)
+        for target_id, num in targets.items():
+            given_to[target_id] = given_to.get(target_id, 0) + num
+        self._graph.add(requestor_id, targets, self._get_today().strftime('%Y-%m'))
+
+    def get_fans(self, user_id: str, k: int, this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return the `k` users who gave the most points to user, as (giver_id, points)."""
+        period = self._get_today().strftime('%Y-%m') if this_month else self.ALL_TIME
+        return self._graph.fans(user_id, k, period)
+
+    def get_top_pairs(self, k: int, this_month: bool = False) -> List[Tuple[str, str, int]]:
+        """Return the `k` pairs with the most points, as (giver_id, target_id, points)."""
+        period = self._get_today().strftime('%Y-%m') if this_month else self.ALL_TIME
+        return self._graph.top_pairs(k, period)
+
+    ### Recent scores
+    def get_recent_leaders(self, k: int) -> List[Tuple[str, float]]:
+        """Return the `k` highest (user_id, recent score), highest first."""
+        return self._recent.top(k)
+
+    ### Currencies
+    def get_user_currencies_used(self, user_id: str) -> Dict[str, int]:
+        """Return dictionary of currency : number of emoji used today."""
+        self._check_user(user_id=user_id)
+        return dict(self._get_user_field(user_id, self.CURRENCY_USED_TODAY))
+
+    def get_currency_leaders(self, currency: str, k: int) -> List[Tuple[str, int]]:
+        """Return the `k` highest (user_id, emoji of `currency` received), highest first."""
+        return self._currencies.top(currency, k)
+
+    ### Diagnostics
+    def sizes(self) -> Dict[str, int]:
+        return {'records': len(self._data),
+                'history records': len(self._history),
+                'channel scores': sum(len(scores) for scores in self._channels.values()),
+                'recent index': len(self._recent),
+                'currency index': len(self._currencies),
+                'graph edges': len(self._graph)}
+
+    ### History
+    def get_daily_history(self, start: datetime.date) -> List[Tuple[str, str, int, int, Dict[str, int]]]:
+        """Return the daily records from `start` until yesterday."""
+        start = start.strftime('%Y-%m-%d')
+        history = [record for record in self._history if record[0] >= start]
+        # Records of users inactive since a previous day are not archived yet.
+        for user_id, record in self._data.items():
+            if (not self._is_current(record) and
+                    (record[self.POINTS_RECEIVED_TODAY] or record[self.POINTS_USED_TODAY])):
+                daily = self._daily_record(user_id)
+                if daily[0] >= start:
+                    history.append(daily)
+        return history
+
+    ### Channels
+    def add_channel_points_received(self, channel_id: str, user_id: str, num: int):
+        """Add `num` to user's all time and this month's points received in channel."""
+        for period in (self.ALL_TIME, self._get_today().strftime('%Y-%m')):
+            scores = self._channels.setdefault((channel_id, period), dict())
+            scores[user_id] = scores.get(user_id, 0) + num
+
+    def get_channel_users_and_scores(self, channel_id: str,
+                                     this_month: bool = False) -> List[Tuple[str, int]]:
+        """Return list of tuples (user_id, points_received) in channel."""
+        period = self._get_today().strftime('%Y-%m') if this_month else self.ALL_TIME
+        return list(self._channels.get((channel_id, period), dict()).items())
+
     ### PM Preferences
     def get_pm_preference(self, user_id: str) -> int:
         """Return user's PM Preference"""
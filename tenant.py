@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+This module holds the per-workspace state of the bot.
+
+A `Tenant` bundles everything that used to be a module global in
+`hey_fireball`: the Slack client, the storage instance, the
+configuration (`EMOJI`, `POINTS`, `MAX_POINTS_PER_DAY`, ...) and the
+user directory. A single process can serve many workspaces by holding
+one `Tenant` per workspace and polling all of them from the same loop.
+
+Tenants are configured either from a JSON file pointed to by the
+TENANTS_FILE environment variable or, when it is not set, from the
+single-workspace environment variables described in the README.
+
+Creating a tenant does no I/O: the Slack client, the storage backend
+(and the SDK it needs) and the user directory are created on first use.
+"""
+import os
+import json
+
+from typing import Dict, List
+
+# Same package imports
+import decay
+import storage
+from currency import Currency, parse_currencies
+from storage import Storage
+from board_cache import BoardCache
+from notifications import NotificationAggregator
+from admission import AdmissionControl
+from digest import DigestAggregator
+
+
+# Requests session shared by every storage backend that talks HTTP, so
+# tenants in the same process reuse keep-alive connections.
+_http_session = None
+# Connections kept alive per host, and requests a storage sends at once.
+HTTP_POOL_SIZE = 16
+
+
+def get_http_session():
+    """Return the process wide requests session, creating it if needed."""
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+        _http_session.mount('https://', adapter)
+        _http_session.mount('http://', adapter)
+    return _http_session
+
+
+def create_storage(storage_type: str, table_name: str = None,
+                   recent_half_life: float = decay.DEFAULT_HALF_LIFE) -> Storage:
+    """Create the storage mechanism for a tenant.
+
+    Parameters
+    ----------
+    storage_type
+        One of ``inmemory`` or ``azuretable``
+    table_name
+        Azure table holding the tenant's data (azuretable only)
+    recent_half_life
+        Half life in days of the recent scores, see `decay`
+
+    Returns
+    -------
+    storage.Storage
+        Storage instance private to the tenant. Azure tables are reached
+        through `async_storage`, which sends independent requests of a
+        call concurrently.
+    """
+    storage_type = storage_type.lower()
+    if storage_type == 'inmemory':
+        return storage.InMemoryStorage(recent_half_life=recent_half_life)
+    elif storage_type == 'azuretable':
+        import async_storage
+        return async_storage.SyncStorage(async_storage.AsyncAzureTableStorage(
+            table_name=table_name, request_session=get_http_session(),
+            pool_size=HTTP_POOL_SIZE, recent_half_life=recent_half_life))
+    else:
+        raise ValueError('Unknown storage type.')
+
+
+class Tenant():
+    """Configuration and state for one Slack workspace.
+
+    Attributes
+    ----------
+    name : str
+        Short name used in logs and to namespace storage
+    slack_client : SlackClient
+        Client authenticated with the workspace's bot token
+    storage : Storage
+        Storage instance holding the workspace's points
+    bot_id : str
+        Slack user Id of the bot in this workspace
+    at_bot : str
+        Formatted mention of the bot, e.g. ``<@U1A1A1A1A>``
+    emoji : str
+        Emoji that is counted as points, e.g. ``:fireball:``
+    points : str
+        Name of the points, e.g. ``shots``
+    self_points : str
+        ``DISALLOW`` to prevent users from giving themselves points
+    max_points_per_day : int
+        Number of ``emoji`` each user can give per day
+    currencies : list
+        `currency.Currency` of every emoji counted as points: ``emoji``
+        (worth 1 point, with a budget of ``max_points_per_day``) followed
+        by the ones configured with the ``currencies`` argument, a list of
+        `Currency` arguments
+    currency_by_emoji : dict
+        Dictionary of emoji : `Currency`, e.g. ``:fireball:``
+    currency_by_name : dict
+        Dictionary of emoji name : `Currency`, e.g. ``fireball`` as found
+        in reaction events
+    user_name_lookup : dict
+        Dictionary of slack_id : username
+    notifications : NotificationAggregator
+        Buffer merging the notifications sent to recipients of gives
+    board_cache : BoardCache
+        Rendered leaderboards, kept until a give changes them
+    recent_half_life : float
+        Days after which received points count half on the
+        ``leaderboard recent``
+    digests : DigestAggregator
+        Running aggregates of the daily and weekly digests, fed by the
+        storage
+    digest_channels : dict
+        Dictionary of ``daily``/``weekly`` : list of channel Ids the
+        digest is posted to
+    admission : AdmissionControl
+        Token buckets limiting how often users and channels run commands.
+        Configured with the ``admission`` argument, a dictionary of
+        `AdmissionControl` arguments.
+    admins : list
+        Slack user Ids allowed to run the ``memory`` command
+    diagnostics : MemoryDiagnostics
+        Memory report of the process serving the tenant, set by the
+        `App` (see `diagnostics`)
+    exporter : LeaderboardExporter
+        Writes the leaderboard to files for dashboards, set by the `App`
+        when exporting (see `exporter`), None otherwise
+    compact_after_days : int
+        Age in days after which the daily history is folded into monthly
+        rollups (see `compaction`), 0 to keep every daily record
+    The Slack client, storage and user directory are created on first
+    access. They can also be assigned, e.g. to share a storage.
+    """
+
+    def __init__(self, name: str, slack_token: str, bot_id: str,
+                 emoji: str, points: str, self_points: str = 'DISALLOW',
+                 max_points_per_day: int = 5, storage_type: str = 'inmemory',
+                 table_name: str = None, notification_window: float = 5,
+                 admission: Dict = None,
+                 recent_half_life: float = decay.DEFAULT_HALF_LIFE,
+                 digest_channels: Dict[str, List[str]] = None,
+                 admins: List[str] = None, currencies: List[Dict] = None,
+                 compact_after_days: int = 90):
+        self.name = name
+        self._slack_token = slack_token
+        self._slack_client = None
+        self._storage_type = storage_type
+        self._table_name = table_name
+        self._storage = None
+        self.recent_half_life = float(recent_half_life)
+        self._user_name_lookup = None
+        self.bot_id = bot_id
+        self.at_bot = f'<@{bot_id}>'
+        self.emoji = emoji
+        self.points = points
+        self.self_points = self_points
+        self.max_points_per_day = int(max_points_per_day)
+        self.currencies = ([Currency(emoji, 1, self.max_points_per_day)] +
+                           [Currency(**c) for c in currencies or []])
+        self.currency_by_emoji = {c.emoji: c for c in self.currencies if c.emoji}
+        self.currency_by_name = {c.name: c for c in self.currencies if c.name}
+        self.notifications = NotificationAggregator(self, float(notification_window))
+        self.board_cache = BoardCache()
+        self.admission = AdmissionControl(**(admission or {}))
+        self.digests = DigestAggregator()
+        self.digest_channels = digest_channels or dict()
+        self.admins = admins or []
+        self.diagnostics = None
+        self.exporter = None
+        self.compact_after_days = int(compact_after_days)
+
+    def __repr__(self):
+        return f'Tenant({self.name!r})'
+
+    @property
+    def slack_client(self):
+        if self._slack_client is None:
+            from slackclient import SlackClient
+            self._slack_client = SlackClient(self._slack_token)
+        return self._slack_client
+
+    @slack_client.setter
+    def slack_client(self, client):
+        self._slack_client = client
+
+    @property
+    def storage(self) -> Storage:
+        if self._storage is None:
+            self.storage = create_storage(self._storage_type, self._table_name,
+                                          self.recent_half_life)
+        return self._storage
+
+    @storage.setter
+    def storage(self, value: Storage):
+        self._storage = value
+        value.add_listener(self.digests)
+        # Points stored before currencies existed are of the main one.
+        value.set_default_currency(self.currencies[0].name)
+
+    @property
+    def user_name_lookup(self) -> Dict[str, str]:
+        if self._user_name_lookup is None:
+            self.load_users()
+        return self._user_name_lookup
+
+    @user_name_lookup.setter
+    def user_name_lookup(self, lookup: Dict[str, str]):
+        self._user_name_lookup = lookup
+
+    def load_users(self):
+        """Fill ``user_name_lookup`` from the workspace's user list.
+
+        The UTC offset of every user is passed to the storage, so that
+        their daily points reset at their local midnight.
+        """
+        user_list = self.slack_client.api_call("users.list")['members']
+        self.user_name_lookup = {x['id'] : x['name'] for x in user_list}  # U1A1A1A1A : kyle.sykes
+        self.storage.set_user_offsets({f"<@{x['id']}>": x['tz_offset'] for x in user_list
+                                       if x.get('tz_offset') is not None})
+
+    def record_give(self, user_id: str, new_total: int, channel: str = None):
+        """Tell the caches of the tenant that `user_id` reached `new_total` points.
+
+        Called by the process answering the boards for every give, see
+        `BoardCache.record_give`.
+        """
+        self.board_cache.record_give(user_id, new_total, channel)
+        if self.exporter is not None:
+            self.exporter.record_give(user_id, new_total)
+
+    def sizes(self) -> Dict[str, int]:
+        """Return the number of entries of every structure of the tenant."""
+        sizes = {'users cached': len(self._user_name_lookup or ()),
+                 'admission buckets': len(self.admission),
+                 'boards cached': len(self.board_cache),
+                 'notifications pending': len(self.notifications)}
+        if self.exporter is not None:
+            sizes['export ranking'] = len(self.exporter)
+        if self._storage is not None:
+            sizes.update({'storage ' + name: size for name, size in self._storage.sizes().items()})
+        return sizes
+
+
+def _tenant_from_env() -> Dict:
+    """Return the single-workspace configuration from environment variables."""
+    return {'name': os.environ.get('TENANT_NAME', 'default'),
+            'slack_token': os.environ.get('SLACK_BOT_TOKEN'),
+            'bot_id': os.environ.get('BOT_ID'),
+            'emoji': os.environ.get('EMOJI'),
+            'points': os.environ.get('POINTS'),
+            'self_points': os.environ.get('SELF_POINTS', 'DISALLOW'),
+            'max_points_per_day': os.environ.get('MAX_POINTS_PER_DAY', 5),
+            'storage_type': os.environ.get('STORAGE_TYPE', 'inmemory'),
+            'table_name': os.environ.get('TABLE_NAME'),
+            'notification_window': os.environ.get('NOTIFICATION_WINDOW', 5),
+            'recent_half_life': os.environ.get('RECENT_HALF_LIFE', decay.DEFAULT_HALF_LIFE),
+            'digest_channels': {kind: os.environ[var].split(',')
+                                for kind, var in (('daily', 'DAILY_DIGEST_CHANNELS'),
+                                                  ('weekly', 'WEEKLY_DIGEST_CHANNELS'))
+                                if os.environ.get(var)},
+            'admins': [u for u in os.environ.get('ADMIN_USERS', '').split(',') if u],
+            'currencies': parse_currencies(os.environ.get('CURRENCIES', '')),
+            'compact_after_days': os.environ.get('COMPACT_AFTER_DAYS', 90)}
+
+
+def load_tenant_configs() -> List[Dict]:
+    """Return the list of tenant configurations.
+
+    If TENANTS_FILE is set it must point to a JSON file holding a list of
+    objects whose keys match the arguments of `Tenant`. Otherwise a single
+    tenant is built from the environment variables.
+    """
+    path = os.environ.get('TENANTS_FILE')
+    if path:
+        with open(path) as f:
+            return json.load(f)
+    return [_tenant_from_env()]
+
+
+def load_tenants() -> List[Tenant]:
+    """Create and return every configured tenant."""
+    return [Tenant(**config) for config in load_tenant_configs()]
@@ -0,0 +1,47 @@
+from admission import AdmissionControl
+
+
+### Tests
+def test_boards_cost_more_than_gives(clock):
+    admission = AdmissionControl(user_rate=1, user_burst=10, clock=clock)
+    assert admission.admit('UA', 'C1', 'leaderboard')
+    assert admission.admit('UA', 'C1', 'leaderboard')
+    assert not admission.admit('UA', 'C1', 'leaderboard')
+    # Another user is not affected.
+    assert admission.admit('UB', 'C1', 'leaderboard')
+    # Refilled after 5 seconds.
+    clock.now = 5
+    assert admission.admit('UA', 'C1', 'leaderboard')
+    clock.now = 10
+    for _ in range(5):
+        assert admission.admit('UA', 'C1', 'give')
+    assert not admission.admit('UA', 'C1', 'give')
+
+def test_channel_bucket_and_notice_once(clock):
+    admission = AdmissionControl(channel_rate=0, channel_burst=3, clock=clock)
+    for user_id in ('UA', 'UB', 'UC'):
+        assert admission.admit(user_id, 'C1', 'give')
+    assert not admission.admit('UD', 'C1', 'give')
+    assert admission.should_notify('UD')
+    assert not admission.admit('UD', 'C1', 'give')
+    assert not admission.should_notify('UD')
+    # Admitted elsewhere, so the next rejection is notified again.
+    assert admission.admit('UD', 'C2', 'give')
+    assert not admission.admit('UD', 'C1', 'give')
+    assert admission.should_notify('UD')
+
+def test_board_spam_does_not_block_gives(clock):
+    admission = AdmissionControl(channel_rate=0, channel_burst=30, clock=clock)
+    users = [f'U{i}' for i in range(10)]
+    for user_id in users:
+        while admission.admit(user_id, 'C1', 'fullboard', board=True):
+            pass
+    assert not admission.admit('UX', 'C1', 'leaderboard', board=True)
+    assert admission.admit('UX', 'C1', 'give')
+    assert admission.admit('UY', 'C1', 'give')
+
+def test_buckets_are_bounded():
+    admission = AdmissionControl(max_buckets=100)
+    for i in range(1000):
+        admission.admit(f'U{i}', f'C{i}', 'give')
+    assert len(admission) == 200
@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+np = pytest.importorskip('numpy')
+import analytics
+import storage
+
+
+TODAY = datetime.date(2026, 10, 19)
+
+
+def day(n):
+    """Return the date `n` days before TODAY as YYYY-MM-DD."""
+    return (TODAY - datetime.timedelta(days=n)).strftime('%Y-%m-%d')
+
+
+### Fixtures
+@pytest.fixture()
+def history():
+    records = [
+        (day(1), 'A', 0, 3, {'B': 2, 'C': 1}),
+        (day(2), 'A', 0, 1, {'B': 1}),
+        (day(3), 'A', 0, 1, {'B': 1}),
+        (day(5), 'A', 0, 1, {'C': 1}),
+        (day(1), 'B', 2, 1, {'C': 1}),
+        (day(2), 'B', 1, 0, {}),
+        (day(3), 'B', 1, 0, {}),
+        (day(1), 'C', 2, 0, {}),
+        (day(5), 'C', 1, 0, {}),
+        (day(45), 'C', 9, 0, {}),
+        (day(400), 'C', 99, 0, {}),
+    ]
+    return analytics.History(records, TODAY - datetime.timedelta(days=365), 365)
+
+
+### Tests
+def test_shares(history):
+    assert analytics.shares(history, days=90) == [('C', 12, 0.75), ('B', 4, 0.25)]
+
+def test_trends(history):
+    assert analytics.trends(history, days=30) == [('B', 4, 0)]
+    assert analytics.trends(history, days=30, giving=True) == [('A', 6, 0), ('B', 1, 0)]
+
+def test_longest_streaks(history):
+    assert analytics.longest_streaks(history) == [('A', 3), ('B', 1)]
+
+def test_top_pairs(history):
+    assert analytics.top_pairs(history) == [('A', 'B', 4), ('A', 'C', 2), ('B', 'C', 1)]
+
+def test_history_cached_until_rollover():
+    ims = storage.InMemoryStorage()
+    first = analytics.get_history(ims, today=TODAY)
+    assert analytics.get_history(ims, today=TODAY) is first
+    assert analytics.get_history(ims, today=TODAY + datetime.timedelta(days=1)) is not first
@@ -0,0 +1,79 @@
+import datetime
+import threading
+
+import pytest
+
+import async_storage
+import storage
+
+
+### Fixtures
+@pytest.fixture()
+def ims():
+    return storage.InMemoryStorage()
+
+@pytest.fixture()
+def async_azure(azure_storage, table_service):
+    """`AsyncAzureTableStorage` on the `FakeTableService` of `azure_storage`."""
+    async_azure = async_storage.AsyncAzureTableStorage(table_name='test', pool_size=4)
+    async_azure.storage._table_service = table_service
+    return async_azure
+
+def wait_for(calls: int, table_service, method: str, partition: str = ''):
+    """Make each `method` call whose partition or filter contains `partition` wait for `calls` of them."""
+    barrier = threading.Barrier(calls, timeout=5)
+    def hook(table_name, *args, **kwargs):
+        key = args[0] if args else kwargs.get('filter') or ''
+        if partition in key:
+            barrier.wait()
+    table_service.hooks[method] = hook
+
+
+### Tests
+def test_sync_storage_round_trip(ims):
+    sync = async_storage.SyncStorage(async_storage.AsyncStorageAdapter(ims, pool_size=1))
+    received = []
+    class Listener():
+        def points_received(self, user_id, num, new_total):
+            received.append((user_id, num, new_total))
+        def points_used(self, user_id, num):
+            pass
+    sync.add_listener(Listener())
+    assert sync.give_points('Matt', {'Kyle': 2, 'Ann': 1}, 'C1') == {'Kyle': 2, 'Ann': 1}
+    assert sync.get_user_points_used('Matt') == 3
+    assert sync.get_user_points_received_total('Kyle') == 2
+    assert sorted(sync.get_channel_users_and_scores('C1')) == [('Ann', 1), ('Kyle', 2)]
+    sync.set_pm_preference('Kyle', 1)
+    assert sync.get_pm_preference('Kyle') == 1
+    assert sorted(received) == [('Ann', 1, 1), ('Kyle', 2, 2)]
+
+def test_give_updates_channels_concurrently(async_azure, table_service):
+    sync = async_storage.SyncStorage(async_azure)
+    sync.give_points('Matt', {'Kyle': 1})
+    # Each target's channel update waits for the others, so they must overlap.
+    wait_for(3, table_service, 'get_entity', 'CHANNEL')
+    sync.give_points('Matt', {'Kyle': 2, 'Ann': 1, 'Bob': 3}, 'C1')
+    assert sorted(sync.get_channel_users_and_scores('C1')) == [('Ann', 1), ('Bob', 3), ('Kyle', 2)]
+    assert sync.get_user_points_received_total('Kyle') == 3
+
+def test_history_queries_run_concurrently(async_azure, table_service):
+    sync = async_storage.SyncStorage(async_azure)
+    table_service._store({'PartitionKey': '2020-06-01', 'RowKey': 'Kyle',
+                          'POINTS_RECEIVED_TODAY': 2, 'POINTS_USED_TODAY': 1,
+                          'GIVEN_TO_TODAY': '{"Ann": 1}', 'DAY': '2020-06-01'})
+    # The rollups, date partitions and Total partition are queried at once.
+    wait_for(3, table_service, 'query_entities')
+    assert sync.get_daily_history(datetime.date(2020, 1, 1)) == [
+        ('2020-06-01', 'Kyle', 2, 1, {'Ann': 1})]
+
+def test_pooled_error_reaches_caller(async_azure, table_service):
+    from azure.common import AzureHttpError
+    sync = async_storage.SyncStorage(async_azure)
+    def fail(*args, **kwargs):
+        raise AzureHttpError('Server busy.', 503)
+    table_service.hooks['query_entities'] = fail
+    with pytest.raises(AzureHttpError):
+        sync.get_users_and_scores_total()
+    # The loop is still serving.
+    del table_service.hooks['query_entities']
+    assert sync.get_users_and_scores_total() == []
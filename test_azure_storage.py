@@ -0,0 +1,47 @@
+import pytest
+
+import storage
+
+
+def bump(table_service, user_id, points):
+    """Add `points` to the received total of `user_id`, as another process would."""
+    record = table_service.entities[(storage.AzureTableStorage.TOTAL_PARTITION, user_id)]
+    table_service._store(dict(record, POINTS_RECEIVED_TOTAL=record['POINTS_RECEIVED_TOTAL'] + points))
+
+
+### Tests
+def test_give_points(azure_storage):
+    new_totals = azure_storage.give_points('Matt', {'Kyle': 2, 'Ann': 2}, 'C1')
+    assert new_totals == {'Kyle': 2, 'Ann': 2}
+    assert azure_storage.get_user_points_used('Matt') == 4
+    assert azure_storage.get_user_points_received_total('Ann') == 2
+
+def test_give_points_retries_concurrent_update(azure_storage, table_service):
+    azure_storage.give_points('Matt', {'Kyle': 1})
+    commits = []
+    def update_first(table_name, batch):
+        commits.append(batch)
+        if len(commits) == 1:
+            bump(table_service, 'Kyle', 10)
+    table_service.hooks['commit_batch'] = update_first
+    # Neither the concurrent update nor the give is lost.
+    assert azure_storage.give_points('Matt', {'Kyle': 2}) == {'Kyle': 13}
+    assert len(commits) == 2
+    assert azure_storage.get_user_points_used('Matt') == 3
+
+def test_give_points_gives_up_on_conflicts(azure_storage, table_service):
+    azure_storage.give_points('Matt', {'Kyle': 1})
+    table_service.hooks['commit_batch'] = lambda table_name, batch: bump(table_service, 'Kyle', 1)
+    with pytest.raises(storage.ConflictError):
+        azure_storage.give_points('Matt', {'Kyle': 2})
+    assert len(table_service.batches()) == 1 + azure_storage.GIVE_ATTEMPTS
+    assert azure_storage.get_user_points_used('Matt') == 1
+
+def test_give_points_caps_targets(azure_storage, table_service):
+    targets = {f'U{idx}': 1 for idx in range(storage.MAX_TARGETS + 1)}
+    with pytest.raises(ValueError):
+        azure_storage.give_points('Matt', targets)
+    assert not table_service.batches()
+    del targets['U0']
+    azure_storage.give_points('Matt', targets)
+    assert azure_storage.get_user_points_used('Matt') == storage.MAX_TARGETS
@@ -0,0 +1,61 @@
+import threading
+import time
+
+from board_cache import BoardCache, SingleFlight
+
+
+### Tests
+def test_single_flight_shares_computation():
+    flight = SingleFlight()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'board'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['board'] * 8
+    assert len(calls) == 1
+
+def test_leaderboard_kept_until_top_changes():
+    cache = BoardCache(size=2)
+    key = (BoardCache.LEADERBOARD, None, None)
+    cache.set_top([('<@UA>', 10), ('<@UB>', 5)])
+    assert cache.get(key, lambda: 'first') == 'first'
+    # Below the top: the board is unchanged.
+    cache.record_give('<@UC>', 3)
+    assert cache.get(key, lambda: 'second') == 'first'
+    # Enters the top: the board is rendered again.
+    cache.record_give('<@UC>', 6)
+    assert cache.get(key, lambda: 'third') == 'third'
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_fullboard_and_channel_boards():
+    cache = BoardCache()
+    full = (BoardCache.FULLBOARD, None)
+    channel = (BoardCache.LEADERBOARD, 'C1', '2026-10')
+    cache.get(full, lambda: 'full')
+    cache.get(channel, lambda: 'C1')
+    cache.record_give('<@UA>', 1, 'C2')
+    assert cache.get(channel, lambda: 'new C1') == 'C1'
+    assert cache.get(full, lambda: 'new full') == 'new full'
+    cache.record_give('<@UA>', 2, 'C1')
+    assert cache.get(channel, lambda: 'new C1') == 'new C1'
+
+def test_least_recently_used_board_dropped():
+    cache = BoardCache(max_boards=2)
+    boards = [(BoardCache.LEADERBOARD, channel, '2026-10') for channel in ('C1', 'C2', 'C3')]
+    cache.get(boards[0], lambda: 'C1')
+    cache.get(boards[1], lambda: 'C2')
+    cache.get(boards[0], lambda: 'new C1')
+    cache.get(boards[2], lambda: 'C3')
+    assert len(cache) == 2
+    assert cache.get(boards[0], lambda: 'new C1') == 'C1'
+    assert cache.get(boards[1], lambda: 'new C2') == 'new C2'
@@ -0,0 +1,149 @@
+import datetime
+import json
+
+import pytest
+
+import compaction
+from storage import Storage
+from tenant import Tenant
+
+
+class MonthsStorage(Storage):
+    """Storage with `months` months of daily history to fold, 10 records each."""
+
+    def __init__(self, months, fail=False):
+        super().__init__()
+        self.months = months
+        self.fail = fail
+        self.calls = []
+
+    def compact_history(self, before):
+        self.calls.append(before)
+        if self.fail:
+            raise RuntimeError('Rollup does not match.')
+        if not self.months:
+            return 0
+        self.months -= 1
+        return 10
+
+
+def archive(table_service, day, user_id, received, used, given_to=None):
+    """Add a daily record to the date partition `day`."""
+    table_service._store({'PartitionKey': day, 'RowKey': user_id,
+                          'POINTS_RECEIVED_TODAY': received, 'POINTS_USED_TODAY': used,
+                          'GIVEN_TO_TODAY': json.dumps(given_to or {}), 'DAY': day})
+
+def archive_month(table_service, users=3, days=3):
+    for day in range(1, days + 1):
+        for idx in range(users):
+            archive(table_service, f'2020-06-{day:02d}', f'<@U{idx}>', idx + day, day,
+                    {f'<@U{idx + 1}>': day})
+
+def make_tenant(name, storage, compact_after_days=90):
+    tenant = Tenant(name, None, 'UBOT', ':fireball:', 'shots',
+                    compact_after_days=compact_after_days)
+    tenant.storage = storage
+    return tenant
+
+
+### Tests
+def test_compaction_cutoff():
+    assert compaction.compaction_cutoff(datetime.date(2026, 10, 19), 90) == datetime.date(2026, 7, 1)
+    assert compaction.compaction_cutoff(datetime.date(2026, 3, 1), 0) == datetime.date(2026, 3, 1)
+
+def test_run_once_folds_every_month_due():
+    storage = MonthsStorage(3)
+    failing = MonthsStorage(3, fail=True)
+    disabled = MonthsStorage(3)
+    compactor = compaction.Compactor([make_tenant('failing', failing), make_tenant('a', storage),
+                                      make_tenant('off', disabled, compact_after_days=0)])
+    assert compactor.run_once(datetime.date(2026, 10, 19)) == 30
+    assert storage.calls == [datetime.date(2026, 7, 1)] * 4
+    # A failing tenant is retried at the next run, the others are not held up.
+    assert len(failing.calls) == 1 and disabled.calls == []
+    assert compactor.run_once(datetime.date(2026, 10, 19)) == 0
+
+def test_inmemory_history_is_not_compacted():
+    tenant = Tenant('test', None, 'UBOT', ':fireball:', 'shots')
+    tenant.storage.give_points('<@UA>', {'<@UB>': 1})
+    assert compaction.Compactor([tenant]).run_once() == 0
+
+def test_compact_history_folds_a_month(azure_storage, table_service):
+    archive_month(table_service)
+    archive(table_service, '2020-07-01', '<@U0>', 1, 1)
+    history = sorted(azure_storage.get_daily_history(datetime.date(2020, 1, 1)))
+    assert azure_storage.compact_history(datetime.date(2020, 7, 1)) == 9
+    assert azure_storage.compact_history(datetime.date(2020, 7, 1)) == 0
+    # Only July is left in the date partitions, the history is unchanged.
+    assert {key[0] for key in table_service.entities} == {'ROLLUP-2020-06', '2020-07-01'}
+    assert sorted(azure_storage.get_daily_history(datetime.date(2020, 1, 1))) == history
+
+def test_compact_history_deletes_only_what_it_read(azure_storage, table_service):
+    from azure.common import AzureHttpError
+    archive_month(table_service)
+    def rewrite(table_name, batch):
+        # A record is written again after it was read, e.g. archived late.
+        if batch._requests[0][1].method == 'DELETE':
+            archive(table_service, '2020-06-01', '<@U0>', 7, 7)
+    table_service.hooks['commit_batch'] = rewrite
+    with pytest.raises(AzureHttpError):
+        azure_storage.compact_history(datetime.date(2020, 7, 1))
+    del table_service.hooks['commit_batch']
+    assert table_service.entities[('2020-06-01', '<@U0>')]['POINTS_RECEIVED_TODAY'] == 7
+    # The next run folds the new record.
+    assert azure_storage.compact_history(datetime.date(2020, 7, 1)) == 9
+    days = json.loads(table_service.entities[('ROLLUP-2020-06', '<@U0>')]['DAYS'])
+    assert days['2020-06-01'] == [7, 7, {}]
+
+def test_compact_history_keeps_records_if_rollup_does_not_match(azure_storage, table_service):
+    archive_month(table_service)
+    def overwrite(table_name, filter=None, select=None):
+        # Another writer changes a rollup between the write and the check.
+        rollup = table_service.entities.get(('ROLLUP-2020-06', '<@U1>'))
+        if rollup:
+            rollup['POINTS_RECEIVED'] += 1
+    table_service.hooks['query_entities'] = overwrite
+    with pytest.raises(RuntimeError):
+        azure_storage.compact_history(datetime.date(2020, 7, 1))
+    assert table_service.batches('PUT') and table_service.batches('DELETE') == []
+    assert len([key for key in table_service.entities if key[0].startswith('2020-06')]) == 9
+
+def test_compact_history_resumes_without_counting_twice(azure_storage, table_service):
+    archive_month(table_service)
+    history = sorted(azure_storage.get_daily_history(datetime.date(2020, 1, 1)))
+    deletes = []
+    def stop(table_name, batch):
+        # The run stops after the rollups and the first day are written off.
+        if batch._requests[0][1].method == 'DELETE':
+            deletes.append(batch)
+            if len(deletes) == 2:
+                raise TimeoutError()
+    table_service.hooks['commit_batch'] = stop
+    with pytest.raises(TimeoutError):
+        azure_storage.compact_history(datetime.date(2020, 7, 1))
+    del table_service.hooks['commit_batch']
+    assert sorted(azure_storage.get_daily_history(datetime.date(2020, 1, 1))) == history
+    # The next run starts at the second day and sets the days again.
+    assert azure_storage.compact_history(datetime.date(2020, 7, 1)) == 6
+    assert sorted(azure_storage.get_daily_history(datetime.date(2020, 1, 1))) == history
+    rollup = table_service.entities[('ROLLUP-2020-06', '<@U2>')]
+    assert (rollup['POINTS_RECEIVED'], rollup['POINTS_USED']) == (3 + 4 + 5, 1 + 2 + 3)
+
+def test_compact_history_splits_batches(azure_storage, table_service):
+    archive_month(table_service, users=150, days=2)
+    assert azure_storage.compact_history(datetime.date(2020, 7, 1)) == 300
+    assert [len(call[2]) for call in table_service.batches('PUT')] == [100, 50]
+    assert [(call[1], len(call[2])) for call in table_service.batches('DELETE')] == [
+        ('2020-06-01', 100), ('2020-06-01', 50), ('2020-06-02', 100), ('2020-06-02', 50)]
+
+def test_compact_history_limits_batch_payload(azure_storage, table_service):
+    # A month of big given to counts: 20 rollups of about 30 KB each.
+    for day in range(1, 31):
+        for idx in range(20):
+            archive(table_service, f'2020-06-{day:02d}', f'<@U{idx}>', 1, 100,
+                    {f'<@U{target}>': 1 for target in range(100)})
+    azure_storage.BATCH_BYTES = 200 * 1024
+    assert azure_storage.compact_history(datetime.date(2020, 7, 1)) == 600
+    puts = table_service.batches('PUT')
+    assert len(puts) > 1 and sum(len(call[2]) for call in puts) == 20
+    assert all(call[3] <= azure_storage.BATCH_BYTES for call in puts)
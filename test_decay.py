@@ -0,0 +1,27 @@
+import pytest
+
+import decay
+
+
+### Tests
+def test_add_decays_previous_value():
+    rate = decay.decay_rate(1)
+    value, updated = decay.add(0.0, 0.0, 4, 1000.0, rate)
+    assert (value, updated) == (4, 1000.0)
+    # One half life later the 4 points count as 2.
+    value, updated = decay.add(value, updated, 1, 1000.0 + 86400, rate)
+    assert value == pytest.approx(3)
+    assert decay.decayed(value, updated, updated + 2 * 86400, rate) == pytest.approx(0.75)
+
+def test_index_order_does_not_depend_on_time():
+    index = decay.DecayedIndex(half_life=1)
+    day = 86400
+    index.update('old', 8, 0)
+    index.update('new', 3, 2 * day)
+    index.update('mid', 2, day)
+    # At day 2: old = 2, new = 3, mid = 1.
+    assert [user for user, score in index.top(3, now=2 * day)] == ['new', 'old', 'mid']
+    assert [score for user, score in index.top(3, now=3 * day)] == pytest.approx([1.5, 1, 0.5])
+    index.update('mid', 5, 2 * day)
+    assert index.top(1, now=2 * day) == [('mid', pytest.approx(5))]
+    assert len(index) == 3
@@ -0,0 +1,63 @@
+import datetime
+import random
+
+import digest
+
+
+class FakeToday():
+    def __init__(self):
+        self.date = datetime.date(2026, 10, 12)  # A Monday
+
+    def __call__(self):
+        return self.date
+
+
+### Tests
+def test_top_k_is_exact():
+    random.seed(1)
+    top = digest.TopK(5)
+    counts = dict()
+    for _ in range(2000):
+        user_id = f'U{random.randrange(50)}'
+        counts[user_id] = counts.get(user_id, 0) + random.randint(1, 3)
+        top.update(user_id, counts[user_id])
+    expected = sorted(counts.values(), reverse=True)[:5]
+    assert [count for user_id, count in top.items()] == expected
+    assert all(counts[user_id] == count for user_id, count in top.items())
+
+def test_daily_and_weekly_digests():
+    today = FakeToday()
+    aggregator = digest.DigestAggregator(k=2, today=today)
+    aggregator.points_received('<@UA>', 3, new_total=3)
+    aggregator.points_used('<@UB>', 3)
+    today.date += datetime.timedelta(days=1)
+    assert aggregator.due() == ['daily', 'weekly']
+    daily = aggregator.summary('daily')
+    assert daily['start'] == datetime.date(2026, 10, 12)
+    assert daily['received'] == [('<@UA>', 3)]
+    assert daily['given'] == [('<@UB>', 3)]
+    assert daily['newcomers'] == ['<@UA>']
+    aggregator.mark_posted('daily')
+    aggregator.mark_posted('weekly')
+    assert aggregator.due() == []
+    # Movers are compared with the day before.
+    aggregator.points_received('<@UA>', 1, new_total=4)
+    aggregator.points_received('<@UC>', 2, new_total=2)
+    today.date += datetime.timedelta(days=6)
+    assert aggregator.due() == ['daily', 'weekly']
+    daily = aggregator.summary('daily')
+    assert daily['start'] == datetime.date(2026, 10, 18)
+    assert daily['total'] == 0
+    weekly = aggregator.summary('weekly')
+    assert weekly['received'] == [('<@UA>', 4), ('<@UC>', 2)]
+    assert weekly['newcomer_count'] == 2
+
+def test_merge_summaries():
+    start = datetime.date(2026, 10, 12)
+    first = dict(digest.empty_summary('daily', start), total=5,
+                 received=[('<@UA>', 4), ('<@UB>', 1)], newcomers=['<@UB>'], newcomer_count=1)
+    second = dict(digest.empty_summary('daily', start), total=2, received=[('<@UC>', 2)])
+    merged = digest.merge_summaries([first, second], k=2)
+    assert merged['received'] == [('<@UA>', 4), ('<@UC>', 2)]
+    assert merged['total'] == 7
+    assert merged['newcomers'] == ['<@UB>']
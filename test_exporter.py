@@ -0,0 +1,71 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import exporter
+import hey_fireball
+
+
+### Fixtures
+@pytest.fixture()
+def tenant(tmp_path):
+    app = hey_fireball.App([{'name': 'test', 'slack_token': None, 'bot_id': 'UBOT',
+                             'emoji': ':fireball:', 'points': 'shots',
+                             'notification_window': 0}], num_shards=1,
+                           export_dir=str(tmp_path))
+    tenant = app.tenants[0]
+    tenant.user_name_lookup = {'UA': 'kyle', 'UB': 'matt', 'UC': 'ann'}
+    now = [0]
+    tenant.exporter.clock = lambda: now[0]
+    tenant.exporter.size = 2
+    tenant.now = now
+    return tenant
+
+def give(tenant, target_id, num):
+    tenant.record_give(target_id, tenant.storage.add_user_points_received(target_id, num))
+
+
+### Tests
+def test_export_when_top_changes(tenant, tmp_path):
+    give(tenant, '<@UB>', 2)
+    assert tenant.exporter.flush()
+    path = tmp_path / 'test' / exporter.JSON_FILE
+    snapshot = json.loads(path.read_text())
+    assert (snapshot['version'], snapshot['leaders'][0]['name']) == (1, 'matt')
+    give(tenant, '<@UC>', 3)
+    give(tenant, '<@UA>', 1)
+    # Debounced.
+    assert not tenant.exporter.flush()
+    tenant.now[0] += tenant.exporter.delay
+    assert tenant.exporter.flush()
+    binary = exporter.unpack_snapshot((tmp_path / 'test' / exporter.BINARY_FILE).read_bytes())
+    assert binary['version'] == 2
+    assert [(l['user_id'], l['score']) for l in binary['leaders']] == [('UC', 3), ('UB', 2)]
+    # Below the top: nothing to write.
+    give(tenant, '<@UA>', 0)
+    tenant.now[0] += tenant.exporter.delay
+    assert not tenant.exporter.flush()
+    # Versions go on after a restart.
+    assert exporter.LeaderboardExporter(tenant, str(tmp_path / 'test')).version == 2
+
+def test_server_etags(tenant, tmp_path):
+    give(tenant, '<@UB>', 2)
+    tenant.exporter.flush()
+    server = exporter.serve_snapshots(str(tmp_path), 0, '127.0.0.1')
+    url = f'http://127.0.0.1:{server.server_address[1]}/test/'
+    try:
+        with urllib.request.urlopen(url + exporter.JSON_FILE) as response:
+            etag = response.headers['ETag']
+            assert json.loads(response.read())['version'] == 1
+        request = urllib.request.Request(url + exporter.JSON_FILE, headers={'If-None-Match': etag})
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 304
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '../../etc/passwd.json')
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
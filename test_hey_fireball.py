@@ -0,0 +1,234 @@
+import datetime
+import tracemalloc
+
+import pytest
+
+from conftest import FakeSlackClient
+import hey_fireball
+
+
+def message(text, user='UA', channel='C1'):
+    return {'type': 'message', 'user': user, 'channel': channel, 'text': text, 'ts': '1.0'}
+
+
+### Fixtures
+@pytest.fixture()
+def tenant():
+    app = hey_fireball.App([{'name': 'test', 'slack_token': None, 'bot_id': 'UBOT',
+                             'emoji': ':fireball:', 'points': 'shots',
+                             'notification_window': 0}], num_shards=1)
+    tenant = app.tenants[0]
+    tenant.slack_client = FakeSlackClient()
+    tenant.user_name_lookup = {'UA': 'kyle', 'UB': 'matt', 'UC': 'ann'}
+    return tenant
+
+def run(tenant, text, **kwargs):
+    fireball_message = hey_fireball.parse_slack_output(tenant, [message(text, **kwargs)])
+    if (fireball_message and fireball_message.valid and
+            hey_fireball.admit_command(fireball_message)):
+        hey_fireball.handle_command(fireball_message)
+    return fireball_message
+
+
+### Tests
+def test_import_does_no_io():
+    assert hey_fireball.App().num_shards >= 1
+
+def test_give(tenant):
+    fireball_message = run(tenant, '<@UB> :fireball: :fireball:')
+    assert fireball_message.command == 'give'
+    assert fireball_message.count == 2
+    assert tenant.storage.get_user_points_received_total('<@UB>') == 2
+    assert hey_fireball.get_user_points_remaining(tenant, '<@UA>') == 3
+    assert tenant.slack_client.calls == [
+        ('chat.postMessage', {'channel': 'UB', 'text': 'You received 2 shots from kyle',
+                              'as_user': True})]
+
+def test_give_to_several_users(tenant):
+    fireball_message = run(tenant, '<@UBOT> <@UB> <@UC> <@UB> 2')
+    assert fireball_message.target_ids == ['<@UB>', '<@UC>']
+    assert tenant.storage.get_user_points_used('<@UA>') == 4
+    # Not enough points left for both.
+    run(tenant, '<@UB> <@UC> 1')
+    assert tenant.storage.get_user_points_used('<@UA>') == 4
+
+def test_cannot_give_negative_points(tenant):
+    run(tenant, '<@UBOT> <@UB> -4')
+    run(tenant, '<@UBOT> <@UB> 0')
+    assert tenant.storage.get_user_points_received_total('<@UB>') == 0
+    assert hey_fireball.get_user_points_remaining(tenant, '<@UA>') == 5
+    assert tenant.slack_client.calls[-1][1]['text'] == 'You can only give a positive number of shots!'
+    assert not hey_fireball.check_points(tenant, '<@UA>', {'fireball': -4})
+
+def test_cannot_give_to_self(tenant):
+    run(tenant, '<@UA> :fireball:')
+    assert tenant.storage.get_user_points_received_total('<@UA>') == 0
+
+def test_give_caps_targets(tenant):
+    users = {f'U{idx}': f'user{idx}' for idx in range(hey_fireball.MAX_TARGETS + 1)}
+    tenant.user_name_lookup.update(users)
+    run(tenant, ' '.join(f'<@{user_id}>' for user_id in users) + ' :fireball:')
+    assert tenant.storage.get_user_points_used('<@UA>') == 0
+    assert tenant.slack_client.calls[-1][1]['text'] == 'You can give to at most 99 users at once!'
+
+def test_give_conflict_is_reported(tenant, monkeypatch):
+    def conflict(*args, **kwargs):
+        raise hey_fireball.ConflictError()
+    monkeypatch.setattr(tenant.storage, 'give_points', conflict)
+    run(tenant, '<@UB> :fireball:')
+    method, kwargs = tenant.slack_client.calls[-1]
+    assert kwargs['channel'] == 'UA'
+    assert kwargs['text'] == 'Your shots could not be given, please try again.'
+
+def test_channel_leaderboard(tenant):
+    run(tenant, '<@UB> :fireball:', channel='C1')
+    run(tenant, '<@UC> :fireball:', channel='C2')
+    fireball_message = run(tenant, '<@UBOT> leaderboard <#C2|eng>')
+    assert fireball_message.board_channel == 'C2'
+    method, kwargs = tenant.slack_client.calls[-1]
+    assert [item['title'] for item in kwargs['attachments']] == ['ann: 1']
+
+def test_spam_is_rejected_with_one_notice(tenant):
+    for _ in range(5):
+        run(tenant, '<@UBOT> leaderboard')
+    posts = [method for method, kwargs in tenant.slack_client.calls]
+    assert posts == ['chat.postMessage', 'chat.postMessage', 'chat.postEphemeral']
+
+def test_board_spam_does_not_block_gives(tenant):
+    for user_id in ('UA', 'UB', 'UC'):
+        for _ in range(5):
+            run(tenant, '<@UBOT> leaderboard', user=user_id)
+    assert not tenant.admission.admit('UD', 'C1', 'leaderboard', board=True)
+    run(tenant, '<@UB> :fireball:', user='UD')
+    assert tenant.storage.get_user_points_received_total('<@UB>') == 1
+
+def test_tokenize():
+    tokens, emoji_counts = hey_fireball.tokenize(
+        ['<@UBOT>', 'Leaderboard', '<#C2|eng>', ':fireball:', '-3', '12', ':trophy:', ':fireball:'],
+        {':fireball:', ':trophy:'})
+    assert tokens == [(hey_fireball.MENTION, '<@UBOT>'), (hey_fireball.KEYWORD, 'leaderboard'),
+                      (hey_fireball.CHANNEL, 'C2'), (hey_fireball.EMOJI, ':fireball:'),
+                      (hey_fireball.INTEGER, -3), (hey_fireball.INTEGER, 12),
+                      (hey_fireball.EMOJI, ':trophy:'), (hey_fireball.EMOJI, ':fireball:')]
+    assert emoji_counts == {':fireball:': 2, ':trophy:': 1}
+
+def test_registered_command(tenant, monkeypatch):
+    monkeypatch.setattr(hey_fireball, '_registry', list(hey_fireball._registry))
+    monkeypatch.setattr(hey_fireball, '_command_tables', dict())
+
+    @hey_fireball.command('ping')
+    def ping(fireball_message):
+        return 'pong', fireball_message.channel, None
+
+    assert run(tenant, '<@UBOT> ping').command == 'ping'
+    assert tenant.slack_client.calls[-1] == (
+        'chat.postMessage', {'channel': 'C1', 'text': 'pong', 'as_user': True, 'attachments': None})
+
+def test_app_queues_every_message(tenant):
+    app = hey_fireball.App(num_shards=1)
+    app._tenants = [tenant]
+    tenant.slack_client.rtm_read = lambda: [message('<@UBOT> leaderboard'),
+                                            message('<@UB> :fireball:'),
+                                            message('hello'),
+                                            message('<@UBOT> shotsleft')]
+    app.step([tenant])
+    assert [kwargs['text'] for method, kwargs in tenant.slack_client.calls] == [
+        'You received 1 shots from kyle', 'You have 4 shots remaining', 'Leaderboard']
+
+def test_recent_leaderboard(tenant):
+    run(tenant, '<@UB> :fireball: :fireball:')
+    run(tenant, '<@UC> :fireball:')
+    fireball_message = run(tenant, '<@UBOT> leaderboard recent')
+    assert fireball_message.board_recent
+    method, kwargs = tenant.slack_client.calls[-1]
+    assert [item['title'] for item in kwargs['attachments']] == ['matt: 2.0', 'ann: 1.0']
+
+def test_digest_posted_once(tenant):
+    app = hey_fireball.App(num_shards=1)
+    tenant.digest_channels = {'daily': ['C9']}
+    today = datetime.date.today()
+    tenant.digests.today = lambda: today
+    run(tenant, '<@UB> :fireball: :fireball:')
+    app.post_digests(tenant)
+    today += datetime.timedelta(days=1)
+    app.post_digests(tenant)
+    app.post_digests(tenant)
+    digests = [kwargs for method, kwargs in tenant.slack_client.calls if kwargs['channel'] == 'C9']
+    assert len(digests) == 1
+    assert digests[0]['attachments'][0]['text'] == 'matt: 2 shots'
+
+def test_memory_report_for_admins_only(tenant):
+    tenant.admins = ['UA']
+    run(tenant, '<@UB> :fireball:')
+    calls = len(tenant.slack_client.calls)
+    run(tenant, '<@UBOT> memory', user='UB')
+    assert len(tenant.slack_client.calls) == calls
+    run(tenant, '<@UBOT> memory')
+    method, kwargs = tenant.slack_client.calls[-1]
+    assert kwargs['channel'] == 'UA'
+    assert 'test storage records: 2' in kwargs['text']
+    assert 'test users cached: 3' in kwargs['text']
+    assert 'Queue waits:\ninteractive: ' in kwargs['text']
+    # Started by the report.
+    tracemalloc.stop()
+
+def test_reaction_gives_to_message_author(tenant):
+    reaction = {'type': 'reaction_added', 'user': 'UA', 'reaction': 'fireball', 'item_user': 'UB',
+                'item': {'type': 'message', 'channel': 'C1', 'ts': '1.0'}}
+    events = [{'type': 'user_typing', 'user': 'UA', 'channel': 'C1'},
+              dict(reaction, reaction='thumbsup'),
+              reaction]
+    fireball_message = hey_fireball.parse_slack_output(tenant, events)
+    assert (fireball_message.command, fireball_message.count) == ('give', 1)
+    assert fireball_message.channel == 'C1'
+    hey_fireball.handle_command(fireball_message)
+    assert tenant.storage.get_user_points_received_total('<@UB>') == 1
+    assert hey_fireball.parse_slack_output(tenant, events[:2]) is None
+
+def test_currencies():
+    tenant = hey_fireball.Tenant('test', None, 'UBOT', ':fireball:', 'shots', notification_window=0,
+                                 currencies=[{'emoji': ':trophy:', 'weight': 5,
+                                              'max_points_per_day': 1}])
+    tenant.slack_client = FakeSlackClient()
+    tenant.user_name_lookup = {'UA': 'kyle', 'UB': 'matt', 'UC': 'ann'}
+    fireball_message = run(tenant, '<@UB> :fireball: :trophy: :fireball:')
+    assert fireball_message.counts == {'fireball': 2, 'trophy': 1}
+    assert tenant.storage.get_user_points_received_total('<@UB>') == 7
+    # The trophy budget is spent, the fireball one is not.
+    run(tenant, '<@UC> :trophy:')
+    run(tenant, '<@UC> :fireball:')
+    assert tenant.storage.get_user_currencies_used('<@UA>') == {'fireball': 3, 'trophy': 1}
+    run(tenant, '<@UBOT> shotsleft')
+    assert tenant.slack_client.calls[-1][1]['text'] == 'You have 2 :fireball:, 0 :trophy: remaining'
+    run(tenant, '<@UA> :trophy:', user='UC')
+    run(tenant, '<@UBOT> leaderboard :trophy:')
+    method, kwargs = tenant.slack_client.calls[-1]
+    assert [item['title'] for item in kwargs['attachments']] == ['kyle: 1', 'matt: 1']
+    # The reply mentions the emoji, the bot must not answer itself.
+    assert hey_fireball.bot_message(tenant, message(kwargs['text'], user='UBOT')) is None
+
+def test_fans_and_top_pairs(tenant):
+    run(tenant, '<@UB> :fireball: :fireball:')
+    run(tenant, '<@UB> :fireball:', user='UC')
+    run(tenant, '<@UC> :fireball:')
+    fireball_message = run(tenant, '<@UBOT> fans <@UB> all')
+    assert fireball_message.target_id == '<@UB>' and not fireball_message.board_this_month
+    method, kwargs = tenant.slack_client.calls[-1]
+    assert kwargs['text'] == 'Biggest fans of matt (all time)'
+    assert [item['title'] for item in kwargs['attachments']] == ['kyle: 2', 'ann: 1']
+    run(tenant, '<@UBOT> top pairs')
+    method, kwargs = tenant.slack_client.calls[-1]
+    assert kwargs['text'] == 'Top pairs (this month)'
+    assert [item['title'] for item in kwargs['attachments']] == ['kyle → matt: 2', 'kyle → ann: 1',
+                                                                 'ann → matt: 1']
+    assert not run(tenant, '<@UBOT> top').valid
+
+def test_setpm_reads_preference_when_executed(tenant, monkeypatch):
+    reads = []
+    monkeypatch.setattr(hey_fireball, 'get_pm_preference',
+                        lambda tenant, user_id: reads.append(user_id) or 1)
+    fireball_message = hey_fireball.extract_fireball_info(message('<@UBOT> setpm off'), tenant)
+    assert fireball_message.setting_request == 'off' and reads == []
+    hey_fireball.handle_command(fireball_message)
+    assert fireball_message.setting == 0 and reads[0] == '<@UA>'
+    assert tenant.storage.get_pm_preference('<@UA>') == 0
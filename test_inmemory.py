@@ -0,0 +1,105 @@
+import datetime
+
+import pytest
+
+import reset
+import storage
+
+
+### Fixtures
+@pytest.fixture()
+def ims():
+    return storage.InMemoryStorage()
+
+
+### Tests
+def test_channel_scores(ims):
+    ims.add_channel_points_received('C1', 'Matt', 3)
+    ims.add_channel_points_received('C1', 'Matt', 2)
+    ims.add_channel_points_received('C1', 'Kyle', 1)
+    ims.add_channel_points_received('C2', 'Kyle', 4)
+    assert sorted(ims.get_channel_users_and_scores('C1')) == [('Kyle', 1), ('Matt', 5)]
+    assert ims.get_channel_users_and_scores('C2', this_month=True) == [('Kyle', 4)]
+    assert ims.get_channel_users_and_scores('C3') == []
+
+def test_give_points(ims):
+    new_totals = ims.give_points('Matt', {'Kyle': 2, 'Ann': 2}, 'C1')
+    assert new_totals == {'Kyle': 2, 'Ann': 2}
+    assert ims.get_user_points_used('Matt') == 4
+    assert ims.get_user_points_used_total('Matt') == 4
+    assert ims.get_user_points_received('Ann') == 2
+    assert sorted(ims.get_channel_users_and_scores('C1')) == [('Ann', 2), ('Kyle', 2)]
+
+def test_daily_history(ims):
+    ims.give_points('Matt', {'Kyle': 2}, 'C1')
+    # Nothing is archived until the day is over.
+    assert ims.get_daily_history(datetime.date.today()) == []
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    for record in ims._data.values():
+        record[ims.LAST_MODIFIED] = yesterday
+        record[ims.RESET_AT] = 0
+    expected = [(yesterday.strftime('%Y-%m-%d'), 'Kyle', 2, 0, {}),
+                (yesterday.strftime('%Y-%m-%d'), 'Matt', 0, 2, {'Kyle': 2})]
+    assert sorted(ims.get_daily_history(yesterday)) == expected
+    # Rolling over archives the records.
+    assert ims.get_user_points_used('Matt') == 0
+    assert ims.get_user_points_used('Kyle') == 0
+    assert sorted(ims.get_daily_history(yesterday)) == expected
+
+def test_recent_leaders(ims):
+    ims.give_points('Matt', {'Kyle': 2, 'Ann': 3})
+    ims.add_user_points_received('Kyle', 2)
+    leaders = ims.get_recent_leaders(5)
+    assert [user for user, score in leaders] == ['Kyle', 'Ann']
+    assert [score for user, score in leaders] == pytest.approx([4, 3], rel=1e-3)
+
+def test_reset_at_local_midnight(ims):
+    now = [reset.DAY * 100 + 12 * 3600]  # 12:00 UTC
+    ims.resets = reset.ResetSchedule(default_offset=0, clock=lambda: now[0])
+    ims.set_user_offsets({'Kyle': 6 * 3600})
+    ims.give_points('Kyle', {'Matt': 2})
+    ims.give_points('Matt', {'Kyle': 3})
+    # Midnight in UTC+6: only Kyle's allowance resets.
+    now[0] += 7 * 3600
+    assert ims.rollover() == 1
+    assert ims.get_user_points_used('Kyle') == 0
+    assert ims.get_user_points_used('Matt') == 3
+    assert ims.get_user_points_used_total('Kyle') == 2
+    assert ims._history == [('1970-04-11', 'Kyle', 3, 2, {'Matt': 2})]
+
+def test_rollover_bounds_history():
+    ims = storage.InMemoryStorage(history_days=15)
+    now = [reset.DAY * 100 + 12 * 3600]
+    ims.resets = reset.ResetSchedule(default_offset=0, clock=lambda: now[0])
+    for day in range(4):
+        ims.give_points('Matt', {'Kyle': 1}, 'C1')
+        now[0] += reset.DAY * 10
+        ims.rollover()
+    assert [record[0] for record in ims._history] == ['1970-05-11', '1970-05-11']
+    assert sorted(ims._channels) == [('C1', '1970-05'), ('C1', 'ALL')]
+    # The gives of the days dropped are out of the graph too.
+    assert ims.get_top_pairs(5) == [('Matt', 'Kyle', 1)]
+    assert ims.get_fans('Kyle', 5, this_month=True) == [('Matt', 1)]
+    assert ims.sizes()['graph edges'] == 2
+
+def test_currency_counts(ims):
+    ims.set_default_currency('fireball')
+    ims.give_points('Matt', {'Kyle': 7, 'Ann': 7}, 'C1', {'fireball': 2, 'trophy': 1})
+    # Without counts, points are of the default currency.
+    ims.give_points('Kyle', {'Ann': 1})
+    assert ims.get_user_currencies_used('Matt') == {'fireball': 4, 'trophy': 2}
+    assert ims.get_user_points_used('Matt') == 14
+    assert ims.get_currency_leaders('fireball', 5) == [('Ann', 3), ('Kyle', 2)]
+    assert ims.get_currency_leaders('trophy', 1) == [('Ann', 1)]
+    assert ims.get_currency_leaders('star', 5) == []
+
+def test_gives_graph(ims):
+    ims.give_points('Matt', {'Kyle': 2, 'Ann': 2})
+    ims.give_points('Ann', {'Kyle': 4})
+    ims.give_points('Matt', {'Kyle': 1})
+    assert ims.get_fans('Kyle', 5) == [('Ann', 4), ('Matt', 3)]
+    assert ims.get_fans('Kyle', 1, this_month=True) == [('Ann', 4)]
+    assert ims.get_fans('Matt', 5) == []
+    assert ims.get_top_pairs(5) == [('Ann', 'Kyle', 4), ('Matt', 'Kyle', 3), ('Matt', 'Ann', 2)]
+    # Two periods, all time and this month, of three pairs.
+    assert ims.sizes()['graph edges'] == 6
@@ -0,0 +1,40 @@
+import pytest
+
+from conftest import FakeSlackClient
+import notifications
+from tenant import Tenant
+
+
+### Fixtures
+@pytest.fixture()
+def tenant():
+    tenant = Tenant('test', None, 'UBOT', ':fireball:', 'shots')
+    tenant.slack_client = FakeSlackClient()
+    return tenant
+
+
+### Tests
+def test_burst_is_merged(tenant, clock):
+    aggregator = notifications.NotificationAggregator(tenant, window=5, clock=clock)
+    aggregator.add('<@UA>', 'C1', 'kyle', 2)
+    aggregator.add('<@UA>', 'C1', 'matt', 1)
+    aggregator.add('<@UA>', 'C1', 'kyle', 1)
+    aggregator.add('<@UB>', 'C1', 'kyle', 1)
+    clock.now = 4
+    assert aggregator.flush() == 0
+    clock.now = 5
+    assert aggregator.flush() == 2
+    assert tenant.slack_client.calls == [
+        ('chat.postMessage', {'channel': 'UA', 'as_user': True,
+                              'text': 'You received 4 shots from 2 people: kyle (3), matt (1)'}),
+        ('chat.postMessage', {'channel': 'UB', 'as_user': True,
+                              'text': 'You received 1 shots from kyle'})]
+    assert len(aggregator) == 0
+
+def test_pm_preference_off_is_ephemeral(tenant, clock):
+    tenant.storage.set_pm_preference('<@UA>', 0)
+    aggregator = notifications.NotificationAggregator(tenant, window=0, clock=clock)
+    aggregator.add('<@UA>', 'C2', 'kyle', 1)
+    assert tenant.slack_client.calls == [
+        ('chat.postEphemeral', {'channel': 'C2', 'user': 'UA',
+                                'text': 'You received 1 shots from kyle'})]
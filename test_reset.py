@@ -0,0 +1,30 @@
+import datetime
+
+import reset
+
+
+### Tests
+def test_next_reset_is_local_midnight():
+    now = [reset.DAY * 100 + 3600]  # 01:00 UTC
+    schedule = reset.ResetSchedule(default_offset=0, clock=lambda: now[0])
+    schedule.set_offsets({'east': 2 * 3600, 'west': -5 * 3600})
+    assert schedule.next_reset('anyone') == reset.DAY * 101
+    # 03:00 local, next midnight is 22:00 UTC.
+    assert schedule.next_reset('east') == reset.DAY * 101 - 2 * 3600
+    # Still 20:00 yesterday in the west.
+    assert schedule.next_reset('west') == reset.DAY * 100 + 5 * 3600
+    assert schedule.today('west') == schedule.today('east') - datetime.timedelta(days=1)
+
+def test_due_reports_each_midnight_once():
+    now = [reset.DAY * 100 + 3600]
+    schedule = reset.ResetSchedule(default_offset=0, clock=lambda: now[0])
+    schedule.set_offsets({'west': -5 * 3600})
+    assert schedule.due() == []
+    now[0] = reset.DAY * 100 + 6 * 3600
+    assert schedule.is_due()
+    assert schedule.due() == [-5 * 3600]
+    assert schedule.due() == []
+    # Read after midnight, before the rollover ran: still reported.
+    now[0] = reset.DAY * 101 + 60
+    assert schedule.next_reset('anyone') == reset.DAY * 102
+    assert schedule.due() == [0]
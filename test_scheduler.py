@@ -0,0 +1,58 @@
+from scheduler import Scheduler, INTERACTIVE, BOARD
+
+
+### Tests
+def test_interactive_runs_before_boards():
+    executed = []
+    scheduler = Scheduler(executed.append)
+    scheduler.submit('fullboard', BOARD, 'C1 fullboard')
+    scheduler.submit('give 1', INTERACTIVE)
+    scheduler.submit('leaderboard', BOARD, 'C1 leaderboard')
+    scheduler.submit('give 2', INTERACTIVE)
+    assert scheduler.run() == 4
+    assert executed == ['give 1', 'give 2', 'fullboard', 'leaderboard']
+    assert len(scheduler) == 0
+
+def test_duplicate_boards_shed_when_overloaded(clock):
+    executed = []
+    scheduler = Scheduler(executed.append, shed_after=2, clock=clock)
+    assert scheduler.submit('board 1', BOARD, 'C1')
+    # Not overloaded yet: the duplicate is kept.
+    assert scheduler.submit('board 2', BOARD, 'C1')
+    clock.now = 3
+    assert not scheduler.submit('board 3', BOARD, 'C1')
+    assert scheduler.submit('board C2', BOARD, 'C2')
+    assert scheduler.submit('give', INTERACTIVE)
+    clock.now = 4
+    scheduler.run()
+    assert executed == ['give', 'board 1', 'board 2', 'board C2']
+    stats = scheduler.wait_stats()
+    assert stats['board']['shed'] == 1
+    assert stats['board']['max'] == 4
+    assert stats['interactive']['count'] == 1
+
+def test_run_budget(clock):
+
+    def execute(item):
+        clock.now += 1
+
+    scheduler = Scheduler(execute, clock=clock)
+    for i in range(5):
+        scheduler.submit(i, INTERACTIVE)
+    assert scheduler.run(budget=2) == 2
+    assert len(scheduler) == 3
+
+def test_failing_item_does_not_stop_the_others(capsys):
+    executed = []
+
+    def execute(item):
+        if item == 'bad give':
+            raise RuntimeError('Storage is down.')
+        executed.append(item)
+
+    scheduler = Scheduler(execute)
+    scheduler.submit('bad give', INTERACTIVE)
+    scheduler.submit('give', INTERACTIVE)
+    assert scheduler.run() == 2
+    assert executed == ['give']
+    assert 'Storage is down.' in capsys.readouterr().err
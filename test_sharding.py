@@ -0,0 +1,123 @@
+import datetime
+import queue
+import random
+import time
+
+import pytest
+
+from conftest import FakeSlackClient
+import reset
+import sharding
+from tenant import Tenant
+
+
+MAX_POINTS_PER_DAY = 5
+USERS = [f'U{i}' for i in range(20)]
+
+
+class SharedTableRouter():
+    """Router running the shard operations in this process on one shared storage.
+
+    This is how shards see Azure tables: every shard reads the same table.
+    """
+
+    def __init__(self, tenant, num_shards):
+        self.num_shards = num_shards
+        self.results = queue.Queue()
+        self.workers = [sharding.ShardWorker(i, [None] * num_shards, self.results, None)
+                        for i in range(num_shards)]
+        for worker in self.workers:
+            worker.tenants = {tenant.name: tenant}
+
+    def call(self, shard, op):
+        getattr(self.workers[shard], '_op_' + op[0])(*op[1:], None)
+        return self.results.get()[2]
+
+
+### Fixtures
+def make_tenants():
+    tenant = Tenant('test', None, 'UBOT', ':fireball:', 'shots',
+                    max_points_per_day=MAX_POINTS_PER_DAY)
+    tenant.slack_client = FakeSlackClient(members=USERS)
+    return [tenant]
+
+@pytest.fixture()
+def router():
+    router = sharding.ShardRouter(make_tenants(), 4, make_tenants)
+    router.start()
+    yield router
+    router.stop()
+
+
+### Tests
+def test_shard_for_is_stable():
+    assert sharding.shard_for('U1A1A1A1A', 8) == sharding.shard_for('<@U1A1A1A1A>', 8)
+    assert {sharding.shard_for(f'U{i}', 4) for i in range(100)} == {0, 1, 2, 3}
+
+def test_transfer_respects_daily_limit(router):
+    users = [f'<@U{i}>' for i in range(20)]
+    random.seed(0)
+    accepted = 0
+    for _ in range(200):
+        requestor, target = random.sample(users, 2)
+        if router.transfer('test', requestor, target, random.randint(1, 3)):
+            accepted += 1
+    assert accepted > 0
+    storage = router.tenants['test'].storage
+    used = [storage.get_user_points_used(u) for u in users]
+    assert max(used) <= MAX_POINTS_PER_DAY
+    # Every debit was credited on the target's shard.
+    assert sum(score for _, score in storage.get_users_and_scores_total()) == sum(used)
+    # The gives graph of every shard holds every transfer.
+    assert sum(points for _, _, points in storage.get_top_pairs(1000)) == sum(used)
+
+def test_sharded_storage_routes_to_owner(router):
+    storage = router.tenants['test'].storage
+    storage.add_user_points_received('<@UA>', 3)
+    storage.set_pm_preference('<@UA>', 0)
+    assert storage.get_user_points_received_total('<@UA>') == 3
+    assert storage.get_pm_preference('<@UA>') == 0
+
+def test_gives_race_across_shards(router):
+    random.seed(1)
+    # Every user sends 5 gives of 2 at once, to users of any shard: only
+    # two fit in the daily budget of 5.
+    for _ in range(5):
+        for user in USERS:
+            target = random.choice([u for u in USERS if u != user])
+            router.submit('test', {'type': 'message', 'user': user, 'channel': 'C1',
+                                   'text': f'<@{target}> :fireball: :fireball:'})
+    storage = router.tenants['test'].storage
+    # The requestor's shard has run its messages before answering.
+    used = [storage.get_user_points_used(f'<@{u}>') for u in USERS]
+    assert used == [4] * len(USERS)
+    # The credits are forwarded between shards, wait for the last ones.
+    deadline = time.time() + 10
+    while (sum(score for _, score in storage.get_users_and_scores_total()) != sum(used) and
+           time.time() < deadline):
+        time.sleep(0.05)
+    assert sum(score for _, score in storage.get_users_and_scores_total()) == sum(used)
+
+def test_gather_counts_shared_storage_once():
+    tenant = make_tenants()[0]
+    shared = tenant.storage
+    now = [reset.DAY * 100]
+    shared.resets = reset.ResetSchedule(default_offset=0, clock=lambda: now[0])
+    random.seed(2)
+    users = [f'<@{user}>' for user in USERS]
+    for day in range(2):
+        for _ in range(30):
+            requestor, target = random.sample(users, 2)
+            shared.give_points(requestor, {target: 1}, 'C1')
+        now[0] += reset.DAY
+        shared.rollover()
+    storage = sharding.ShardedStorage(SharedTableRouter(tenant, 4), 'test')
+    assert sorted(storage.get_users_and_scores_total()) == sorted(shared.get_users_and_scores_total())
+    assert sorted(storage.get_channel_users_and_scores('C1')) == sorted(shared.get_channel_users_and_scores('C1'))
+    # Scores decay with time and may tie, compare them regardless of order.
+    assert (dict(storage.get_recent_leaders(len(users))) ==
+            pytest.approx(dict(shared.get_recent_leaders(len(users)))))
+    assert sorted(storage.get_top_pairs(100)) == sorted(shared.get_top_pairs(100))
+    assert sorted(storage.get_fans(users[0], 20)) == sorted(shared.get_fans(users[0], 20))
+    start = datetime.date(1970, 1, 1)
+    assert sorted(storage.get_daily_history(start)) == sorted(shared.get_daily_history(start))
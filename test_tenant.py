@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from conftest import FakeSlackClient
+import hey_fireball
+from tenant import Tenant, load_tenant_configs, load_tenants
+
+
+CONFIGS = [{'name': 'acme', 'slack_token': 'xoxb-acme', 'bot_id': 'UBOT1',
+            'emoji': ':fireball:', 'points': 'shots'},
+           {'name': 'globex', 'slack_token': 'xoxb-globex', 'bot_id': 'UBOT2',
+            'emoji': ':taco:', 'points': 'tacos', 'max_points_per_day': 3}]
+
+
+def message(text, user='UA', channel='C1'):
+    return {'type': 'message', 'user': user, 'channel': channel, 'text': text, 'ts': '1.0'}
+
+
+### Fixtures
+@pytest.fixture()
+def tenants_file(tmp_path, monkeypatch):
+    path = tmp_path / 'tenants.json'
+    path.write_text(json.dumps(CONFIGS))
+    monkeypatch.setenv('TENANTS_FILE', str(path))
+    return path
+
+
+### Tests
+def test_load_tenants_from_file(tenants_file):
+    assert load_tenant_configs() == CONFIGS
+    acme, globex = load_tenants()
+    assert (acme.name, acme.at_bot, acme.points, acme.max_points_per_day) == ('acme', '<@UBOT1>', 'shots', 5)
+    assert (globex.name, globex.emoji, globex.max_points_per_day) == ('globex', ':taco:', 3)
+
+def test_load_tenant_from_env(monkeypatch):
+    monkeypatch.delenv('TENANTS_FILE', raising=False)
+    for name, value in (('SLACK_BOT_TOKEN', 'xoxb-1'), ('BOT_ID', 'UBOT'), ('EMOJI', ':taco:'),
+                        ('POINTS', 'tacos'), ('MAX_POINTS_PER_DAY', '7'),
+                        ('ADMIN_USERS', 'UA,UB'), ('DAILY_DIGEST_CHANNELS', 'C1')):
+        monkeypatch.setenv(name, value)
+    tenant, = load_tenants()
+    assert (tenant.name, tenant.at_bot, tenant.emoji, tenant.points) == ('default', '<@UBOT>', ':taco:', 'tacos')
+    assert tenant.max_points_per_day == 7
+    assert tenant.admins == ['UA', 'UB']
+    assert tenant.digest_channels == {'daily': ['C1']}
+
+def test_tenant_creation_does_no_io():
+    tenant = Tenant(**CONFIGS[0])
+    assert tenant._slack_client is None and tenant._storage is None
+    assert tenant.sizes() == {'users cached': 0, 'admission buckets': 0,
+                              'boards cached': 0, 'notifications pending': 0}
+
+def test_tenants_have_their_own_storage():
+    acme, globex = [Tenant(**config) for config in CONFIGS]
+    assert acme.storage is not globex.storage
+    acme.storage.give_points('<@UA>', {'<@UB>': 2})
+    assert acme.storage.get_user_points_received_total('<@UB>') == 2
+    assert globex.storage.get_users_and_scores_total() == []
+
+def test_app_serves_every_tenant(tenants_file):
+    app = hey_fireball.App(num_shards=1)
+    acme, globex = app.tenants
+    acme.slack_client = FakeSlackClient([message('<@UB> :fireball: :fireball:')])
+    globex.slack_client = FakeSlackClient([message('<@UB> :taco:'),
+                                           message('<@UBOT2> tacosleft'),
+                                           # Another workspace's emoji is ignored.
+                                           message('<@UB> :fireball:')])
+    for tenant in (acme, globex):
+        tenant.user_name_lookup = {'UA': 'kyle', 'UB': 'matt'}
+        tenant.notifications.window = 0
+    app.step([acme, globex])
+    assert acme.storage.get_user_points_received_total('<@UB>') == 2
+    assert globex.storage.get_user_points_received_total('<@UB>') == 1
+    assert [kwargs['text'] for _, kwargs in acme.slack_client.calls] == [
+        'You received 2 shots from kyle']
+    assert [kwargs['text'] for _, kwargs in globex.slack_client.calls] == [
+        'You received 1 tacos from kyle', 'You have 2 tacos remaining']